@@ -3,152 +3,691 @@ import logging
 import sys
 import datetime
 import os
+import copy
+import json
+import re
+import shlex
+import socket
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import glob
+import tempfile
 from dotenv import load_dotenv
+from assets.manifest import ChangeManifest
+from assets.locks import RepoLock
+from assets.misc import in_window
+from assets.snapshot_index import partial_tag
+
+# restic's error when another process holds the repo lock, with the holder's PID and host and the lock's age
+lock_error = re.compile(r'locked (?:exclusively )?by PID (\d+) on (\S+) by .*?lock was created at [^(]*\(([^)]*) ago\)', re.S)
+
+class ProgressTracker:
+
+    '''
+    Consumes the messages restic prints with --json and turns them into progress events.
+    Status messages get files_per_second, bytes_per_second and eta added, the summary message is kept in self.summary,
+    error messages (files that couldn't be read) in self.errors and the exit_error restic prints before a fatal exit in self.exit_error.
+    Every event is passed to the callbacks, by default a short progress line is printed every print_interval seconds.
+    '''
+    def __init__(self, prefix='', callbacks=None, print_interval=10):
+        self.prefix = prefix
+        self.callbacks = callbacks if callbacks is not None else [self.print_progress]
+        self.print_interval = print_interval
+        self.last_print = 0
+        self.summary = None
+        self.errors = []
+        self.exit_error = None
+
+    def __call__(self, event):
+        message_type = event.get('message_type')
+        if message_type == 'status':
+            elapsed = event.get('seconds_elapsed') or 0
+            if elapsed:
+                event['files_per_second'] = event.get('files_done', 0) / elapsed
+                event['bytes_per_second'] = event.get('bytes_done', 0) / elapsed
+            event['eta'] = event.get('seconds_remaining')
+        elif message_type == 'summary':
+            duration = event.get('total_duration') or 0
+            if duration:
+                event['files_per_second'] = event.get('total_files_processed', 0) / duration
+                event['bytes_per_second'] = event.get('total_bytes_processed', 0) / duration
+            self.summary = event
+        elif message_type == 'error':
+            self.errors.append(event)
+        elif message_type == 'exit_error':
+            self.exit_error = event
+        for callback in self.callbacks:
+            callback(event)
+
+    def print_progress(self, event):
+        message_type = event.get('message_type')
+        if message_type == 'status':
+            if time.monotonic() - self.last_print < self.print_interval:
+                return
+            self.last_print = time.monotonic()
+            percent = event.get('percent_done', 0) * 100
+            rate = event.get('bytes_per_second', 0) / 1024 / 1024
+            print(f"{self.prefix}{percent:.1f}% {event.get('files_done', 0)}/{event.get('total_files', 0)} files, {rate:.1f} MiB/s, ETA {event.get('eta')}s")
+        elif message_type == 'summary':
+            added = event.get('data_added', 0) / 1024 / 1024
+            rate = event.get('bytes_per_second', 0) / 1024 / 1024
+            print(f"{self.prefix}Snapshot {event.get('snapshot_id')}: {event.get('files_new', 0)} new files, {added:.1f} MiB added in {event.get('total_duration', 0):.1f}s ({rate:.1f} MiB/s)")
+        elif message_type == 'error':
+            print(f"{self.prefix}Error: {event.get('error', {}).get('message', event)} {event.get('item', '')}")
+        elif message_type == 'exit_error':
+            print(f"{self.prefix}restic exited with code {event.get('code')}: {event.get('message', event)}")
+
+    def error_text(self, stderr):
+        '''
+        What went wrong, with --json restic's error messages are events and no longer in stderr.
+        '''
+        messages = [f"{event.get('error', {}).get('message', '')} {event.get('item', '')}".strip() for event in self.errors]
+        if self.exit_error:
+            messages.append(self.exit_error.get('message', ''))
+        return '\n'.join(filter(None, [stderr.strip()] + messages))
 
 class ResticBackup:
 
     '''
     Defining the restic class to backup, list snaphosts, restore, mount and forget.
     Includes a subprocess method that will print output while executing, useful for restores and backups which will take long and will only clear the buffer at the end of the command.
+    The parts of the restic command line that don't change between runs are built once when the task is created.
     '''
-    def __init__(self, loaded_config, restic_path, script_path, options=None, forget_options=None, exclude=None):
+    def __init__(self, loaded_config, restic_path, script_path, options=None, forget_options=None, exclude=None, name=None, lock_options=None):
         self.repo_path = loaded_config['repo_path']
-        self.backup_path = loaded_config['backup_path']
+        self.backup_path = loaded_config.get('backup_path')
         self.options = loaded_config['options']
-        self.exclude = loaded_config['exclude']
+        self.exclude = loaded_config.get('exclude')
+        self.source = loaded_config.get('source')
+        self.change_detection = loaded_config.get('change_detection') or {}
+        self.maintenance_options = loaded_config.get('maintenance') or {}
+        self.copy_from = loaded_config.get('copy_from')
+        self.limit_upload = loaded_config.get('limit_upload')
+        self.shaping = loaded_config.get('shaping') or []
+        self.primary = None
         self.backup_type = loaded_config['type']
         if self.backup_type != 's3':
-            self.host = loaded_config['host']
+            # Only sftp repos need one, config.validate_config checks that
+            self.host = loaded_config.get('host')
         self.password_file = loaded_config['password_file']
         self.forget_options = loaded_config['forget_options']
         self.enabled = loaded_config['enabled']
         self.script_path = script_path
         self.restic = restic_path
+        self.name = name
+        self.prefix = f'[{name}] ' if name else ''
+        self.lock_options = lock_options or {}
+        self.json_status = bool(self.options and self.options.get('json'))
+        self.returncode = None
+        self.errors = []
+        self.exclude_file = None
+        self.backup_paths = self.backup_path.split() if self.backup_path else []
+        self.password_args = ['--password-file', self.password_file]
+        self.forget_args = ['--keep-daily', str(self.forget_options['daily']), '--keep-weekly', str(self.forget_options['weekly']), '--keep-monthly', str(self.forget_options['monthly'])]
+        if self.change_detection.get('files_from'):
+            # Every partial snapshot has its own paths, grouped by restic's default host,paths each would be kept forever
+            self.forget_args += ['--group-by', 'host,tags']
+        self.apply_profile(None)
+
+    def apply_profile(self, profile):
+        '''
+        Rebuilds the command prefix and the backup options for a shaping profile (profiles on the config file): nice/ionice
+        in front of restic, upload/download limits, pack size and backend connections on every command and
+        --read-concurrency on backups. None goes back to the repo's own options.
+        '''
+        profile = profile or {}
+        self.profile = profile
+        prefix = []
+        if profile.get('ionice_class') is not None:
+            prefix += ['ionice', '-c', str(profile['ionice_class'])]
+            if profile.get('ionice_level') is not None:
+                prefix += ['-n', str(profile['ionice_level'])]
+        if profile.get('nice') is not None:
+            prefix += ['nice', '-n', str(profile['nice'])]
+        global_args = []
+        for key, flag in [('limit_upload', '--limit-upload'), ('limit_download', '--limit-download'), ('pack_size', '--pack-size')]:
+            if profile.get(key) is not None:
+                global_args += [flag, str(profile[key])]
+        if profile.get('connections') is not None and self.backup_type in ['s3', 'sftp']:
+            global_args += ['-o', f'{self.backup_type}.connections={profile["connections"]}']
+        if self.lock_options.get('retry_lock'):
+            global_args += ['--retry-lock', str(self.lock_options['retry_lock'])]
+        self.base_args = prefix + [self.restic, '-r', self.repository()] + global_args
+        self.backup_options = self.option_parser(profile.get('read_concurrency'))
+
+    def run_command(self, cmd, on_event=None, quiet=False, stdin=None):
+        '''
+        Runs cmd with run_process. When restic failed because of a stale lock (left behind by a killed run) the lock is
+        removed with restic unlock and the command runs once more. Not for --stdin backups, their input is already used up.
+        '''
+        stdout, stderr = self.run_process(cmd, on_event, quiet, stdin)
+        # With --json the lock error is an event and no longer in stderr
+        error = on_event.error_text(stderr) if isinstance(on_event, ProgressTracker) else stderr
+        if self.returncode and stdin is None and self.unlock_stale(error):
+            stdout, stderr = self.run_process(cmd, on_event, quiet, stdin)
+        return stdout, stderr
+
+    def unlock_stale(self, stderr):
+        '''
+        Runs restic unlock when stderr is restic's lock error and the lock is stale. restic unlock itself only removes
+        stale locks, a live run elsewhere keeps its lock either way. Returns True when the command can be tried again.
+        '''
+        reason = stale_lock(stderr, self.lock_options.get('stale_minutes', 30))
+        if not reason:
+            return False
+        returncode = self.returncode
+        print(f'{self.prefix}Removing stale restic lock on {self.repo_path}: {reason}.')
+        logging.warning(f'Stale restic lock on {self.backup_type}:{self.repo_path} ({reason}), running restic unlock.')
+        _, unlock_error = self.run_process(self.base_args + ['unlock'] + self.password_args, quiet=True)
+        if self.returncode != 0:
+            logging.warning(f'restic unlock failed on {self.repo_path}: {unlock_error}')
+            self.returncode = returncode
+            return False
+        return True
 
-    def run_command(self, cmd):
-        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8')
+    def run_process(self, cmd, on_event=None, quiet=False, stdin=None):
+        process = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8')
         '''
         Read and print the output while the process is running.
+        With on_event set, lines that are restic --json messages are passed to it instead of being printed.
+        With quiet set nothing is printed and the whole stdout is returned, for output that is parsed afterwards.
+        stderr is read on its own thread so a chatty restic can't fill the pipe and stall the loop.
         Catches the KeyboardInterrupt, needed for the mount closing.
+        cmd is an argv list from type_selector, it runs without a shell so nothing in it needs quoting.
         '''
+        if quiet:
+            stdout, stderr = process.communicate()
+            self.returncode = process.returncode
+            logging.debug(f'Ran command {shlex.join(cmd)}.')
+            return stdout, stderr
+        stderr_lines = []
+        stderr_reader = threading.Thread(target=lambda: stderr_lines.extend(process.stderr), daemon=True)
+        stderr_reader.start()
         try:
             while True:
                 output = process.stdout.readline()
                 if output == '' and process.poll() is not None:
                     break
                 if output:
-                    print(output.strip())
+                    if on_event and self.dispatch_event(output, on_event):
+                        continue
+                    print(f'{self.prefix}{output.strip()}')
         except KeyboardInterrupt:
             process.terminate()
             process.wait()
 
-        stdout, stderr = process.communicate()
-        logging.debug(f'Ran command {cmd}.')
+        # Not communicate(), it would read stderr too and take lines from stderr_reader
+        stdout = process.stdout.read()
+        process.wait()
+        stderr_reader.join()
+        if on_event:
+            stderr_lines = [line for line in stderr_lines if not self.dispatch_event(line, on_event)]
+        stderr = ''.join(stderr_lines)
+        self.returncode = process.returncode
+        logging.debug(f'Ran command {shlex.join(cmd)}.')
         return stdout, stderr
 
-    def type_selector(self, job, options=None, snapshot_id=None, restore_path=None):
+    def dispatch_event(self, line, on_event):
+        '''
+        Returns True when the line was a restic --json message and was handed to on_event.
+        '''
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return False
+        if not isinstance(event, dict) or 'message_type' not in event:
+            return False
+        on_event(event)
+        return True
+
+    def type_selector(self, job, options=None, snapshot_id=None, restore_path=None, paths=None):
 
         '''
-        type_selector is used to modify the restic command based on the type of host used, local, FTP or S3.
-        Each task will call it to get a return of the command needed. Some options will differ like forget(daily, weekly, monthly), exclude, etc.
+        type_selector is used to build the restic command based on the type of host used, local, FTP or S3.
+        Each task will call it to get the argv list needed. Some options will differ like forget(daily, weekly, monthly), exclude, etc.
+        The repo, password file and forget arguments come precomputed from __init__, options and paths are lists.
         All commands include --password-file to allow running from cron.
         '''
-        if self.backup_type == 'sftp':
-            host = f'{self.backup_type}:{self.host}:{self.repo_path}'
-        elif self.backup_type == 's3':
-            self.s3_env_set()
-            host = f'{self.backup_type}:{self.repo_path}'
-        else:
-            host = f'{self.repo_path}'
-
-        if job == 'backup':
-            exclude_file = self.set_exclude()
-            cmd = f'{self.restic} -r {host} {options} --exclude-file={exclude_file} {job} {self.backup_path} --password-file {self.password_file}'
+        options = options or []
+        if job == 'backup' and self.source:
+            cmd = self.base_args + options + [job, '--stdin', '--stdin-filename', self.source.get('filename', 'stdin')] + self.password_args
+        elif job == 'dump':
+            cmd = self.base_args + [job, snapshot_id, self.source.get('filename', 'stdin')] + self.password_args
+        elif job == 'backup':
+            cmd = self.base_args + options + [f'--exclude-file={self.set_exclude()}', job] + (paths or self.backup_paths) + self.password_args
         elif job == 'snapshots':
-            cmd = f'{self.restic} -r {host} {job} --password-file {self.password_file}'
+            cmd = self.base_args + [job] + options + self.password_args
         elif job == 'restore':
-            cmd = f'{self.restic} -r {host} {job} {snapshot_id} --target {restore_path} --password-file {self.password_file}'
+            cmd = self.base_args + [job, snapshot_id, '--target', restore_path] + options + self.password_args
         elif job == 'forget':
-            cmd = f'{self.restic} -r {host} {job} --keep-daily {self.forget_options["daily"]} --keep-weekly {self.forget_options["weekly"]} --keep-monthly {self.forget_options["monthly"]} --password-file {self.password_file}'
+            cmd = self.base_args + [job] + self.forget_args + options + self.password_args
+        elif job == 'copy':
+            cmd = self.base_args + options + [job] + self.primary_args() + self.password_args
+        elif job == 'init' and self.primary:
+            cmd = self.base_args + [job] + self.primary_args() + ['--copy-chunker-params'] + self.password_args
         elif job == 'init':
-            cmd = f'{self.restic} -r {host} {job} --password-file {self.password_file}' 
+            cmd = self.base_args + [job] + self.password_args
         elif job == 'mount':
-            cmd = f'{self.restic} -r {host} {job} {restore_path} --password-file {self.password_file}'
+            cmd = self.base_args + [job, restore_path] + self.password_args
         elif job[0] == 'other':
-            cmd = f'{self.restic} -r {host} {job[1]} --password-file {self.password_file}'
+            cmd = self.base_args + shlex.split(job[1]) + self.password_args
         else:
-            print(f'Task is not defined.')
+            print(f'{self.prefix}Task is not defined.')
             logging.warning(f'Task is not defined. Exiting.')
             sys.exit()
         return cmd
 
+    def repository(self):
+        '''
+        The -r argument for this repo.
+        '''
+        if self.backup_type == 'sftp':
+            return f'{self.backup_type}:{self.host}:{self.repo_path}'
+        elif self.backup_type == 's3':
+            self.s3_env_set()
+            return f'{self.backup_type}:{self.repo_path}'
+        return f'{self.repo_path}'
+
+    def primary_args(self):
+        return ['--from-repo', self.primary.repository(), '--from-password-file', self.primary.password_file]
+
     def create(self):
         job = 'init'
         cmd = self.type_selector(job)
         stdout, stderr = self.run_command(cmd)
         if stderr:
-            print(f'Error initializing repository: {stderr}')
+            print(f'{self.prefix}Error initializing repository: {stderr}')
             logging.debug(f'Error initializing repository: {stderr}')
             return False
-        print(f'{stdout}\nSuccessfully created repo for {self.repo_path} on {self.backup_type}.')
+        print(f'{self.prefix}{stdout}\nSuccessfully created repo for {self.repo_path} on {self.backup_type}.')
         logging.info(f'Successfully created repo for {self.repo_path} on {self.backup_type}.')
+        return True
 
 
-    def backup(self, options):
+    def backup(self, options, on_event=None):
         '''
         Backup options can be set on the config file.
+        With json: true in the options restic reports progress as JSON, on_event receives every progress/summary event and the summary is returned.
         '''
+        if self.source:
+            return self.backup_stdin(options, on_event)
         job = 'backup'
         now = datetime.datetime.now()
-        cmd = self.type_selector(job, options) 
-        stdout, stderr = self.run_command(cmd)
-        if stderr:
-           print(f'Error creating backup: {stderr}')
-           logging.debug(f'Error creting backup: {stderr}')
-           return False
-        print(f'{stdout}\nSuccessfully created backup of {self.backup_path} at {now} on {self.backup_type}.')
-        logging.info(f'Successfully created backup of {self.backup_path} at {now} on {self.backup_type}.')
+        paths = None
+        manifest = None
+        if self.change_detection.get('enabled'):
+            manifest, scan, paths = self.check_changes()
+            if paths is False:
+                return {'skipped': True, 'changed_dirs': 0}
+        if paths and paths[0] == '--files-from':
+            # Only the changed directories, tagged so restores and dumps of "latest" pass over it
+            options = (options or []) + ['--tag', partial_tag]
+        cmd = self.type_selector(job, options, paths=paths) 
+        tracker = None
+        if self.json_status:
+            tracker = ProgressTracker(self.prefix)
+            if on_event:
+                tracker.callbacks.append(on_event)
+        stdout, stderr = self.run_command(cmd, tracker)
+        if paths and paths[0] == '--files-from':
+            os.remove(paths[1])
+        error = tracker.error_text(stderr) if tracker else stderr.strip()
+        # 0 is success and 3 a snapshot missing files restic couldn't read, anything else means no snapshot
+        if self.returncode not in (0, 3):
+            print(f'{self.prefix}Error creating backup (exit code {self.returncode}): {error}')
+            logging.warning(f'Backup of {self.backup_path} on {self.backup_type} failed with exit code {self.returncode}: {error}')
+            return False
+        self.errors = tracker.errors if tracker else []
+        if self.returncode == 3 or self.errors:
+            # No manifest, so the directories with unreadable files are backed up again next time
+            print(f'{self.prefix}{stdout}\nCreated an incomplete backup of {self.backup_path} at {now} on {self.backup_type}, some files could not be read: {error}')
+            logging.warning(f'Incomplete backup of {self.backup_path} on {self.backup_type} (exit code {self.returncode}): {error}')
+        else:
+            if manifest:
+                manifest.save(self.backup_paths, scan, full=paths is None)
+            print(f'{self.prefix}{stdout}\nSuccessfully created backup of {self.backup_path} at {now} on {self.backup_type}.')
+            logging.info(f'Successfully created backup of {self.backup_path} at {now} on {self.backup_type}.')
+        if tracker and tracker.summary:
+            summary = tracker.summary
+            logging.info(f"Backup of {self.backup_path} on {self.backup_type}: {summary.get('files_new')} new files, {summary.get('data_added')} bytes added in {summary.get('total_duration')}s.")
+            return summary
+        return True
     
-    def forget(self):
+    def copy(self):
+        '''
+        Replicas (copy_from set on the config file) are filled with restic copy from their primary instead of reading and
+        chunking backup_path a second time. Only snapshots missing here are copied. limit_upload caps the upload in KiB/s
+        unless the shaping profile sets its own.
+        The primary is locked shared while copying so its maintenance can't prune what is being copied.
+        Replicas should be created with init, which copies the primary's chunker parameters so copied data deduplicates.
+        '''
+        if not self.primary:
+            print(f'{self.prefix}Primary repo {self.copy_from} not found in the config file.')
+            logging.warning(f'Primary repo {self.copy_from} of {self.repo_path} not found in the config file.')
+            return False
+        job = 'copy'
+        now = datetime.datetime.now()
+        options = ['--limit-upload', str(self.limit_upload)] if self.limit_upload and 'limit_upload' not in self.profile else []
+        cmd = self.type_selector(job, options)
+        with self.primary.repo_lock(shared=True):
+            stdout, stderr = self.run_command(cmd)
+        if self.returncode != 0:
+            print(f'{self.prefix}Error copying snapshots from {self.copy_from}: {stderr}')
+            logging.debug(f'Error copying snapshots from {self.copy_from} to {self.repo_path}: {stderr}')
+            return False
+        print(f'{self.prefix}{stdout}\nSuccessfully copied snapshots from {self.copy_from} to {self.repo_path} at {now} on {self.backup_type}.')
+        logging.info(f'Successfully copied snapshots from {self.copy_from} to {self.repo_path} at {now} on {self.backup_type}.')
+        return True
+
+    def check_changes(self):
+        '''
+        Compares backup_path against the manifest of the last backup. Returns (manifest, scan, paths) where paths is False
+        when the backup can be skipped, None for a normal run, or the --files-from arguments listing the files of the changed
+        directories when change_detection.files_from is set. A backup always runs once the last one is older than
+        change_detection.max_skip_hours, so retention policies keep getting fresh snapshots, and with files_from the whole
+        backup_path is backed up again once the last full backup is that old, so "latest" never falls far behind.
+        '''
+        key = hashlib.sha1(f'{self.backup_type}:{self.repo_path}:{self.backup_path}'.encode()).hexdigest()[:16]
+        manifest = ChangeManifest(f'{self.script_path}/logs/manifests/{key}.json', self.exclude)
+        roots = self.backup_paths
+        start = time.monotonic()
+        changed, scan = manifest.changes(roots)
+        elapsed = time.monotonic() - start
+        max_skip = self.change_detection.get('max_skip_hours')
+        expired = max_skip is not None and manifest.age() is not None and manifest.age() > max_skip * 60 * 60
+        if not changed and not expired:
+            print(f'{self.prefix}No changes in {self.backup_path} since the last backup (checked {len(scan)} directories in {elapsed:.1f}s), skipping.')
+            logging.info(f'Skipped backup of {self.backup_path} on {self.backup_type}: no changes in {len(scan)} directories.')
+            return manifest, scan, False
+        logging.info(f'{len(changed)} of {len(scan)} directories changed in {self.backup_path}, checked in {elapsed:.1f}s.')
+        full_due = max_skip is not None and manifest.full_age() is not None and manifest.full_age() > max_skip * 60 * 60
+        if self.change_detection.get('files_from') and manifest.saved and not expired and not full_due:
+            files = [path for directory in changed if directory in scan for path in scan[directory][1]]
+            if not files:
+                return manifest, scan, None
+            with tempfile.NamedTemporaryFile('w', prefix='restic-files-', suffix='.txt', delete=False) as files_from:
+                files_from.write('\n'.join(files) + '\n')
+            print(f'{self.prefix}Backing up {len(files)} files from {len(changed)} changed directories.')
+            return manifest, scan, ['--files-from', files_from.name]
+        return manifest, scan, None
+
+    def backup_stdin(self, options, on_event=None):
+        '''
+        Backs up the output of source.command (e.g. pg_dump) through restic backup --stdin, without writing the dump to disk.
+        The dump's stdout is handed to restic as its stdin, so the only buffering is the kernel pipe and a slow repo slows the dump down.
+        source.command is a shell command line (pipes, redirects) so it is the one part that still runs through the shell.
+        restic always runs with --json here to know the snapshot ID: when the dump command fails the snapshot holds a
+        truncated dump, so it is forgotten again and the backup is reported as failed.
+        '''
+        job = 'backup'
+        now = datetime.datetime.now()
+        command = self.source['command']
+        if '--json' not in options:
+            options = options + ['--json']
+        cmd = self.type_selector(job, options)
+        tracker = ProgressTracker(self.prefix)
+        if on_event:
+            tracker.callbacks.append(on_event)
+        dump = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        dump_errors = []
+        dump_reader = threading.Thread(target=lambda: dump_errors.extend(dump.stderr), daemon=True)
+        dump_reader.start()
+        stdout, stderr = self.run_command(cmd, tracker, stdin=dump.stdout)
+        dump.stdout.close()
+        dump.wait()
+        dump_reader.join()
+        dump_error = b''.join(dump_errors).decode('utf-8', 'replace').strip()
+        if dump.returncode != 0:
+            print(f'{self.prefix}Error running {command} (exit code {dump.returncode}): {dump_error}')
+            logging.warning(f'Dump command for {self.repo_path} failed with exit code {dump.returncode}: {dump_error}')
+            if tracker.summary and tracker.summary.get('snapshot_id'):
+                self.run_command(self.type_selector(['other', f"forget {tracker.summary['snapshot_id']}"]), quiet=True)
+                logging.info(f"Forgot incomplete snapshot {tracker.summary['snapshot_id']} of {self.repo_path}.")
+            return False
+        if stderr or self.returncode != 0:
+            error = tracker.error_text(stderr)
+            print(f'{self.prefix}Error creating backup from {command} (exit code {self.returncode}): {error}')
+            logging.warning(f'Backup from {command} failed with exit code {self.returncode}: {error}')
+            return False
+        print(f'{self.prefix}Successfully created backup of {command} at {now} on {self.backup_type}.')
+        logging.info(f'Successfully created backup of {command} at {now} on {self.backup_type}.')
+        return tracker.summary or True
+
+    def dump(self, snapshot_id, restore_path=None):
+        '''
+        Streams source.filename out of a snapshot with restic dump: to stdout with restore_path -, to a file with a path, or
+        piped into source.restore_command (e.g. psql) when no path is given.
+        '''
+        if not self.source:
+            print(f'{self.prefix}dump needs a repo with a source command.')
+            return False
+        snapshot_id = snapshot_id or 'latest'
+        cmd = self.type_selector('dump', snapshot_id=snapshot_id)
+        restore_command = self.source.get('restore_command')
+        if restore_path == '-' or (not restore_path and not restore_command):
+            process = subprocess.run(cmd, stdout=sys.stdout.buffer, stderr=subprocess.PIPE)
+            returncode, error, target = process.returncode, process.stderr, 'stdout'
+        elif restore_path:
+            with open(restore_path, 'wb') as output:
+                process = subprocess.run(cmd, stdout=output, stderr=subprocess.PIPE)
+            returncode, error, target = process.returncode, process.stderr, restore_path
+        else:
+            restic = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            consumer = subprocess.Popen(restore_command, shell=True, stdin=restic.stdout)
+            restic.stdout.close()
+            _, error = restic.communicate()
+            consumer.wait()
+            returncode, target = restic.returncode, restore_command
+            if consumer.returncode != 0:
+                print(f'{self.prefix}Error running {restore_command} (exit code {consumer.returncode}).', file=sys.stderr)
+                logging.warning(f'{restore_command} failed with exit code {consumer.returncode} restoring {snapshot_id}.')
+                return False
+        if returncode != 0:
+            print(f'{self.prefix}Error dumping snapshot {snapshot_id}: {error.decode("utf-8", "replace")}', file=sys.stderr)
+            logging.debug(f'Error dumping snapshot {snapshot_id} from {self.backup_type}.')
+            return False
+        logging.info(f'Dumped snapshot {snapshot_id} from: {self.backup_type} to {target}')
+        return True
+
+    def forget(self, options=None):
         '''
         Forget parameters can be set on the config file.
         '''
         job = 'forget'
         now = datetime.datetime.now()
-        cmd = self.type_selector(job)
+        cmd = self.type_selector(job, options)
         stdout, stderr = self.run_command(cmd)
         if stderr:
-            print(f'Error forgetting old snapshots: {stderr}')
+            print(f'{self.prefix}Error forgetting old snapshots: {stderr}')
             logging.debug(f'Error forgetting old snapshots from {self.backup_type}.')
             return False
-        print(f'{stdout}\nSuccessfully forgot backup for {self.repo_path} at {now} on {self.backup_type}.')
+        print(f'{self.prefix}{stdout}\nSuccessfully forgot backup for {self.repo_path} at {now} on {self.backup_type}.')
         logging.info(f'Successfully forgot backup for {self.repo_path} at {now} on {self.backup_type}.')
+        return True
+
+    def maintenance(self):
+        '''
+        Maintenance chain set under maintenance in the config file: forget, with --prune and the --max-unused/--max-repack-size
+        budgets when prune is set, then check --read-data-subset on a sample of the pack files when check_subset is set.
+        Each step only runs when the previous one succeeded. Outside of window ("HH:MM-HH:MM") the repo is skipped.
+        Without a maintenance section this is a plain forget.
+        '''
+        settings = self.maintenance_options
+        if not in_window(settings.get('window')):
+            print(f'{self.prefix}Outside the maintenance window {settings["window"]} for {self.repo_path}, skipping.')
+            logging.info(f'Skipped maintenance of {self.repo_path}: outside the window {settings["window"]}.')
+            return {'skipped': True}
+        options = []
+        if settings.get('prune'):
+            options.append('--prune')
+            if settings.get('max_unused'):
+                options += ['--max-unused', str(settings['max_unused'])]
+            if settings.get('max_repack_size'):
+                options += ['--max-repack-size', str(settings['max_repack_size'])]
+        start = time.monotonic()
+        if not self.forget(options):
+            return False
+        forget_duration = time.monotonic() - start
+        if settings.get('check_subset'):
+            if not self.other(f"check --read-data-subset {settings['check_subset']}"):
+                return False
+        duration = time.monotonic() - start
+        logging.info(f'Maintenance of {self.repo_path} on {self.backup_type} done in {duration:.1f}s (forget{"/prune" if settings.get("prune") else ""} {forget_duration:.1f}s).')
+        return True
+
+    def repo_lock(self, shared=False):
+        '''
+        Local lock on this repo: backups take it shared, maintenance exclusive, so they never overlap on this host.
+        '''
+        return RepoLock(self.script_path, f'{self.backup_type}:{getattr(self, "host", "")}:{self.repo_path}', shared)
 
     def list_snapshots(self):
         job = 'snapshots'
         cmd = self.type_selector(job)
-        print(f'Listing snapshots from {self.backup_type}:{self.repo_path}.')
+        print(f'{self.prefix}Listing snapshots from {self.backup_type}:{self.repo_path}.')
         stdout, stderr = self.run_command(cmd)
         if stderr:
-           print(f'Error listing snapshots: {stderr}')
+           print(f'{self.prefix}Error listing snapshots: {stderr}')
            logging.debug(f'Error listing snapshots: {stderr}')
            return False
         logging.info(f'Listed snapshots from: {self.backup_type}:{self.repo_path}.')
+        return True
+
+    def fetch_snapshots(self):
+        '''
+        Returns the parsed `restic snapshots --json` list without printing it, None on error. Used to refresh the snapshot index.
+        '''
+        cmd = self.type_selector('snapshots', ['--json'])
+        stdout, stderr = self.run_command(cmd, quiet=True)
+        if self.returncode != 0:
+            print(f'{self.prefix}Error listing snapshots: {stderr}')
+            logging.debug(f'Error listing snapshots: {stderr}')
+            return None
+        return json.loads(stdout or '[]') or []
 
-    def restore(self, snapshot_id, restore_path, options=None):
+    def restore(self, snapshot_id, restore_path, options=None, overlays=None):
+        '''
+        overlays are partial snapshots restored on top, see restore_overlays.
+        '''
         if not snapshot_id or not restore_path:
             logging.warning(f'snapshot ID or restore path missing.')
-            print(f'snapshot ID or restore path missing.')
+            print(f'{self.prefix}snapshot ID or restore path missing.')
             sys.exit() 
         job = 'restore'
         cmd = self.type_selector(job, options, snapshot_id, restore_path)
         stdout, stderr = self.run_command(cmd)
         if stderr:
-           print(f'Error restoring snapshot: {stderr}')
+           print(f'{self.prefix}Error restoring snapshot: {stderr}')
            logging.debug(f'Error restoring snapshot: {snapshot_id}.')
            return False
-        print(f'Restored snapshot {snapshot_id} from: {self.backup_type} to {restore_path}\n{stdout}')
+        if overlays and not self.restore_overlays(overlays, restore_path, options):
+            return False
+        # The whole snapshot is there now, an interrupted partial restore to the same target has nothing left to resume
+        for state_file in glob.glob(self.restore_state_file(snapshot_id, restore_path, '*')):
+            os.remove(state_file)
+        print(f'{self.prefix}Restored snapshot {snapshot_id} from: {self.backup_type} to {restore_path}\n{stdout}')
         logging.info(f'Restored snapshot {snapshot_id} from: {self.backup_type} to {restore_path}')
+        return True
+
+    def restore_overlays(self, overlays, restore_path, options=None):
+        '''
+        Restores the partial snapshots of change-limited backups taken after the snapshot just restored on top of it, oldest
+        first, so the target also gets the files they added or changed. Files deleted since then are left in place.
+        '''
+        for overlay in overlays:
+            cmd = self.type_selector('restore', options, overlay, restore_path)
+            stdout, stderr = self.run_command(cmd)
+            if self.returncode != 0:
+                print(f'{self.prefix}Error restoring partial snapshot {overlay} (exit code {self.returncode}): {stderr.strip()}')
+                logging.warning(f'Restoring partial snapshot {overlay} to {restore_path} failed with exit code {self.returncode}: {stderr.strip()}')
+                return False
+            print(f'{self.prefix}Restored the changes of partial snapshot {overlay} on top.')
+        return True
+
+    def restore_state_file(self, snapshot_id, restore_path, excludes_key):
+        '''
+        Where restore_partial keeps the include patterns already restored, in logs/ and not in the target.
+        '''
+        key = hashlib.sha1(f'{self.backup_type}:{self.repo_path}:{snapshot_id}:{os.path.abspath(restore_path)}'.encode()).hexdigest()[:16]
+        return f'{self.script_path}/logs/restores/{key}-{excludes_key}.json'
+
+    def restore_partial(self, snapshot_id, restore_path, includes=None, excludes=None, workers=4, overlays=None):
+        '''
+        Restores only the paths matching includes, split over several restic restore processes running at once.
+        The patterns left to restore are spread over the workers; every finished include pattern is written to a state file
+        (per repo, snapshot, target and excludes), so running the same restore again after an interruption only restores
+        what is left, with any number of workers. overlays are restored on top with the same patterns, see restore_overlays.
+        Prints the restored bytes per second at the end.
+        '''
+        if not snapshot_id or not restore_path:
+            logging.warning(f'snapshot ID or restore path missing.')
+            print(f'{self.prefix}snapshot ID or restore path missing.')
+            sys.exit() 
+        includes = includes or []
+        excludes = excludes or []
+        os.makedirs(restore_path, exist_ok=True)
+        state_file = self.restore_state_file(snapshot_id, restore_path, hashlib.sha1('\n'.join(excludes).encode()).hexdigest()[:8])
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        done = []
+        if os.path.exists(state_file):
+            with open(state_file) as state:
+                done = json.load(state)['done']
+            print(f'{self.prefix}Resuming restore of {snapshot_id}, {len(done)} of {len(includes) or 1} include patterns already restored.')
+        if includes:
+            pending = [pattern for pattern in includes if pattern not in done]
+            units = [pending[i::workers] for i in range(min(workers, len(pending)))]
+        else:
+            # Without includes the whole snapshot (minus excludes) is one unit, recorded as ''
+            units = [] if '' in done else [[]]
+        state_lock = threading.Lock()
+        restored_bytes = []
+        exclude_args = [arg for pattern in excludes for arg in ['--exclude', pattern]]
+
+        def restore_unit(index, patterns):
+            options = [arg for pattern in patterns for arg in ['--include', pattern]] + exclude_args
+            worker = copy.copy(self)
+            worker.prefix = f'{self.prefix}[part {index + 1}/{len(units)}] '
+            tracker = ProgressTracker(worker.prefix) if self.json_status else None
+            if tracker:
+                options.append('--json')
+            cmd = worker.type_selector('restore', options, snapshot_id, restore_path)
+            stdout, stderr = worker.run_command(cmd, tracker)
+            # With --json restic's errors are events, not stderr, the exit code is what tells a failed part
+            if worker.returncode != 0:
+                error = tracker.error_text(stderr) if tracker else stderr.strip()
+                print(f'{worker.prefix}Error restoring snapshot (exit code {worker.returncode}): {error}')
+                logging.warning(f'Restoring {patterns} from snapshot {snapshot_id} failed with exit code {worker.returncode}: {error}')
+                with state_lock:
+                    # The workers are copies, the task's own exit code is what Runner.run_task records
+                    self.returncode = worker.returncode
+                return False
+            with state_lock:
+                done.extend(patterns or [''])
+                if tracker and tracker.summary:
+                    restored_bytes.append(tracker.summary.get('bytes_restored') or tracker.summary.get('total_bytes') or 0)
+                with open(state_file, 'w') as state:
+                    json.dump({'snapshot_id': snapshot_id, 'restore_path': os.path.abspath(restore_path), 'done': done}, state)
+            return True
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(restore_unit, range(len(units)), units))
+        elapsed = time.monotonic() - start
+        if not all(results):
+            print(f'{self.prefix}Restore of {snapshot_id} incomplete, run it again to resume.')
+            logging.warning(f'Partial restore of {snapshot_id} to {restore_path} incomplete: {results.count(False)} parts failed.')
+            return False
+        if overlays and not self.restore_overlays(overlays, restore_path, [arg for pattern in includes for arg in ['--include', pattern]] + exclude_args):
+            print(f'{self.prefix}Restore of {snapshot_id} incomplete, run it again to resume.')
+            return False
+        os.remove(state_file)
+        total = sum(restored_bytes) if restored_bytes else directory_size(restore_path)
+        rate = total / elapsed / 1024 / 1024 if elapsed else 0
+        print(f'{self.prefix}Restored {len(includes) or "all"} paths of snapshot {snapshot_id} from: {self.backup_type} to {restore_path}, {total / 1024 / 1024:.1f} MiB in {elapsed:.1f}s ({rate:.1f} MiB/s)')
+        logging.info(f'Restored {includes} of snapshot {snapshot_id} from: {self.backup_type} to {restore_path} in {elapsed:.1f}s with {workers} workers.')
+        return {'bytes_restored': total, 'total_duration': elapsed, 'bytes_per_second': total / elapsed if elapsed else None}
 
     def mount(self, restore_path, snapshot_id=None, options=None):
         '''
@@ -158,50 +697,55 @@ class ResticBackup:
 
         if not restore_path:
             logging.warning(f'Restore path missing.')
-            print(f'Restore path missing.')
+            print(f'{self.prefix}Restore path missing.')
             sys.exit() 
         job = 'mount'
-        unmount_command = f'umount {restore_path}'
-        run_umount = subprocess.Popen(unmount_command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, encoding='utf-8')
+        unmount_command = ['umount', restore_path]
+        run_umount = subprocess.Popen(unmount_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, encoding='utf-8')
         cmd = self.type_selector(job, options, snapshot_id, restore_path)
         stdout, stderr = self.run_command(cmd)
         if stderr:
-           print(f'Error mounting snapshot: {stderr}')
+           print(f'{self.prefix}Error mounting snapshot: {stderr}')
            logging.debug(f'Error mounting snapshot from: {self.backup_type}.')
            return False
-        print(f'Mounted snapshots from: {self.backup_type} to {restore_path}')
+        print(f'{self.prefix}Mounted snapshots from: {self.backup_type} to {restore_path}')
         logging.info(f'Mounted snapshots from: {self.backup_type} to {restore_path}')
+        return True
 
     def other(self, command):
         job = ['other', command]
         cmd = self.type_selector(job)
         stdout, stderr = self.run_command(cmd)
         if stderr:
-            print(f'Ran {command} at  {stderr}')
+            print(f'{self.prefix}Ran {command} at  {stderr}')
             logging.debug(f'Ran {command} at {self.backup_type}:{self.repo_path}.')
             return False
-        print(f'Ran {command} at {self.backup_type}:{self.repo_path}. {stdout}')
+        print(f'{self.prefix}Ran {command} at {self.backup_type}:{self.repo_path}. {stdout}')
         logging.info(f'Ran {command} at {self.backup_type}:{self.repo_path}.')
+        return True
 
-    def option_parser(self):
+    def option_parser(self, read_concurrency=None):
+        '''
+        Backup options from the config file. read-concurrency is the number of files restic reads at once, a shaping
+        profile's read_concurrency replaces it.
+        '''
         options_dict = self.options
         options = []
         if options_dict:
             if options_dict['no-scan'] == True:
                 options.append('--no-scan')
-            if options_dict['read-concurrency'] == True:
-                options.append('--read-concurrency')
+            read_concurrency = read_concurrency or options_dict['read-concurrency']
+            if read_concurrency:
+                options += ['--read-concurrency', str(read_concurrency)]
+            if options_dict.get('json') == True:
+                options.append('--json')
             if options_dict['compression']:
                 compression = f"--compression={options_dict['compression']}"
                 options.append(compression)
-            try:
-                if options_dict['tags']:
-                    for tag in options_dict['tags'].split(','):
-                        tagger = f'--tag {tag}'
-                        options.append(tagger)
-            except KeyError:
-                ...
-        return ' '.join(options)
+            if options_dict.get('tags'):
+                for tag in options_dict['tags'].split(','):
+                    options += ['--tag', tag]
+        return options
 
     def s3_env_set(self):
         '''
@@ -220,16 +764,59 @@ class ResticBackup:
 
     def set_exclude(self):
         '''
-        The exclude file is created on each run based on the exclude param on the config file.
-        Words needs to be separated by comma, no space. If nothing is provided then an empty file is created.
-        '''
-        exclude_file = f'{self.script_path}/config/excludes.txt'
-        logging.info(f'Excluding terms: {self.exclude}. Creating exclude.txt for {self.backup_type}.')
-        with open(exclude_file, 'w') as my_file:
-            if self.exclude is not None: 
-                for item in self.exclude.split(','):
-                    my_file.write(f'{item}\n')
-            else:
-                with open(exclude_file, 'w'):
-                    pass
+        The exclude file is created from the exclude param on the config file.
+        Words needs to be separated by comma, no space. If nothing is provided then an empty file is used.
+        The file is named after a hash of its content and only written when it doesn't exist yet, so repos running in parallel
+        never rewrite a file another one is reading, and unchanged excludes aren't written again on every backup.
+        '''
+        if self.exclude_file:
+            return self.exclude_file
+        content = ''.join(f'{item}\n' for item in self.exclude.split(',')) if self.exclude is not None else ''
+        digest = hashlib.sha1(content.encode()).hexdigest()[:16]
+        exclude_file = f'{self.script_path}/config/excludes/{digest}.txt'
+        if not os.path.exists(exclude_file):
+            os.makedirs(os.path.dirname(exclude_file), exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(exclude_file), suffix='.tmp', delete=False) as my_file:
+                my_file.write(content)
+            os.replace(my_file.name, exclude_file)
+            logging.info(f'Excluding terms: {self.exclude}. Created {exclude_file} for {self.backup_type}.')
+        self.exclude_file = exclude_file
         return exclude_file
+
+def go_duration(text):
+    '''
+    Seconds in a Go duration as restic prints them, e.g. 3h2m1.5s or 350ms.
+    '''
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001, 'us': 1e-6, 'µs': 1e-6, 'ns': 1e-9}
+    return sum(float(value) * units[unit] for value, unit in re.findall(r'([\d.]+)(h|ms|us|µs|ns|m|s)', text))
+
+def stale_lock(stderr, stale_minutes=30):
+    '''
+    Reads restic's "repository is already locked" error. Returns why the lock is stale, None when it isn't one or looks
+    alive: restic refreshes the locks of running processes every 5 minutes, so a lock older than stale_minutes belongs to
+    a process that is gone, and so does a lock of this host whose PID doesn't exist anymore.
+    '''
+    match = lock_error.search(stderr or '')
+    if not match:
+        return None
+    pid, host, age = int(match[1]), match[2], match[3]
+    if host == socket.gethostname():
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return f'PID {pid} on {host} is not running'
+        except PermissionError:
+            pass
+    if go_duration(age) > stale_minutes * 60:
+        return f'created {age} ago by PID {pid} on {host}'
+    return None
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.lstat(os.path.join(root, file_name)).st_size
+            except OSError:
+                pass
+    return total
@@ -1,66 +1,186 @@
-import requests
-import subprocess
 import socket
+import sys
 import time
 import logging
+import threading
+import uuid
 import os
-from misc import setup_logging, import_configuration
+from transport import Transport
+
+sys.path.insert(0, os.path.abspath(f'{os.path.dirname(__file__)}/..'))
+# From the assets package like the Runner, so both bind log IDs in the same context
+from assets.misc import setup_logging, import_configuration, bind_log
+from assets.runner import Runner
+from assets.config import load_config, ConfigError
 
 logger = logging.getLogger(__name__)
 
-def run_once(server_url, client_id, restic_cmd):
+def heartbeat(transport, client_id, interval, stop):
+    '''
+    Keeps the backup slot leased from the server while the backup runs.
+    '''
+    while not stop.wait(interval):
+        try:
+            transport.post("/heartbeat", {"id": client_id}, retries=0)
+        except Exception as e:
+            logger.info(f"[{client_id}] Heartbeat failed: {e}")
+
+def run_once(transport, client_id, runner, repository="default"):
+    '''
+    Returns the seconds to wait when the server has no backup slot free, None otherwise.
+    '''
     try:
-        logger.info(f'Registering {client_id} at {server_url}...')
-        check = requests.post(f"{server_url}/register", json={"id": client_id}, timeout=10)
-        check.raise_for_status()
-        action = check.json().get("action", "ok")
+        logger.info(f'Registering {client_id} at {transport.server_url}...')
+        response = transport.post("/register", {"id": client_id, "repository": repository})
+        action = response.get("action", "ok")
     except Exception as e:
         logger.info(f"[{client_id}] Error registering: {e}")
         return
 
+    if action == "wait":
+        wait_seconds = response.get("wait_seconds", 60)
+        logger.info(f"[{client_id}] Backup is due, server asked to wait {wait_seconds}s for a slot.")
+        return wait_seconds
     if action == "backup":
-        logger.info(f"[{client_id}] Running backup...")
-        try:
-            subprocess.run(restic_cmd, check=True)
-            success = True
-        except subprocess.CalledProcessError as e:
-            logger.info(f"[{client_id}] Backup failed: {e}")
-            success = False
-
-        try:
-            requests.post(f"{server_url}/report", json={"id": client_id, "success": success}, timeout=10)
-            logger.info(f'Sent report to server with status: {success}.')
-        except Exception as e:
-            logger.info(f"[{client_id}] Failed to report result: {e}")
+        run_backup(transport, client_id, runner, response.get("lease_seconds"), response.get("profile"))
     else:
         print(f"[{client_id}] No backup needed.")
 
+def run_error(results):
+    '''
+    Error text for a report, kept in the server's run history.
+    '''
+    failed = [f"{row['repo']} ({row['status']}, exit code {row['exit_code']})" for row in results if row['status'] in ['failed', 'partial']]
+    return f"failed: {', '.join(failed)}" if failed else None
+
+def backup_report(client_id, results, duration, error=None):
+    '''
+    Builds the /report payload from the per-repo rows returned by Runner.run_all.
+    '''
+    added = [row['data_added'] for row in results if row['data_added'] is not None]
+    return {
+        "id": client_id,
+        "success": bool(results) and all(row['status'] in ['ok', 'skipped'] for row in results),
+        "duration": duration,
+        "bytes_added": sum(added) if added else None,
+        "results": [{key: row[key] for key in ['repo', 'type', 'status', 'exit_code', 'duration', 'lock_wait', 'summary']} for row in results],
+        "error": error or run_error(results),
+    }
+
+def run_backup(transport, client_id, runner, lease_seconds=None, profile=None):
+    bind_log(run=uuid.uuid4().hex[:12])
+    logger.info(f"[{client_id}] Running backup...")
+    stop = threading.Event()
+    if lease_seconds:
+        threading.Thread(target=heartbeat, args=(transport, client_id, lease_seconds / 3, stop), daemon=True).start()
+    start = time.monotonic()
+    error = None
+    try:
+        results = runner.run_all("backup", profile=profile)
+    except Exception as e:
+        logger.info(f"[{client_id}] Backup failed: {e}")
+        results = []
+        error = str(e)
+    finally:
+        stop.set()
+    report = backup_report(client_id, results, time.monotonic() - start, error)
+    if not report["success"]:
+        logger.info(f"[{client_id}] Backup failed or incomplete for: {[row['repo'] for row in results if row['status'] in ['failed', 'partial']]}")
+
+    if transport.report("/report", report):
+        logger.info(f'Sent report to server with status: {report["success"]}.')
 
-def run_forget(server_url, client_id, forget_cmd):
+
+def run_forget(transport, client_id, runner, repository="default"):
     logger.info(f'Checking forget for {client_id}...')
     try:
-        check = requests.post(f"{server_url}/forget", json={"id": client_id}, timeout=10)
-        check.raise_for_status()
-        action = check.json().get("action", "ok")
+        response = transport.post("/forget", {"id": client_id, "repository": repository})
+        action = response.get("action", "ok")
     except Exception as e:
         logger.info(f"[{client_id}] Error checking forget: {e}")
         return
 
     if action == "forget":
-        logger.info(f"[{client_id}] Running restic forget...")
-        try:
-            subprocess.run(forget_cmd, check=True)
-            success = True
-        except subprocess.CalledProcessError as e:
-            logger.info(f"[{client_id}] Forget failed: {e}")
-            success = False
+        run_forget_job(transport, client_id, runner, response.get("profile"))
 
+def run_forget_job(transport, client_id, runner, profile=None):
+    '''
+    Runs the maintenance chain (forget, prune and check as set per repo under maintenance in config.yml).
+    Repos skipped because they are outside their own maintenance window don't fail the run, but if every repo was skipped
+    the run isn't reported as done so the server asks again.
+    '''
+    bind_log(run=uuid.uuid4().hex[:12])
+    logger.info(f"[{client_id}] Running restic maintenance...")
+    start = time.monotonic()
+    error = None
+    try:
+        results = runner.run_all("maintenance", profile=profile)
+    except Exception as e:
+        logger.info(f"[{client_id}] Forget failed: {e}")
+        results = []
+        error = str(e)
+    success = any(row['status'] == 'ok' for row in results) and all(row['status'] != 'failed' for row in results)
+    report = {"id": client_id, "success": success, "duration": time.monotonic() - start, "error": error or run_error(results)}
+
+    if transport.report("/forget/report", report):
+        logger.info(f'Sent report to server with status: {success}.')
+
+def run_adhoc_job(transport, client_id, job, runner):
+    '''
+    check and other jobs run as `restic <command>` on every repo, check is `restic check`.
+    '''
+    command = "check" if job["action"] == "check" else job.get("command")
+    bind_log(run=job["job_id"])
+    logger.info(f"[{client_id}] Running job {job['job_id']}: {command}...")
+    results = []
+    start = time.monotonic()
+    error = None if command else "no command given"
+    if command:
         try:
-            requests.post(f"{server_url}/forget/report", json={"id": client_id, "success": success}, timeout=10)
-            logger.info(f'Sent report to server with status: {success}.')
+            results = runner.run_all("other", command=command)
         except Exception as e:
-            logger.info(f"[{client_id}] Failed to report forget result: {e}")
+            logger.info(f"[{client_id}] Job {job['job_id']} failed: {e}")
+            error = str(e)
+    success = bool(results) and all(row['status'] == 'ok' for row in results)
+    report = {"id": client_id, "job_id": job["job_id"], "action": job["action"], "success": success, "duration": time.monotonic() - start, "error": error or run_error(results)}
+
+    transport.report("/jobs/report", report)
 
+def poll(transport, client_id, repository, timeout):
+    '''
+    Long-polls the server for the next job. Raises when the server can't be reached so the caller can fall back to interval polling.
+    '''
+    return transport.post("/poll", {"id": client_id, "repository": repository, "timeout": timeout}, timeout=timeout + 15)
+
+def run_job(transport, client_id, job, runner):
+    '''
+    Returns the seconds to wait before polling again.
+    '''
+    action = job.get("action", "ok")
+    if action == "backup":
+        run_backup(transport, client_id, runner, job.get("lease_seconds"), job.get("profile"))
+    elif action == "forget":
+        run_forget_job(transport, client_id, runner, job.get("profile"))
+    elif action in ["check", "other"]:
+        run_adhoc_job(transport, client_id, job, runner)
+    elif action == "wait":
+        logger.info(f"[{client_id}] Backup is due, server asked to wait {job.get('wait_seconds')}s for a slot.")
+        return job.get("wait_seconds", 60)
+    return 0
+
+def poll_interval(transport, client_id, repository, runner, check_interval):
+    '''
+    Interval polling, used when long-polling isn't available.
+    '''
+    transport.flush_outbox()
+    started = time.monotonic()
+    wait_seconds = run_once(transport, client_id, runner, repository)
+    while wait_seconds and time.monotonic() - started + wait_seconds < check_interval:
+        time.sleep(wait_seconds)
+        wait_seconds = run_once(transport, client_id, runner, repository)
+    time.sleep(60)
+    run_forget(transport, client_id, runner, repository)
+    time.sleep(check_interval)
 
 def main():
     script_path=os.path.abspath(os.path.dirname(__file__))
@@ -68,19 +188,32 @@ def main():
     setup_logging(loaded_config, script_path)
 
 
-    server_url = loaded_config['server_url']
-    python_interp = loaded_config['python_interp']
-    restic_cli_path = f'{script_path}/../restic.py'
-    restic_cmd = [python_interp, restic_cli_path, "backup"]
-    forget_cmd = [python_interp, restic_cli_path, "forget"]
+    transport = Transport(loaded_config['server_url'], f'{script_path}/../logs/outbox', **(loaded_config.get('transport') or {}))
+    config_location = f'{script_path}/../config/config.yml'
+    runner = Runner(load_config(config_location), os.path.abspath(f'{script_path}/..'))
 
     check_interval = loaded_config['check_interval'] * 60 * 60  # 6 hours in seconds
+    poll_timeout = loaded_config.get('poll_timeout', 60)
     client_id = loaded_config['client_id'] if loaded_config.get('client_id') else socket.gethostname()
+    bind_log(client=client_id)
+    repository = loaded_config.get('repository', 'default')
     while True:
-        run_once(server_url, client_id, restic_cmd)
-        time.sleep(60)
-        run_forget(server_url, client_id, forget_cmd)
-        time.sleep(check_interval)
+        try:
+            runner.reload(load_config(config_location))
+        except (ConfigError, OSError) as e:
+            logger.warning(f"[{client_id}] Keeping the previous config, {config_location} can't be used: {e}")
+        try:
+            # A report that can't be delivered yet stays queued, a server that is down fails the poll below
+            if not transport.flush_outbox():
+                logger.info(f"[{client_id}] Queued reports could not be delivered yet, kept in the outbox.")
+            job = poll(transport, client_id, repository, poll_timeout)
+        except Exception as e:
+            logger.info(f"[{client_id}] Long-poll unavailable ({e}), falling back to polling every {loaded_config['check_interval']}h.")
+            poll_interval(transport, client_id, repository, runner, check_interval)
+            continue
+        wait_seconds = run_job(transport, client_id, job, runner)
+        if wait_seconds:
+            time.sleep(wait_seconds)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,171 @@
+import os
+import re
+import threading
+import yaml
+
+backends = ['local', 'sftp', 's3']
+profile_keys = ['limit_upload', 'limit_download', 'read_concurrency', 'pack_size', 'connections', 'nice', 'ionice_class', 'ionice_level']
+option_defaults = {'no-scan': False, 'read-concurrency': False, 'compression': None, 'json': False}
+cache = {}
+cache_lock = threading.Lock()
+
+class ConfigError(ValueError):
+
+    '''
+    Raised with every problem found in config.yml, one per line, instead of a KeyError halfway through a run.
+    '''
+
+def load_config(config_location):
+    '''
+    Reads and validates config/config.yml. The result is cached until the file's mtime or size changes, so the long running
+    client can call it before every job and only parses the file again after it was edited. FileNotFoundError is left to the caller.
+    '''
+    stat = os.stat(config_location)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with cache_lock:
+        cached = cache.get(config_location)
+    if cached and cached[0] == key:
+        return cached[1]
+    with open(config_location) as config_file:
+        config = yaml.safe_load(config_file)
+    validate_config(config, config_location)
+    with cache_lock:
+        cache[config_location] = (key, config)
+    return config
+
+def validate_config(config, config_location='config.yml'):
+    '''
+    Checks the whole file and raises ConfigError listing everything that is wrong. Missing backup options are filled in
+    with their defaults so the rest of the code can index them.
+    '''
+    if not isinstance(config, dict):
+        raise ConfigError(f'{config_location} is not valid: expected a mapping with restic_path and servers.')
+    errors = []
+    if not isinstance(config.get('restic_path'), str):
+        errors.append('restic_path: missing, it should be the path to the restic binary')
+    servers = config.get('servers')
+    if not isinstance(servers, dict) or not servers:
+        errors.append('servers: missing or empty')
+        servers = {}
+    profiles = config.get('profiles') or {}
+    if not isinstance(profiles, dict):
+        errors.append('profiles: should be a mapping of profile names to settings')
+        profiles = {}
+    for name, profile in profiles.items():
+        errors += [f'profiles.{name}.{error}' for error in profile_errors(profile)]
+    for name, repo in servers.items():
+        if repo:
+            errors += [f'servers.{name}.{error}' for error in repo_errors(name, repo, servers)]
+        if isinstance(repo, dict):
+            errors += [f'servers.{name}.{error}' for error in shaping_errors(repo, profiles)]
+    concurrency = config.get('concurrency') or {}
+    if not isinstance(concurrency, dict):
+        errors.append('concurrency: should be a mapping')
+    else:
+        for key in ['workers', 'per_host', 'copy_workers']:
+            if key in concurrency and not is_int(concurrency[key]):
+                errors.append(f'concurrency.{key}: should be a number, got {concurrency[key]!r}')
+    errors += lock_errors(config.get('locks'))
+    if 'snapshot_cache_ttl' in config and not is_int(config['snapshot_cache_ttl']):
+        errors.append(f'snapshot_cache_ttl: should be a number of seconds, got {config["snapshot_cache_ttl"]!r}')
+    if errors:
+        raise ConfigError(f'{config_location} is not valid:\n' + '\n'.join(f'  {error}' for error in errors))
+    return config
+
+def repo_errors(name, repo, servers):
+    if not isinstance(repo, dict):
+        return ['should be a mapping']
+    errors = []
+    for key, expected in [('enabled', bool), ('type', str), ('repo_path', str), ('password_file', str), ('forget_options', dict)]:
+        if key not in repo:
+            errors.append(f'{key}: missing')
+        elif not isinstance(repo[key], expected):
+            errors.append(f'{key}: should be {expected.__name__}, got {repo[key]!r}')
+    if repo.get('type') not in backends:
+        errors.append(f'type: should be one of {backends}, got {repo.get("type")!r}')
+    if repo.get('type') == 'sftp' and not repo.get('host'):
+        errors.append('host: missing, sftp repos need user@host')
+    if not repo.get('backup_path') and not repo.get('source') and not repo.get('copy_from'):
+        errors.append('backup_path: missing, needed unless source or copy_from is set')
+    for key in ['backup_path', 'exclude', 'copy_from']:
+        if repo.get(key) is not None and not isinstance(repo[key], str):
+            errors.append(f'{key}: should be str, got {repo[key]!r}')
+    forget_options = repo.get('forget_options')
+    if isinstance(forget_options, dict):
+        for key in ['daily', 'weekly', 'monthly']:
+            if not is_int(forget_options.get(key)):
+                errors.append(f'forget_options.{key}: should be a number, got {forget_options.get(key)!r}')
+    options = repo.get('options') or {}
+    if not isinstance(options, dict):
+        errors.append('options: should be a mapping')
+    else:
+        repo['options'] = dict(option_defaults, **options)
+        if repo['options']['read-concurrency'] not in [False, None] and not is_int(repo['options']['read-concurrency']):
+            errors.append(f'options.read-concurrency: should be false or the number of files read at once, got {repo["options"]["read-concurrency"]!r}')
+        if repo.get('type') == 's3' and not options.get('.env-file'):
+            errors.append('options..env-file: missing, s3 repos read their credentials from it')
+    for key in ['source', 'change_detection', 'maintenance']:
+        if repo.get(key) is not None and not isinstance(repo[key], dict):
+            errors.append(f'{key}: should be a mapping')
+    if isinstance(repo.get('source'), dict) and not repo['source'].get('command'):
+        errors.append('source.command: missing')
+    change_detection = repo.get('change_detection') if isinstance(repo.get('change_detection'), dict) else {}
+    if change_detection.get('files_from') and not is_int(change_detection.get('max_skip_hours')):
+        errors.append('change_detection.max_skip_hours: needed with files_from, so the whole backup_path is backed up on a schedule')
+    window = (repo.get('maintenance') or {}).get('window') if isinstance(repo.get('maintenance'), dict) else None
+    if window and not re.fullmatch(r'\d\d:\d\d-\d\d:\d\d', str(window)):
+        errors.append(f'maintenance.window: should look like "01:00-05:00", got {window!r}')
+    if repo.get('copy_from') is not None and (repo['copy_from'] == name or not servers.get(repo['copy_from'])):
+        errors.append(f'copy_from: {repo["copy_from"]!r} is not another repo in servers')
+    elif repo.get('copy_from') is not None and isinstance(servers[repo['copy_from']], dict) and servers[repo['copy_from']].get('copy_from'):
+        # Copies all run after the backups, in no set order, so a replica of a replica could copy before its source is filled
+        errors.append(f'copy_from: {repo["copy_from"]!r} is a replica itself, copy from the repo it copies from instead')
+    if repo.get('limit_upload') is not None and not is_int(repo['limit_upload']):
+        errors.append(f'limit_upload: should be KiB/s as a number, got {repo["limit_upload"]!r}')
+    return errors
+
+def profile_errors(profile, allowed=profile_keys):
+    if not isinstance(profile, dict):
+        return ['should be a mapping']
+    errors = [f'{key}: unknown setting, use one of {profile_keys}' for key in profile if key not in allowed]
+    for key in profile_keys:
+        if profile.get(key) is not None and not is_int(profile[key]):
+            errors.append(f'{key}: should be a number, got {profile[key]!r}')
+    return errors
+
+def shaping_errors(repo, profiles):
+    '''
+    shaping is a list of {window, profile, settings...} entries, the first one whose window contains now is used.
+    '''
+    shaping = repo.get('shaping')
+    if shaping is None:
+        return []
+    if not isinstance(shaping, list):
+        return ['shaping: should be a list of windows']
+    errors = []
+    for index, entry in enumerate(shaping):
+        errors += [f'shaping[{index}].{error}' for error in profile_errors(entry, profile_keys + ['window', 'profile'])]
+        if not isinstance(entry, dict):
+            continue
+        if entry.get('window') and not re.fullmatch(r'\d\d:\d\d-\d\d:\d\d', str(entry['window'])):
+            errors.append(f'shaping[{index}].window: should look like "08:00-18:00", got {entry["window"]!r}')
+        if entry.get('profile') is not None and entry['profile'] not in profiles:
+            errors.append(f'shaping[{index}].profile: {entry["profile"]!r} is not in profiles')
+    return errors
+
+def lock_errors(locks):
+    if locks is None:
+        return []
+    if not isinstance(locks, dict):
+        return ['locks: should be a mapping']
+    errors = []
+    for key, expected in [('server_url', str), ('retry_lock', str)]:
+        if locks.get(key) is not None and not isinstance(locks[key], expected):
+            errors.append(f'locks.{key}: should be {expected.__name__}, got {locks[key]!r}')
+    for key in ['wait_timeout', 'stale_minutes']:
+        if locks.get(key) is not None and not is_int(locks[key]):
+            errors.append(f'locks.{key}: should be a number, got {locks[key]!r}')
+    return errors
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
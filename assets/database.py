@@ -0,0 +1,179 @@
+import asyncio
+import contextvars
+import functools
+import re
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# SQLite column types and hints in the migrations and queries, and what PostgreSQL needs instead
+postgres_rewrites = [
+    (re.compile(r'\bINTEGER PRIMARY KEY( AUTOINCREMENT)?'), 'BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY'),
+    (re.compile(r'\bINTEGER\b'), 'BIGINT'),
+    (re.compile(r'\bREAL\b'), 'DOUBLE PRECISION'),
+    (re.compile(r'\bTIMESTAMP\b'), 'TEXT'),
+    (re.compile(r'\s+INDEXED BY \w+'), ''),
+    (re.compile(r'\?'), '%s'),
+]
+# Key of the advisory lock every PostgreSQL write transaction holds
+postgres_write_lock = 0x7265737469
+
+def open_database(location, busy_timeout=5000):
+    '''
+    server.db is the path of a SQLite file or a postgresql:// URL.
+    '''
+    if location.startswith(('postgresql://', 'postgres://')):
+        return PostgresDatabase(location, busy_timeout)
+    return Database(location, busy_timeout)
+
+class Database:
+
+    '''
+    Shared data-access layer for the server.
+    All queries run on one dedicated thread that owns a single long-lived connection, so the event loop never blocks on
+    SQLite and no request pays for opening a connection. The database runs in WAL mode so readers don't wait on the writer,
+    and sqlite3 keeps the compiled statements of the module-level SQL strings in its statement cache.
+    Several server processes (uvicorn --workers) can share the file: write transactions start with BEGIN IMMEDIATE, so the
+    write lock is held from the first statement and what a transaction counted (free slots, tokens) can't change under it.
+    '''
+    def __init__(self, db_file, busy_timeout=5000):
+        self.db_file = db_file
+        self.busy_timeout = busy_timeout
+        self.conn = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+        self.executor.submit(self.connect).result()
+
+    def connect(self):
+        # Transactions are started explicitly by begin()
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False, cached_statements=256, isolation_level=None)
+        self.conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        logger.info(f'Opened {self.db_file} in WAL mode.')
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def begin(self, cursor, write):
+        cursor.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+
+    def schema_version(self, cursor):
+        return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+    def set_schema_version(self, cursor, version):
+        cursor.execute(f"PRAGMA user_version = {int(version)}")
+
+    def transaction(self, fn, args, write=True):
+        '''
+        Runs fn(cursor, *args) on the database thread and commits, or rolls back if it raises.
+        '''
+        cursor = self.cursor()
+        try:
+            self.begin(cursor, write)
+            result = fn(cursor, *args)
+            self.conn.commit()
+            return result
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    async def run(self, fn, *args):
+        '''
+        Runs fn(cursor, *args) in a transaction on the database thread, in a copy of the caller's context so the IDs
+        bound for logging (misc.bind_log) are on what fn logs too.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(contextvars.copy_context().run, self.transaction, fn, args))
+
+    async def read(self, fn, *args):
+        '''
+        Same as run() for fn that only reads: a snapshot that doesn't take the write lock, so other workers' writes go on.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(contextvars.copy_context().run, self.transaction, fn, args, False))
+
+    def run_sync(self, fn, *args):
+        '''
+        Same as run() for code outside the event loop, e.g. startup.
+        '''
+        return self.executor.submit(self.transaction, fn, args).result()
+
+    def close(self):
+        self.executor.submit(self.conn.close).result()
+        self.executor.shutdown()
+
+class PostgresCursor:
+
+    '''
+    A psycopg cursor that takes the SQLite flavoured queries of the server, see postgres_sql.
+    '''
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, params=()):
+        self.cursor.execute(postgres_sql(query), params)
+        return self
+
+    def executemany(self, query, params):
+        self.cursor.executemany(postgres_sql(query), params)
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+@functools.lru_cache(maxsize=512)
+def postgres_sql(query):
+    for pattern, replacement in postgres_rewrites:
+        query = pattern.sub(replacement, query)
+    return query
+
+class PostgresDatabase(Database):
+
+    '''
+    The same interface on PostgreSQL (or a database speaking its protocol), for servers on several hosts sharing one state.
+    The queries stay written for SQLite and are rewritten on the way (placeholders, INDEXED BY hints, column types).
+    Every write transaction takes the same advisory lock first, so writes are serialized across all workers and nodes
+    like on SQLite and the scheduler's count-then-insert stays atomic, reads are REPEATABLE READ snapshots.
+    Needs psycopg 3, which is only imported when server.db is a postgresql:// URL.
+    '''
+    def connect(self):
+        try:
+            import psycopg
+        except ImportError:
+            raise RuntimeError('server.db is a PostgreSQL URL but psycopg is not installed: pip install "psycopg[binary]"')
+        self.conn = psycopg.connect(self.db_file, autocommit=True)
+        self.conn.execute(f"SET lock_timeout = {int(self.busy_timeout)}")
+        logger.info(f'Opened PostgreSQL database {self.conn.info.dbname} on {self.conn.info.host}.')
+
+    def cursor(self):
+        return PostgresCursor(self.conn.cursor())
+
+    def begin(self, cursor, write):
+        if write:
+            cursor.execute("BEGIN")
+            cursor.execute("SELECT pg_advisory_xact_lock(?)", (postgres_write_lock,))
+        else:
+            cursor.execute("BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY")
+
+    def schema_version(self, cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+        row = cursor.execute("SELECT version FROM schema_version").fetchone()
+        return row[0] if row else 0
+
+    def set_schema_version(self, cursor, version):
+        cursor.execute("DELETE FROM schema_version")
+        cursor.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
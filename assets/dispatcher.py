@@ -0,0 +1,105 @@
+import asyncio
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+job_actions = ['backup', 'forget', 'check', 'other']
+
+# AUTOINCREMENT so a claimed (deleted) job's id is never handed out again, watch() relies on ids only growing
+CREATE_JOBS = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        client_id TEXT NOT NULL,
+        action TEXT NOT NULL,
+        command TEXT,
+        queued_at REAL NOT NULL
+    )
+"""
+CREATE_JOBS_INDEX = "CREATE INDEX IF NOT EXISTS jobs_client ON jobs (client_id, id)"
+INSERT_JOB = "INSERT INTO jobs (client_id, action, command, queued_at) VALUES (?, ?, ?, ?) RETURNING id"
+SELECT_QUEUED = "SELECT 1 FROM jobs WHERE client_id = ? LIMIT 1"
+CLAIM_JOB = "DELETE FROM jobs WHERE id = (SELECT MIN(id) FROM jobs WHERE client_id = ?) RETURNING id, action, command"
+SELECT_NEW_JOBS = "SELECT id, client_id FROM jobs WHERE id > ? ORDER BY id"
+SELECT_LAST_JOB = "SELECT COALESCE(MAX(id), 0) FROM jobs"
+
+class JobDispatcher:
+
+    '''
+    Queues ad-hoc jobs per client in the jobs table and wakes up the client's long-poll request when one arrives.
+    Jobs survive restarts and every server worker sees them: a job queued through the worker holding the client's poll
+    wakes it right away, one queued through another worker or node is found when this worker next looks for new jobs,
+    every check_seconds while it holds polls. Claiming a job deletes it, so it is handed out once.
+    Methods that take a cursor are meant to run inside a Database transaction.
+    '''
+    def __init__(self, check_seconds=1):
+        self.check_seconds = check_seconds
+        self.waiters = {}
+        self.last_id = 0
+        self.watcher = None
+
+    def latest(self, cursor):
+        '''
+        Call once at startup, jobs with a higher id are new to watch().
+        '''
+        self.last_id = cursor.execute(SELECT_LAST_JOB).fetchone()[0]
+
+    def enqueue(self, cursor, client_id, action, command=None):
+        job_id = cursor.execute(INSERT_JOB, (client_id, action, command, time.time())).fetchone()[0]
+        logger.info('Queued %s job %s for %s.', action, job_id, client_id)
+        return {"job_id": job_id, "action": action, "command": command}
+
+    def queued(self, cursor, client_id):
+        '''
+        Read-only check before claim(), so a poll without a job doesn't take the write lock.
+        '''
+        return cursor.execute(SELECT_QUEUED, (client_id,)).fetchone() is not None
+
+    def claim(self, cursor, client_id):
+        '''
+        Takes the client's oldest queued job off the table, None when there is none.
+        '''
+        row = cursor.execute(CLAIM_JOB, (client_id,)).fetchone()
+        return {"job_id": row[0], "action": row[1], "command": row[2]} if row else None
+
+    def new_jobs(self, cursor, last_id):
+        return cursor.execute(SELECT_NEW_JOBS, (last_id,)).fetchall()
+
+    def notify(self, client_id):
+        for event in self.waiters.get(client_id, ()):
+            event.set()
+
+    async def watch(self, db):
+        '''
+        Wakes the polls held here for jobs queued through other workers, runs while there are any.
+        '''
+        while self.waiters:
+            for job_id, client_id in await db.read(self.new_jobs, self.last_id):
+                self.last_id = max(self.last_id, job_id)
+                self.notify(client_id)
+            await asyncio.sleep(self.check_seconds)
+
+    async def wait(self, db, client_id, timeout):
+        '''
+        Returns the next job for client_id, or None if nothing arrived within timeout seconds.
+        '''
+        event = asyncio.Event()
+        self.waiters.setdefault(client_id, set()).add(event)
+        if self.watcher is None or self.watcher.done():
+            self.watcher = asyncio.create_task(self.watch(db))
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                event.clear()
+                if await db.read(self.queued, client_id):
+                    job = await db.run(self.claim, client_id)
+                    if job:
+                        return job
+                try:
+                    await asyncio.wait_for(event.wait(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    return None
+        finally:
+            self.waiters[client_id].discard(event)
+            if not self.waiters[client_id]:
+                del self.waiters[client_id]
@@ -0,0 +1,91 @@
+import statistics
+import logging
+
+logger = logging.getLogger(__name__)
+
+SELECT_HISTORY = """
+    SELECT finished_at, duration, bytes_added FROM runs
+    WHERE client_id = ? AND action = 'backup' AND status = 'ok' ORDER BY started_at DESC LIMIT ?
+"""
+SELECT_DUE_BUCKETS = "SELECT next_due / 3600, COUNT(*) FROM clients WHERE next_due BETWEEN ? AND ? AND id != ? GROUP BY 1"
+
+class AdaptiveIntervals:
+
+    '''
+    Picks a client's next backup interval from its recent successful backups (the runs table) after every report.
+    The change rate is the median of bytes_added per hour between consecutive backups, the interval is the time it takes
+    to change target_bytes, so busy clients are backed up more often and idle ones less. It never drops below the longest
+    recent backup divided by max_busy_fraction, so a slow client doesn't spend all its time backing up, it moves at most
+    by a factor of 2 per backup and stays within min_hours/max_hours.
+    The next start is then moved by up to slot_spread of the interval to the hour with the fewest clients due, which keeps
+    starts spread over the day instead of piling up at the hour clients were first installed.
+    All methods that take a cursor are meant to run inside a Database transaction.
+    '''
+    def __init__(self, enabled=False, min_hours=6, max_hours=72, target_bytes=1 << 30, max_busy_fraction=0.25, history=10, slot_spread=0.1):
+        self.enabled = enabled
+        self.min_hours = min_hours
+        self.max_hours = max_hours
+        self.target_bytes = target_bytes
+        self.max_busy_fraction = max_busy_fraction
+        self.history = history
+        self.slot_spread = slot_spread
+
+    @classmethod
+    def from_config(cls, adaptive_config):
+        return cls(**(adaptive_config or {}))
+
+    def interval(self, cursor, client_id, current):
+        '''
+        Returns (interval hours, reason).
+        '''
+        runs = cursor.execute(SELECT_HISTORY, (client_id, self.history)).fetchall()
+        rates = [
+            bytes_added / ((finished - previous) / 3600)
+            for (finished, _, bytes_added), (previous, _, _) in zip(runs, runs[1:])
+            if bytes_added is not None and finished > previous
+        ]
+        durations = [duration for _, duration, _ in runs if duration]
+        reasons = []
+        wanted = current
+        if rates:
+            rate = statistics.median(rates)
+            wanted = self.target_bytes / rate if rate > 0 else self.max_hours
+            reasons.append(f'{rate / (1 << 20):.1f} MiB/h changed (median of {len(rates)}), {self.target_bytes / (1 << 20):.0f} MiB per backup takes {wanted:.1f}h')
+        else:
+            reasons.append(f'no bytes_added over {len(runs)} backups yet, change rate unknown')
+        if durations:
+            floor = max(durations) / 3600 / self.max_busy_fraction
+            if wanted < floor:
+                wanted = floor
+                reasons.append(f'longest backup {max(durations) / 60:.0f}min needs at least {floor:.1f}h')
+        bounded = min(max(wanted, current / 2, self.min_hours), current * 2, self.max_hours)
+        interval = max(1, round(max(bounded, self.min_hours)))
+        if interval != round(wanted):
+            reasons.append(f'kept within {self.min_hours}-{self.max_hours}h and x2 of {current}h')
+        return interval, f'{"; ".join(reasons)} -> {interval}h'
+
+    def start_slot(self, cursor, client_id, due, interval):
+        '''
+        Returns (next_due, reason), due moved by whole hours to the least busy hour within slot_spread of the interval.
+        '''
+        spread = int(interval * self.slot_spread)
+        if spread < 1:
+            return due, None
+        counts = dict(cursor.execute(SELECT_DUE_BUCKETS, (due - spread * 3600, due + spread * 3600, client_id)).fetchall())
+        hour = due // 3600
+        shift = min(range(-spread, spread + 1), key=lambda offset: (counts.get(hour + offset, 0), abs(offset)))
+        if not shift:
+            return due, None
+        return due + shift * 3600, f'start moved {shift:+d}h to a less busy hour ({counts.get(hour + shift, 0)} vs {counts.get(hour, 0)} clients due)'
+
+    def schedule(self, cursor, client_id, current, last_backup):
+        '''
+        Returns (interval hours, next_due, reason) for a client whose backup finished at last_backup (epoch seconds).
+        '''
+        interval, reason = self.interval(cursor, client_id, current)
+        next_due, slot_reason = self.start_slot(cursor, client_id, last_backup + interval * 3600, interval)
+        if slot_reason:
+            reason = f'{reason}; {slot_reason}'
+        if interval != current:
+            logger.info(f'Backup interval of {client_id}: {current}h -> {interval}h ({reason}).')
+        return interval, next_due, reason
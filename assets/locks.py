@@ -0,0 +1,96 @@
+import fcntl
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+import logging
+
+class RepoLock:
+
+    '''
+    Host-local lock per repo, a flock on logs/locks/<repo key>.lock.
+    Backups take it shared and maintenance (forget/prune/check) takes it exclusive, so a prune never starts while a backup
+    of the same repo runs from restic.py, cron or the client, and vice versa. Waiting is a plain blocking flock, the
+    time spent waiting is kept in self.waited.
+    '''
+    def __init__(self, script_path, repo, shared=False):
+        key = hashlib.sha1(repo.encode()).hexdigest()[:16]
+        os.makedirs(f'{script_path}/logs/locks', exist_ok=True)
+        self.lock_file = f'{script_path}/logs/locks/{key}.lock'
+        self.repo = repo
+        self.shared = shared
+        self.waited = 0
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.lock_file, 'a')
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        start = time.monotonic()
+        try:
+            fcntl.flock(self.handle, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info(f'Waiting for the local lock on {self.repo}...')
+            fcntl.flock(self.handle, mode)
+        self.waited = time.monotonic() - start
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+        self.handle = None
+
+class LockLease:
+
+    '''
+    Repo lock lease from the server (locks.server_url in config.yml), taken after the local RepoLock so runs on other hosts
+    queue for the repo too. While the server answers wait the run sleeps and asks again, for up to wait_timeout seconds,
+    and once granted the lease is renewed on a thread until the run is over. When the server can't be reached the run
+    goes ahead with the local lock only. The time spent waiting is kept in self.waited and sent along with the release.
+    '''
+    def __init__(self, transport, repo, shared=False, wait_timeout=3600):
+        self.transport = transport
+        self.repo = repo
+        self.shared = shared
+        self.wait_timeout = wait_timeout
+        self.holder = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.waited = 0
+        self.granted = False
+        self.stop = threading.Event()
+
+    def __enter__(self):
+        start = time.monotonic()
+        while True:
+            try:
+                response = self.transport.post('/locks/acquire', {'repo': self.repo, 'holder': self.holder, 'shared': self.shared})
+            except Exception as e:
+                logging.warning(f'Lock server unavailable ({e}), {self.repo} only holds the local lock.')
+                break
+            if response.get('action') == 'granted':
+                self.granted = True
+                threading.Thread(target=self.renew, args=(response['lease_seconds'] / 3,), daemon=True).start()
+                break
+            waited = time.monotonic() - start
+            if waited >= self.wait_timeout:
+                raise TimeoutError(f'no lock on {self.repo} after waiting {waited:.0f}s, held or queued by {response.get("holders")}')
+            logging.info(f'Waiting for the lock on {self.repo}, held or queued by {response.get("holders")}...')
+            time.sleep(min(response.get('wait_seconds', 15), self.wait_timeout - waited))
+        self.waited = time.monotonic() - start
+        return self
+
+    def renew(self, interval):
+        while not self.stop.wait(interval):
+            try:
+                self.transport.post('/locks/renew', {'repo': self.repo, 'holder': self.holder}, retries=0)
+            except Exception as e:
+                logging.info(f'Renewing the lock on {self.repo} failed: {e}')
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        if not self.granted:
+            return
+        try:
+            self.transport.post('/locks/release', {'repo': self.repo, 'holder': self.holder, 'waited': self.waited})
+        except Exception as e:
+            logging.warning(f'Could not release the lock on {self.repo}, it expires on its own: {e}')
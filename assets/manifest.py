@@ -0,0 +1,92 @@
+import fnmatch
+import hashlib
+import json
+import os
+import time
+import logging
+
+class ChangeManifest:
+
+    '''
+    Per-directory fingerprint of a backup path, used to skip restic when nothing changed since the last backup.
+    Each directory is stored as one digest over the name, inode, size and mtime of its direct entries, so the manifest
+    stays small (one line per directory) while a changed, added or removed file still changes its directory's digest.
+    The scan is local stat calls only: no repo access and no restic lock.
+    '''
+    def __init__(self, manifest_file, exclude=None):
+        self.manifest_file = manifest_file
+        self.exclude = [pattern for pattern in (exclude or '').split(',') if pattern]
+        self.saved = None
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as manifest:
+                self.saved = json.load(manifest)
+
+    def excluded(self, path, name):
+        return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern) for pattern in self.exclude)
+
+    def scan(self, paths):
+        '''
+        Returns {directory: [digest, [files]]} for every directory under paths.
+        '''
+        dirs = {}
+        pending = list(paths)
+        while pending:
+            directory = pending.pop()
+            digest = hashlib.blake2b(digest_size=16)
+            files = []
+            try:
+                entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+            except OSError as e:
+                logging.debug(f'Cannot scan {directory}: {e}')
+                continue
+            for entry in entries:
+                if self.excluded(entry.path, entry.name):
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                digest.update(f'{entry.name}\0{stat.st_ino}\0{stat.st_size}\0{stat.st_mtime_ns}\0'.encode('utf-8', 'surrogateescape'))
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                else:
+                    files.append(entry.path)
+            dirs[directory] = [digest.hexdigest(), files]
+        return dirs
+
+    def changes(self, paths):
+        '''
+        Scans paths and returns (changed directories, scan). Everything counts as changed when there is no manifest yet.
+        '''
+        scan = self.scan(paths)
+        if self.saved is None or self.saved.get('paths') != list(paths):
+            return list(scan), scan
+        saved_dirs = self.saved['dirs']
+        changed = [directory for directory, (digest, _) in scan.items() if saved_dirs.get(directory) != digest]
+        changed += [directory for directory in saved_dirs if directory not in scan]
+        return changed, scan
+
+    def save(self, paths, scan, full=True):
+        '''
+        full is False after a backup of only the changed directories (--files-from), full_at then stays where it was.
+        '''
+        os.makedirs(os.path.dirname(self.manifest_file), exist_ok=True)
+        now = time.time()
+        full_at = now if full or not self.saved else self.saved.get('full_at', self.saved['saved_at'])
+        manifest = {'paths': list(paths), 'saved_at': now, 'full_at': full_at, 'dirs': {directory: digest for directory, (digest, _) in scan.items()}}
+        with open(f'{self.manifest_file}.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file, separators=(',', ':'))
+        os.replace(f'{self.manifest_file}.tmp', self.manifest_file)
+        self.saved = manifest
+
+    def age(self):
+        '''
+        Seconds since the manifest was saved, i.e. since the last backup that actually ran.
+        '''
+        return time.time() - self.saved['saved_at'] if self.saved else None
+
+    def full_age(self):
+        '''
+        Seconds since the last backup of the whole backup path.
+        '''
+        return time.time() - self.saved.get('full_at', self.saved['saved_at']) if self.saved else None
@@ -0,0 +1,114 @@
+import math
+import sqlite3
+from contextlib import closing
+import threading
+import time
+import logging
+
+class MetricsStore:
+
+    '''
+    Keeps a row per restic run in a local SQLite file (logs/metrics.db by default).
+    Each row has the wall time, exit code, backend type and, when the backup ran with json: true, the restic summary stats.
+    report() turns the rows into percentiles and a recent-vs-previous trend per repo, to spot throughput regressions after restic upgrades or option changes.
+    '''
+    summary_fields = ['files_new', 'files_changed', 'files_unmodified', 'total_files_processed', 'total_bytes_processed', 'data_added', 'total_duration', 'snapshot_id']
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        with self.lock, closing(sqlite3.connect(self.db_file)) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    repo TEXT NOT NULL,
+                    action TEXT NOT NULL,
+                    backend TEXT,
+                    started_at REAL NOT NULL,
+                    wall_time REAL,
+                    exit_code INTEGER,
+                    status TEXT,
+                    files_new INTEGER,
+                    files_changed INTEGER,
+                    files_unmodified INTEGER,
+                    total_files_processed INTEGER,
+                    total_bytes_processed INTEGER,
+                    data_added INTEGER,
+                    total_duration REAL,
+                    snapshot_id TEXT,
+                    lock_wait REAL
+                )
+            """)
+            if 'lock_wait' not in [column[1] for column in conn.execute("PRAGMA table_info(runs)")]:
+                conn.execute("ALTER TABLE runs ADD COLUMN lock_wait REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS runs_repo_action ON runs (repo, action, started_at)")
+
+    def record_run(self, repo, action, backend, started_at, wall_time, exit_code, status, summary=None, lock_wait=None):
+        '''
+        lock_wait is the time the run queued for the repo lock (local and server lease) before restic started.
+        '''
+        summary = summary or {}
+        values = [repo, action, backend, started_at, wall_time, exit_code, status, lock_wait] + [summary.get(field) for field in self.summary_fields]
+        columns = ['repo', 'action', 'backend', 'started_at', 'wall_time', 'exit_code', 'status', 'lock_wait'] + self.summary_fields
+        try:
+            with self.lock, closing(sqlite3.connect(self.db_file)) as conn, conn:
+                conn.execute(f"INSERT INTO runs ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", values)
+        except sqlite3.Error as e:
+            logging.warning(f'Could not record {action} run for {repo}: {e}')
+
+    def fetch_runs(self, repo=None, action='backup', days=30):
+        since = time.time() - days * 24 * 60 * 60
+        query = "SELECT repo, backend, started_at, wall_time, status, data_added, total_bytes_processed, total_duration, lock_wait FROM runs WHERE action = ? AND started_at >= ?"
+        params = [action, since]
+        if repo:
+            query += " AND repo = ?"
+            params.append(repo)
+        query += " ORDER BY repo, started_at"
+        with self.lock, closing(sqlite3.connect(self.db_file)) as conn, conn:
+            return conn.execute(query, params).fetchall()
+
+    def report(self, repo=None, action='backup', days=30, recent=5):
+        '''
+        Returns one dict per repo with run/failure counts, p50/p90/p99 of wall time, throughput and lock wait, the dedup
+        ratio and the throughput change of the last `recent` runs against the runs before them.
+        '''
+        by_repo = {}
+        for row in self.fetch_runs(repo, action, days):
+            by_repo.setdefault(row[0], []).append(row)
+
+        report = []
+        for name, rows in by_repo.items():
+            ok = [row for row in rows if row[4] == 'ok']
+            wall_times = [row[3] for row in ok if row[3] is not None]
+            throughput = [row[6] / row[7] for row in ok if row[6] and row[7]]
+            lock_waits = [row[8] for row in rows if row[8] is not None]
+            processed = sum(row[6] or 0 for row in ok)
+            added = sum(row[5] or 0 for row in ok)
+            older, newer = throughput[:-recent], throughput[-recent:]
+            trend = None
+            if older and newer:
+                trend = (percentile(newer, 50) - percentile(older, 50)) / percentile(older, 50) * 100
+            report.append({
+                'repo': name,
+                'backend': rows[-1][1],
+                'runs': len(rows),
+                'failed': len([row for row in rows if row[4] == 'failed']),
+                'skipped': len([row for row in rows if row[4] == 'skipped']),
+                'wall_time': {p: percentile(wall_times, p) for p in (50, 90, 99)},
+                'throughput': {p: percentile(throughput, p) for p in (50, 90, 99)},
+                'lock_wait': {p: percentile(lock_waits, p) for p in (50, 90, 99)},
+                'data_added': added,
+                'dedup_ratio': processed / added if added else None,
+                'trend': trend,
+            })
+        return report
+
+def percentile(values, p):
+    '''
+    Nearest-rank percentile, None for an empty list.
+    '''
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
@@ -0,0 +1,122 @@
+import logging
+from datetime import datetime, timezone
+from scheduler import CREATE_LEASES, CREATE_RATE_LIMITS
+from repo_leases import CREATE_REPO_LOCKS
+from dispatcher import CREATE_JOBS, CREATE_JOBS_INDEX
+from telemetry import CREATE_WORKER_METRICS
+
+logger = logging.getLogger(__name__)
+
+CREATE_CLIENTS = """
+    CREATE TABLE IF NOT EXISTS clients (
+        id TEXT PRIMARY KEY,
+        last_backup TIMESTAMP,
+        backup_interval_hours INTEGER DEFAULT 24,
+        last_forget TIMESTAMP
+    )
+"""
+CREATE_RUNS = """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        client_id TEXT NOT NULL,
+        action TEXT NOT NULL,
+        status TEXT NOT NULL,
+        started_at REAL NOT NULL,
+        finished_at REAL NOT NULL,
+        duration REAL,
+        bytes_added INTEGER,
+        error TEXT,
+        results TEXT
+    )
+"""
+CREATE_RUNS_INDEX = "CREATE INDEX IF NOT EXISTS runs_client_started ON runs (client_id, started_at)"
+CREATE_CLIENTS_EPOCH = """
+    CREATE TABLE clients (
+        id TEXT PRIMARY KEY,
+        last_backup INTEGER,
+        backup_interval_hours INTEGER NOT NULL DEFAULT 24,
+        last_forget INTEGER,
+        next_due INTEGER NOT NULL DEFAULT 0
+    )
+"""
+CREATE_NEXT_DUE_INDEX = "CREATE INDEX IF NOT EXISTS clients_next_due ON clients (next_due)"
+# Clients from before adaptive intervals keep the interval they have, new ones are inserted adaptive (server.INSERT_CLIENT)
+ADD_ADAPTIVE = "ALTER TABLE clients ADD COLUMN adaptive INTEGER NOT NULL DEFAULT 0"
+ADD_INTERVAL_REASON = "ALTER TABLE clients ADD COLUMN interval_reason TEXT"
+CREATE_SERVER_STATE = """
+    CREATE TABLE IF NOT EXISTS server_state (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+"""
+INSERT_CLIENTS_VERSION = "INSERT INTO server_state (name, value) VALUES ('clients_version', 0)"
+ADD_BACKUP_RETRY_AFTER = "ALTER TABLE clients ADD COLUMN backup_retry_after INTEGER"
+ADD_FORGET_RETRY_AFTER = "ALTER TABLE clients ADD COLUMN forget_retry_after INTEGER"
+
+def to_epoch(value):
+    '''
+    The old TIMESTAMP columns hold str(datetime) from /report and isoformat() from /forget/report, naive ones are UTC.
+    '''
+    if value is None:
+        return None
+    parsed = datetime.fromisoformat(str(value))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+def epoch_columns(cursor):
+    '''
+    last_backup and last_forget become integer epoch seconds and next_due (last_backup + interval, 0 when there was no
+    backup yet) is stored, so the overdue clients are one range scan of its index.
+    '''
+    rows = cursor.execute("SELECT id, last_backup, backup_interval_hours, last_forget FROM clients").fetchall()
+    cursor.execute("DROP TABLE clients")
+    cursor.execute(CREATE_CLIENTS_EPOCH)
+    converted = []
+    for client_id, last_backup, interval, last_forget in rows:
+        last_backup = to_epoch(last_backup)
+        interval = interval or 24
+        converted.append((client_id, last_backup, interval, to_epoch(last_forget), last_backup + interval * 3600 if last_backup else 0))
+    cursor.executemany("INSERT INTO clients (id, last_backup, backup_interval_hours, last_forget, next_due) VALUES (?, ?, ?, ?, ?)", converted)
+
+# Schema versions in order, each one a list of SQL statements or functions taking a cursor. Only ever append.
+migrations = [
+    [CREATE_CLIENTS],
+    [CREATE_LEASES],
+    [CREATE_RUNS, CREATE_RUNS_INDEX],
+    [epoch_columns, CREATE_NEXT_DUE_INDEX],
+    [CREATE_REPO_LOCKS],
+    [ADD_ADAPTIVE, ADD_INTERVAL_REASON],
+    [CREATE_RATE_LIMITS, CREATE_SERVER_STATE, INSERT_CLIENTS_VERSION, CREATE_JOBS, CREATE_JOBS_INDEX, CREATE_WORKER_METRICS],
+    [ADD_BACKUP_RETRY_AFTER, ADD_FORGET_RETRY_AFTER],
+]
+
+def migrate(db):
+    '''
+    Brings the database (a database.Database) to the newest schema. Every migration runs in its own write transaction that
+    reads the version (PRAGMA user_version, a schema_version table on PostgreSQL) first, so when several workers or nodes
+    start at once they take turns: one applies a migration and the others find it done. A failing migration leaves the
+    database at the previous version. Databases created before migrations existed are at version 0 and already have the
+    first tables, their CREATE TABLE IF NOT EXISTS steps do nothing.
+    '''
+    def apply_next(cursor):
+        version = db.schema_version(cursor)
+        if version >= len(migrations):
+            return None
+        try:
+            for step in migrations[version]:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            db.set_schema_version(cursor, version + 1)
+        except Exception:
+            logger.error(f'Migration {version + 1} failed, database left at version {version}.')
+            raise
+        return version + 1
+
+    while True:
+        number = db.run_sync(apply_next)
+        if number is None:
+            return len(migrations)
+        logger.info(f'Migrated database to version {number}.')
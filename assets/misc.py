@@ -1,27 +1,115 @@
 import os
+import json
 import yaml
+import queue
+import atexit
+import random
 import logging
-from logging.handlers import RotatingFileHandler
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
-def setup_logging(loaded_config, script_path):
+# client/repo/run IDs added to the log records of the current thread or asyncio task, see bind_log
+log_context = contextvars.ContextVar('log_context', default={})
+context_fields = ['client', 'repo', 'run']
+listener = None
+
+def bind_log(**fields):
+    '''
+    Adds IDs (client, repo, run) to every record logged from the current context from here on. Threads and asyncio tasks
+    each have their own context, a task started from here gets a copy.
+    '''
+    log_context.set({**log_context.get(), **{key: value for key, value in fields.items() if value is not None}})
+
+class ContextQueueHandler(QueueHandler):
+
+    '''
+    Puts records on the queue as they are, the message is only formatted by the listener thread. The bound IDs are copied
+    onto the record first, the listener doesn't run in the caller's context.
+    '''
+    def prepare(self, record):
+        for field, value in log_context.get().items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        return record
+
+class JsonFormatter(logging.Formatter):
+
+    '''
+    One JSON object per line: time (UTC), level, logger, message, the bound IDs and the traceback if there is one.
+    '''
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        for field in context_fields:
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class SampleFilter(logging.Filter):
+
+    '''
+    Keeps a share (rate) of the records at or below level from the given loggers and their children, e.g. the per-request
+    messages of the server. Everything above level and from other loggers passes.
+    '''
+    def __init__(self, loggers, rate, level=logging.INFO):
+        super().__init__()
+        self.loggers = list(loggers)
+        self.rate = rate
+        self.level = level
+
+    def filter(self, record):
+        if record.levelno > self.level or not any(record.name == name or record.name.startswith(f'{name}.') for name in self.loggers):
+            return True
+        return random.random() < self.rate
+
+def stop_logging():
+    '''
+    Writes out what is still queued, registered with atexit.
+    '''
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
+
+def setup_logging(loaded_config, script_path, console=True, sampled=()):
+    '''
+    Logging for restic.py, the client and the server. Loggers only put records on an in-memory queue, a listener thread
+    formats them and writes them to logs/<log_file> (rotated, JSON lines unless format: text) and to the console. So a
+    request handler never waits on the disk, and with %-style arguments a message is only built when it is written.
+    With sample_rate set, only that share of the records up to sample_level (INFO by default) from the sampled loggers is kept.
+    '''
+    global listener
+    stop_logging()
+    settings = loaded_config.get('logging') or {}
     log_path = f'{script_path}/../logs'
     if not os.path.exists(log_path):
         os.makedirs(log_path)
-    log_file = loaded_config['logging'].get('log_file', None)
-    log_level = loaded_config['logging'].get('log_level', None)
-    max_log_size = loaded_config['logging'].get('max_log_size', None)
-    backup_count = loaded_config['logging'].get('backup_count', None)
-    numeric_level = getattr(logging, log_level.upper(), logging.INFO)
-    log_file_location = f'{log_path}/{log_file}'
-    handler = RotatingFileHandler(log_file_location, maxBytes=max_log_size, backupCount=backup_count)
-    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
-
-    logging.basicConfig(
-        level=numeric_level,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-        handlers=[handler, logging.StreamHandler()]
-    )
+    numeric_level = getattr(logging, str(settings.get('log_level') or 'INFO').upper(), logging.INFO)
+    text_format = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    # {pid} in log_file gives every server worker its own file, processes rotating one file would overwrite each other's logs
+    log_file_location = f"{log_path}/{str(settings.get('log_file') or 'restic.log').format(pid=os.getpid())}"
+    file_handler = RotatingFileHandler(log_file_location, maxBytes=settings.get('max_log_size', 5242880), backupCount=settings.get('backup_count', 5), encoding='utf-8')
+    file_handler.setFormatter(text_format if settings.get('format') == 'text' else JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(text_format)
+        handlers.append(stream_handler)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    queue_handler = ContextQueueHandler(queue.SimpleQueue())
+    if settings.get('sample_rate') is not None and sampled:
+        sample_level = getattr(logging, str(settings.get('sample_level') or 'INFO').upper(), logging.INFO)
+        queue_handler.addFilter(SampleFilter(sampled, float(settings['sample_rate']), sample_level))
+    root.addHandler(queue_handler)
+    root.setLevel(numeric_level)
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging)
 
 def import_configuration(config_location):
     try:
@@ -38,4 +126,16 @@ def import_configuration(config_location):
         exit(1)
     except yaml.YAMLError:
         print(f'Error parsing {config_location}.')
-        exit(1)
\ No newline at end of file
+        exit(1)
+
+def in_window(window, now=None):
+    '''
+    True when now (local time) is inside window, a "HH:MM-HH:MM" string that may wrap past midnight. No window means always.
+    '''
+    if not window:
+        return True
+    now = (now or datetime.now()).strftime('%H:%M')
+    start, end = [part.strip() for part in window.split('-')]
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
@@ -0,0 +1,81 @@
+import random
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CREATE_REPO_LOCKS = """
+    CREATE TABLE IF NOT EXISTS repo_locks (
+        repo TEXT NOT NULL,
+        holder TEXT NOT NULL,
+        shared INTEGER NOT NULL,
+        granted INTEGER NOT NULL,
+        requested_at REAL NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (repo, holder)
+    )
+"""
+DELETE_EXPIRED_LOCKS = "DELETE FROM repo_locks WHERE expires_at < ?"
+SELECT_REPO_LOCKS = "SELECT holder, shared, granted, requested_at FROM repo_locks WHERE repo = ?"
+UPSERT_REPO_LOCK = """
+    INSERT INTO repo_locks (repo, holder, shared, granted, requested_at, expires_at) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (repo, holder) DO UPDATE SET shared = excluded.shared, granted = excluded.granted, expires_at = excluded.expires_at
+"""
+RENEW_REPO_LOCK = "UPDATE repo_locks SET expires_at = ? WHERE repo = ? AND holder = ? AND granted = 1"
+DELETE_REPO_LOCK = "DELETE FROM repo_locks WHERE repo = ? AND holder = ?"
+
+class RepoLeases:
+
+    '''
+    Repo locks shared by every host that runs restic on a repo: restic.py, cron and the client take a lease here before
+    restic starts, so runs from different hosts queue for the repo instead of failing on restic's own lock.
+    Backups hold shared leases, maintenance an exclusive one. An exclusive request that has to wait is kept as a
+    waiting row, new shared leases are refused while it waits and exclusive requests are granted oldest first, so a
+    steady stream of backups can't starve a prune. Leases expire unless renewed, waiting rows unless asked again.
+    All methods that take a cursor are meant to run inside a Database transaction.
+    '''
+    def __init__(self, lease_seconds=600, retry_seconds=15, jitter_seconds=5):
+        self.lease_seconds = lease_seconds
+        self.retry_seconds = retry_seconds
+        self.jitter_seconds = jitter_seconds
+
+    @classmethod
+    def from_config(cls, lock_config):
+        return cls(**(lock_config or {}))
+
+    def wait(self):
+        return round(self.retry_seconds + random.uniform(0, self.jitter_seconds), 1)
+
+    def acquire(self, cursor, repo, holder, shared):
+        '''
+        Returns ('granted', lease_seconds, []) or ('wait', seconds, [holders in the way]).
+        '''
+        now = time.time()
+        cursor.execute(DELETE_EXPIRED_LOCKS, (now,))
+        rows = cursor.execute(SELECT_REPO_LOCKS, (repo,)).fetchall()
+        mine = [row for row in rows if row[0] == holder]
+        others = [row for row in rows if row[0] != holder]
+        requested_at = mine[0][3] if mine else now
+        if shared:
+            blocking = [row for row in others if not row[1]]
+        else:
+            blocking = [row for row in others if row[2] or (not row[1] and row[3] < requested_at)]
+        if not blocking:
+            cursor.execute(UPSERT_REPO_LOCK, (repo, holder, int(shared), 1, requested_at, now + self.lease_seconds))
+            return 'granted', self.lease_seconds, []
+        seconds = self.wait()
+        if not shared:
+            cursor.execute(UPSERT_REPO_LOCK, (repo, holder, 0, 0, requested_at, now + seconds * 3))
+        holders = [row[0] for row in blocking]
+        logger.info('%s waits for %s lock on %s, held or queued by %s.', holder, 'a shared' if shared else 'the exclusive', repo, holders)
+        return 'wait', seconds, holders
+
+    def renew(self, cursor, repo, holder):
+        '''
+        Extends a granted lease, returns False when it has none (expired or never granted).
+        '''
+        cursor.execute(RENEW_REPO_LOCK, (time.time() + self.lease_seconds, repo, holder))
+        return cursor.rowcount > 0
+
+    def release(self, cursor, repo, holder):
+        cursor.execute(DELETE_REPO_LOCK, (repo, holder))
@@ -0,0 +1,315 @@
+import contextvars
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from assets.backup import ResticBackup
+from assets.locks import LockLease
+from assets.misc import in_window, bind_log
+from assets.metrics import MetricsStore
+from assets.snapshot_index import SnapshotIndex, partial_tag
+from assets.transport import Transport
+
+def choice(action, task, snapshot_id, restore_path, single, command, restore_options=None):
+    '''
+    To trigger the actions.
+    Restore, create and mount cannot run for all repos, a single repo must be chosen with --single <repo>
+    restore_options (includes, excludes, workers) switch restore to a partial, parallel restore, overlays are partial
+    snapshots restored on top (Runner.resolve_latest).
+    '''
+    logging.info(f'Task is set to {action}')
+    if action == 'other':
+        if not command:
+            print(f'Command is empty.')
+            sys.exit()
+        return task.other(command)
+    if action == 'backup' and task.copy_from:
+        return task.copy()
+    if action == 'backup':
+        return task.backup(task.backup_options)
+    elif action == 'forget':
+        return task.forget()
+    elif action == 'maintenance':
+        return task.maintenance()
+    elif action == 'snapshots':
+        return task.list_snapshots()
+    elif action == 'restore':
+        if not single:
+            print(f'Cannot {action} all repos, use --single.')
+            logging.warning(f'Action was set to {action} but all repos were selected. Exiting.')
+            sys.exit()
+        if restore_options and (restore_options.get('includes') or restore_options.get('excludes')):
+            return task.restore_partial(snapshot_id, restore_path, **restore_options)
+        return task.restore(snapshot_id, restore_path, overlays=(restore_options or {}).get('overlays'))
+    elif action == 'mount':
+        if not single:
+            print(f'Cannot {action} all repos, use --single.')
+            logging.warning(f'Action was set to {action} but all repos were selected. Exiting.')
+            sys.exit()
+        return task.mount(restore_path)
+    elif action == 'dump':
+        if not single:
+            print(f'Cannot {action} all repos, use --single.')
+            logging.warning(f'Action was set to {action} but all repos were selected. Exiting.')
+            sys.exit()
+        return task.dump(snapshot_id, restore_path)
+    elif action == 'init':
+        if not single:
+            print(f'Cannot {action} all repos, use --single.')
+            logging.warning(f'Action was set to {action} but all repos were selected. Exiting.')
+            sys.exit()
+        return task.create()
+
+def run_status(result, task):
+    '''
+    failed when the action returned False or restic exited with an error, partial when a backup's snapshot is missing
+    files (exit code 3 or errors reported with --json), ok otherwise. Negative exit codes are restic stopped by a
+    signal, e.g. a mount ended with Ctrl-C, the action's own result decides then.
+    '''
+    if result is False or (task.returncode is not None and task.returncode > 0 and task.returncode != 3):
+        return 'failed'
+    if task.returncode == 3 or task.errors:
+        return 'partial'
+    return 'ok'
+
+def concurrency_limits(concurrency):
+    '''
+    Builds the semaphores used to cap how many repos run at once per backend type (sftp, s3, local) and per sftp host.
+    Both caps are optional, anything not listed is only bound by the number of workers.
+    '''
+    per_backend = {backend: threading.Semaphore(limit) for backend, limit in (concurrency.get('per_backend') or {}).items()}
+    per_host = concurrency.get('per_host')
+    host_limits = {}
+    host_lock = threading.Lock()
+
+    def limits_for(task):
+        limits = []
+        if task.backup_type in per_backend:
+            limits.append(per_backend[task.backup_type])
+        if per_host and task.backup_type == 'sftp':
+            with host_lock:
+                limits.append(host_limits.setdefault(task.host, threading.Semaphore(per_host)))
+        return limits
+    return limits_for
+
+def print_summary(action, results):
+    print(f'\nSummary for {action}:')
+    print(f'{"REPO":<20} {"TYPE":<8} {"STATUS":<8} {"DURATION":>10} {"ADDED":>12} {"RATE":>12}')
+    for row in results:
+        added = f'{row["data_added"] / 1024 / 1024:.1f} MiB' if row['data_added'] is not None else '-'
+        rate = f'{row["bytes_per_second"] / 1024 / 1024:.1f} MiB/s' if row['bytes_per_second'] is not None else '-'
+        print(f'{row["repo"]:<20} {row["type"]:<8} {row["status"]:<8} {row["duration"]:>9.1f}s {added:>12} {rate:>12}')
+    failed = [row['repo'] for row in results if row['status'] in ['failed', 'partial']]
+    logging.info(f'{action} finished for {len(results)} repos, {len(failed)} failed or incomplete: {failed}')
+
+def resolve_profile(entry, profiles):
+    '''
+    A shaping entry is a profile name, or a mapping with an optional profile name and settings that override it.
+    '''
+    if entry is None:
+        return None
+    if isinstance(entry, str):
+        entry = {'profile': entry}
+    profile = dict(profiles.get(entry.get('profile')) or {})
+    profile.update({key: value for key, value in entry.items() if key not in ['profile', 'window']})
+    return profile
+
+# Actions that take the local repo lock, True for shared.
+repo_locks = {'backup': True, 'forget': False, 'maintenance': False}
+
+class Runner:
+
+    '''
+    Runs restic actions for the repos in config.yml, in-process.
+    Used by restic.py and by the orchestrator client, which gets the per-repo rows back (status, exit code, duration and the
+    restic summary when json: true is set) and sends them to /report instead of starting restic.py as a subprocess.
+    '''
+    def __init__(self, config, script_path):
+        self.script_path = script_path
+        self.lock_transport = None
+        self.reload(config)
+        self.metrics = MetricsStore(config.get('metrics_db') or f'{script_path}/logs/metrics.db')
+        self.snapshot_index = SnapshotIndex(config.get('snapshot_db') or f'{script_path}/logs/snapshots.db', config.get('snapshot_cache_ttl', 3600))
+
+    def reload(self, config):
+        '''
+        Switches to a newly loaded config.yml, the repos are read from it on the next run. metrics_db and snapshot_db are only read at start.
+        '''
+        self.config = config
+        self.servers = config['servers']
+        self.restic_path = config['restic_path']
+        self.lock_options = config.get('locks') or {}
+        server_url = self.lock_options.get('server_url')
+        if not server_url:
+            self.lock_transport = None
+        elif not self.lock_transport or self.lock_transport.server_url != server_url.rstrip('/'):
+            self.lock_transport = Transport(server_url, f'{self.script_path}/logs/outbox', retries=1)
+
+    def load_environment(self, restic_task):
+
+        '''
+        Checking if the basic keys exist on the config file, if it doesn't it will exit.
+        Tasks can be set to enabled = true or enabled = false to skip.
+        Once keys are checked and task is enabled the task keys are returned to be used.
+        '''
+        if not self.servers[restic_task]:
+            return None
+        elif self.servers[restic_task]['enabled'] is not True:
+            print(f'Skipping {restic_task} as it is disabled in the configuration file.')
+            return None
+        return self.servers[restic_task]
+
+    def task(self, restic_task, name=None):
+        '''
+        Replicas get their primary attached (enabled or not, it's only read from) for copy and init.
+        '''
+        loaded_config = self.load_environment(restic_task)
+        if loaded_config is None:
+            return None
+        task = ResticBackup(loaded_config, self.restic_path, self.script_path, name=name, lock_options=self.lock_options)
+        if task.copy_from and self.servers.get(task.copy_from):
+            task.primary = ResticBackup(self.servers[task.copy_from], self.restic_path, self.script_path, name=task.copy_from, lock_options=self.lock_options)
+        return task
+
+    def shaping_profile(self, task, pushed=None):
+        '''
+        The shaping profile for a run: the one pushed by the server or given with --profile, otherwise the first of the
+        repo's shaping windows that contains the current time.
+        '''
+        profiles = self.config.get('profiles') or {}
+        if pushed is not None:
+            return resolve_profile(pushed, profiles)
+        for entry in task.shaping:
+            if in_window(entry.get('window')):
+                return resolve_profile(entry, profiles)
+        return None
+
+    def lock_repo(self, stack, restic_task, task, action):
+        '''
+        Enters the local repo lock and, with locks.server_url set, the server's lease on the repo. Returns the seconds
+        waited for both. Raises TimeoutError when the lease wasn't granted within locks.wait_timeout.
+        '''
+        shared = repo_locks[action]
+        waited = stack.enter_context(task.repo_lock(shared=shared)).waited
+        if self.lock_transport:
+            lease = LockLease(self.lock_transport, task.repository(), shared, self.lock_options.get('wait_timeout', 3600))
+            waited += stack.enter_context(lease).waited
+        if waited > 1:
+            logging.info(f'{restic_task} waited {waited:.1f}s for the repo lock before {action}.')
+        return waited
+
+    def run_task(self, restic_task, task, limits, action, snapshot_id=None, restore_path=None, single=None, command=None, restore_options=None, profile=None):
+        '''
+        Runs a single repo while holding its backend/host slots and returns a row for the summary table.
+        '''
+        bind_log(repo=restic_task)
+        profile = self.shaping_profile(task, profile)
+        if profile:
+            task.apply_profile(profile)
+            logging.info(f'{restic_task} runs {action} with shaping profile {profile}.')
+        with ExitStack() as stack:
+            for limit in limits:
+                stack.enter_context(limit)
+            lock_wait = None
+            # Tasks are reused between runs, the status comes from this run's exit code only
+            task.returncode = None
+            task.errors = []
+            started_at = time.time()
+            start = time.monotonic()
+            try:
+                if action in repo_locks:
+                    lock_wait = self.lock_repo(stack, restic_task, task, action)
+                    started_at, start = time.time(), time.monotonic()
+                result = choice(action, task, snapshot_id, restore_path, single, command, restore_options)
+            except Exception as e:
+                logging.error(f'{restic_task} failed running {action}: {e}')
+                result = False
+            duration = time.monotonic() - start
+        status = run_status(result, task)
+        summary = result if isinstance(result, dict) else None
+        if summary and summary.get('skipped'):
+            status = 'skipped'
+        if action in ['backup', 'forget', 'maintenance', 'other'] and status != 'skipped':
+            self.snapshot_index.invalidate(restic_task)
+        self.metrics.record_run(restic_task, action, task.backup_type, started_at, duration, task.returncode, status, summary, lock_wait)
+        row = {'repo': restic_task, 'type': task.backup_type, 'status': status, 'exit_code': task.returncode, 'duration': duration, 'lock_wait': lock_wait, 'data_added': None, 'bytes_per_second': None, 'summary': summary}
+        if summary:
+            row['data_added'] = summary.get('data_added')
+            row['bytes_per_second'] = summary.get('bytes_per_second')
+        return row
+
+    def run_copy(self, primary_backup, restic_task, task, limits, action, profile=None):
+        '''
+        Waits for the primary's backup of this run (if it is part of it) before copying its snapshots to the replica.
+        '''
+        if primary_backup is not None:
+            primary_backup.result()
+        return self.run_task(restic_task, task, limits, action, profile=profile)
+
+    def run_all(self, action, snapshot_id=None, restore_path=None, single=None, command=None, workers=None, profile=None):
+        '''
+        Runs the action for every enabled repo. With more than one worker the repos run in a thread pool, each one prefixing its output with its name.
+        On backup, replicas (copy_from) are filled from their primary with restic copy once its backup finished. The copies run
+        in their own pool, concurrency.copy_workers at once (all of them by default), so they don't hold up the backups.
+        Restore, mount and init always stop before this point as they need --single.
+        Each repo runs in a copy of the caller's context, so its log records carry the caller's client/run IDs and its own repo.
+        '''
+        concurrency = self.config.get('concurrency') or {}
+        workers = workers or concurrency.get('workers', 1)
+        limits_for = concurrency_limits(concurrency)
+        tasks = []
+        for restic_task in self.servers:
+            task = self.task(restic_task, name=restic_task if workers > 1 else None)
+            if task is not None:
+                tasks.append((restic_task, task))
+
+        replicas = [restic_task for restic_task, task in tasks if action == 'backup' and task.copy_from]
+        copy_workers = concurrency.get('copy_workers') or len(replicas) or 1
+
+        logging.info(f'Running {action} for {len(tasks)} repos with {workers} workers.')
+        with ThreadPoolExecutor(max_workers=workers) as executor, ThreadPoolExecutor(max_workers=copy_workers) as copier:
+            futures = {}
+            for restic_task, task in tasks:
+                if restic_task not in replicas:
+                    futures[restic_task] = executor.submit(contextvars.copy_context().run, self.run_task, restic_task, task, limits_for(task), action, snapshot_id, restore_path, single, command, None, profile)
+            for restic_task, task in tasks:
+                if restic_task in replicas:
+                    futures[restic_task] = copier.submit(contextvars.copy_context().run, self.run_copy, futures.get(task.copy_from), restic_task, task, limits_for(task), action, profile)
+            results = [futures[restic_task].result() for restic_task, _ in tasks]
+        print_summary(action, results)
+        return results
+
+    def snapshots(self, restic_task, task, refresh=False, **filters):
+        '''
+        Snapshots of the repo from the local index, refreshed from the repo first when the index is stale or refresh is set.
+        filters are the SnapshotIndex.query ones: tag, host, path, before, after, limit.
+        '''
+        if refresh or not self.snapshot_index.is_fresh(restic_task):
+            snapshots = task.fetch_snapshots()
+            if snapshots is None:
+                return None
+            added, removed = self.snapshot_index.refresh(restic_task, snapshots)
+            logging.info(f'Refreshed snapshot index for {restic_task}: {added} added, {removed} removed.')
+        return self.snapshot_index.query(restic_task, **filters)
+
+    def resolve_snapshot(self, restic_task, task, **filters):
+        '''
+        ID of the newest snapshot matching filters, e.g. before=<epoch> for "latest before date X". Snapshots of
+        change-limited backups only hold part of backup_path and are skipped unless filters ask for their tag.
+        '''
+        snapshots = self.snapshots(restic_task, task, limit=1, exclude_tag=partial_tag, **filters)
+        return snapshots[0]['id'] if snapshots else None
+
+    def resolve_latest(self, restic_task, task, **filters):
+        '''
+        "latest" for restore: the ID of the newest complete snapshot matching filters and the IDs of the partial snapshots
+        of change-limited backups taken after it, oldest first, which restore lays on top. (None, []) without a complete one.
+        '''
+        overlays = []
+        for snapshot in self.snapshots(restic_task, task, **filters) or []:
+            if partial_tag not in snapshot['tags']:
+                return snapshot['id'], overlays[::-1]
+            overlays.append(snapshot['id'])
+        return None, []
@@ -0,0 +1,121 @@
+import random
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CREATE_LEASES = """
+    CREATE TABLE IF NOT EXISTS leases (
+        client_id TEXT PRIMARY KEY,
+        repository TEXT NOT NULL,
+        acquired_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )
+"""
+DELETE_EXPIRED = "DELETE FROM leases WHERE expires_at < ?"
+SELECT_LEASE = "SELECT repository FROM leases WHERE client_id = ?"
+COUNT_LEASES = "SELECT COUNT(*), SUM(CASE WHEN repository = ? THEN 1 ELSE 0 END) FROM leases"
+INSERT_LEASE = "INSERT INTO leases (client_id, repository, acquired_at, expires_at) VALUES (?, ?, ?, ?)"
+RENEW_LEASE = "UPDATE leases SET expires_at = ? WHERE client_id = ?"
+DELETE_LEASE = "DELETE FROM leases WHERE client_id = ?"
+SELECT_BUSY = "SELECT COUNT(*) FROM leases WHERE (client_id = ? OR repository = ?) AND expires_at >= ?"
+CREATE_RATE_LIMITS = """
+    CREATE TABLE IF NOT EXISTS rate_limits (
+        name TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL
+    )
+"""
+INSERT_RATE_LIMIT = "INSERT INTO rate_limits (name, tokens, updated) VALUES (?, ?, ?) ON CONFLICT (name) DO NOTHING"
+SELECT_RATE_LIMIT = "SELECT tokens, updated FROM rate_limits WHERE name = ?"
+UPDATE_RATE_LIMIT = "UPDATE rate_limits SET tokens = ?, updated = ? WHERE name = ?"
+
+class TokenBucket:
+
+    '''
+    Limits how many backups may start per minute, refilling continuously up to `burst` tokens.
+    The tokens are a row of the rate_limits table, taken inside the caller's transaction, so every server worker
+    and node draws from the same bucket.
+    '''
+    def __init__(self, per_minute, burst, name='backup_starts'):
+        self.rate = per_minute / 60
+        self.capacity = burst
+        self.name = name
+
+    def take(self, cursor):
+        '''
+        Takes a token and returns 0, or returns the seconds until the next token is available.
+        '''
+        now = time.time()
+        cursor.execute(INSERT_RATE_LIMIT, (self.name, self.capacity, now))
+        tokens, updated = cursor.execute(SELECT_RATE_LIMIT, (self.name,)).fetchone()
+        tokens = min(self.capacity, tokens + max(0, now - updated) * self.rate)
+        if tokens < 1:
+            return (1 - tokens) / self.rate
+        cursor.execute(UPDATE_RATE_LIMIT, (tokens - 1, now, self.name))
+        return 0
+
+class BackupScheduler:
+
+    '''
+    Hands out backup slots to clients that are due.
+    A slot is a lease row in the leases table, capped globally and per repository (the storage the client backs up to),
+    and starts are rate limited by a token bucket. A client without a slot is told to wait N seconds, with random jitter so
+    refused clients don't all come back at the same moment. Leases expire unless the client heartbeats, so a crashed client
+    gives its slot back after lease_seconds. Leases and tokens live in the database, so slots stay within the caps however
+    many server workers hand them out.
+    All methods that take a cursor are meant to run inside a Database transaction.
+    '''
+    def __init__(self, max_concurrent=10, max_per_repository=2, starts_per_minute=30, burst=5, lease_seconds=900, retry_seconds=300, jitter_seconds=120):
+        self.max_concurrent = max_concurrent
+        self.max_per_repository = max_per_repository
+        self.bucket = TokenBucket(starts_per_minute, burst)
+        self.lease_seconds = lease_seconds
+        self.retry_seconds = retry_seconds
+        self.jitter_seconds = jitter_seconds
+
+    @classmethod
+    def from_config(cls, scheduler_config):
+        return cls(**(scheduler_config or {}))
+
+    def wait(self, base=None):
+        return int((base or self.retry_seconds) + random.uniform(0, self.jitter_seconds))
+
+    def acquire(self, cursor, client_id, repository):
+        '''
+        Returns ('backup', lease_seconds) when the client got a slot, ('wait', seconds) otherwise.
+        '''
+        now = time.time()
+        cursor.execute(DELETE_EXPIRED, (now,))
+        if cursor.execute(SELECT_LEASE, (client_id,)).fetchone():
+            cursor.execute(RENEW_LEASE, (now + self.lease_seconds, client_id))
+            return 'backup', self.lease_seconds
+        total, in_repository = cursor.execute(COUNT_LEASES, (repository,)).fetchone()
+        if total >= self.max_concurrent:
+            logger.info('%s has to wait, %d backups running.', client_id, total)
+            return 'wait', self.wait()
+        if (in_repository or 0) >= self.max_per_repository:
+            logger.info('%s has to wait, %d backups running on %s.', client_id, in_repository, repository)
+            return 'wait', self.wait()
+        next_token = self.bucket.take(cursor)
+        if next_token:
+            logger.info('%s has to wait, start rate limit reached.', client_id)
+            return 'wait', self.wait(next_token)
+        cursor.execute(INSERT_LEASE, (client_id, repository, now, now + self.lease_seconds))
+        return 'backup', self.lease_seconds
+
+    def heartbeat(self, cursor, client_id):
+        '''
+        Extends the client's lease, returns False when it has none (expired or never acquired).
+        '''
+        cursor.execute(RENEW_LEASE, (time.time() + self.lease_seconds, client_id))
+        return cursor.rowcount > 0
+
+    def busy(self, cursor, client_id, repository):
+        '''
+        True while the client, or any client backing up to the same repository, holds a backup lease.
+        '''
+        return cursor.execute(SELECT_BUSY, (client_id, repository, time.time())).fetchone()[0] > 0
+
+    def release(self, cursor, client_id):
+        cursor.execute(DELETE_LEASE, (client_id,))
@@ -1,167 +1,524 @@
-from fastapi import FastAPI, Request
-from datetime import datetime, timedelta, timezone
-import sqlite3
+from fastapi import FastAPI, Request, HTTPException
+from typing import Optional
+from fastapi.responses import PlainTextResponse, JSONResponse, Response
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+import asyncio
 import os
+import json
+import time
+import socket
 import logging
-from misc import setup_logging, import_configuration
+from misc import setup_logging, import_configuration, in_window, bind_log
+from telemetry import ServerMetrics
+from database import open_database
+from scheduler import BackupScheduler
+from repo_leases import RepoLeases
+from intervals import AdaptiveIntervals
+from migrations import migrate
+from dispatcher import JobDispatcher, job_actions
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    """Publishes this worker's metrics for the other workers while it serves, and one last time when it stops"""
+    publisher = asyncio.create_task(publish_metrics())
+    yield
+    publisher.cancel()
+    await db.run(server_metrics.publish, worker_id, metrics_ttl)
+
+app = FastAPI(lifespan=lifespan)
 
 script_path=os.path.abspath(os.path.dirname(__file__))
 loaded_config = import_configuration(f'{script_path}/../config/server.yaml')
-setup_logging(loaded_config, script_path)
+setup_logging(loaded_config, script_path, sampled=['server.requests', 'scheduler', 'repo_leases'])
 
 db_file = loaded_config['server']['db']
 default_backup_interval = loaded_config['server']['default_backup_interval']
 logger = logging.getLogger(__name__)
-def init_db(db_file):
-    if not os.path.exists(db_file):
-        logger.info('Initializing database...')
-        conn = sqlite3.connect(db_file)
-        c = conn.cursor()
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS clients (
-                id TEXT PRIMARY KEY,
-                last_backup TIMESTAMP,
-                backup_interval_hours INTEGER DEFAULT 24,
-                last_forget TIMESTAMP
-            )
-        """)
-        conn.commit()
-        conn.close()
+# Messages logged on every request, sampled with logging.sample_rate in server.yaml
+request_logger = logging.getLogger(f'{__name__}.requests')
+
+# Everything below runs in every worker (uvicorn --workers N) and on every node, at the same time, and has to be safe
+# to repeat: migrations take the database's write lock, the rest only reads config and database.
+db = open_database(db_file)
+migrate(db)
+scheduler = BackupScheduler.from_config(loaded_config['server'].get('scheduler'))
+workers_config = loaded_config['server'].get('workers') or {}
+dispatcher = JobDispatcher(workers_config.get('jobs_check_seconds', 1))
+db.run_sync(dispatcher.latest)
+repo_leases = RepoLeases.from_config(loaded_config['server'].get('repo_locks'))
+adaptive = AdaptiveIntervals.from_config(loaded_config['server'].get('adaptive'))
+poll_timeout = loaded_config['server'].get('poll_timeout', 60)
+maintenance_config = loaded_config['server'].get('maintenance') or {}
+maintenance_interval = maintenance_config.get('interval_hours', 7 * 24)
+maintenance_window = maintenance_config.get('window')
+shaping = loaded_config['server'].get('shaping') or []
+# A failed backup or maintenance run is handed out again after this long, not on the client's next poll
+retry_failed_seconds = loaded_config['server'].get('retry_failed_minutes', 60) * 60
+
+SELECT_BACKUP = "SELECT next_due, backup_retry_after FROM clients WHERE id = ?"
+SELECT_FORGET = "SELECT last_forget, forget_retry_after FROM clients WHERE id = ?"
+SELECT_INTERVAL = "SELECT backup_interval_hours, adaptive FROM clients WHERE id = ?"
+SELECT_ALL = "SELECT id, last_backup, backup_interval_hours, last_forget FROM clients"
+INSERT_CLIENT = "INSERT INTO clients (id, last_backup, backup_interval_hours, last_forget, next_due, adaptive) VALUES (?, NULL, ?, NULL, 0, 1)"
+UPDATE_BACKUP = "UPDATE clients SET last_backup = ?, next_due = ? + backup_interval_hours * 3600, backup_retry_after = NULL WHERE id = ?"
+UPDATE_SCHEDULE = "UPDATE clients SET last_backup = ?, backup_interval_hours = ?, next_due = ?, interval_reason = ?, backup_retry_after = NULL WHERE id = ?"
+UPDATE_BACKUP_FAILED = "UPDATE clients SET backup_retry_after = ? WHERE id = ?"
+UPDATE_FORGET = "UPDATE clients SET last_forget = ?, forget_retry_after = NULL WHERE id = ?"
+UPDATE_FORGET_FAILED = "UPDATE clients SET forget_retry_after = ? WHERE id = ?"
+UPDATE_INTERVAL = "UPDATE clients SET backup_interval_hours = ?, next_due = COALESCE(last_backup + ? * 3600, 0), adaptive = ?, interval_reason = ? WHERE id = ?"
+INSERT_RUN = "INSERT INTO runs (client_id, action, status, started_at, finished_at, duration, bytes_added, error, results) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+SELECT_RUNS = "SELECT id, action, status, started_at, finished_at, duration, bytes_added, error, results FROM runs WHERE client_id = ?"
+SELECT_STATUS = "SELECT id, last_backup, backup_interval_hours, next_due, adaptive, interval_reason FROM clients WHERE id > ?"
+SELECT_OVERDUE = "SELECT id, last_backup, backup_interval_hours, next_due, adaptive, interval_reason FROM clients INDEXED BY clients_next_due WHERE id > ? AND next_due <= ?"
+COUNT_OVERDUE = "SELECT COUNT(*) FROM clients WHERE next_due <= ?"
+SELECT_CLIENTS_VERSION = "SELECT value FROM server_state WHERE name = 'clients_version'"
+BUMP_CLIENTS_VERSION = "UPDATE server_state SET value = value + 1 WHERE name = 'clients_version'"
+
+server_metrics = ServerMetrics()
+worker_id = f'{socket.gethostname()}:{os.getpid()}'
+metrics_seconds = workers_config.get('metrics_seconds', 15)
+metrics_ttl = workers_config.get('metrics_ttl_hours', 24) * 60 * 60
+
+def clients_changed(db_connection):
+    """Bumps the counter in the /status ETag, in the transaction that wrote to the clients table so all workers agree"""
+    db_connection.execute(BUMP_CLIENTS_VERSION)
+
+def iso(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat() if epoch else None
+
+def seed_metrics(db_connection):
+    """Sets the per-client timestamps and intervals of the in-memory metrics from the clients table"""
+    rows = db_connection.execute(SELECT_ALL).fetchall()
+    for cid, last_backup, interval, last_forget in rows:
+        server_metrics.set_client(
+            cid,
+            last_backup=last_backup,
+            last_forget=last_forget,
+            interval=interval,
+            seeded=True
+        )
+    return len(rows)
+
+def load_metrics():
+    '''
+    Seeds the in-memory metrics with the last known timestamps, after this /metrics is only fed by the handlers
+    (and, with several workers, the others' snapshots, see metrics()).
+    '''
+    count = db.run_sync(seed_metrics)
+    logger.info(f'Loaded metrics for {count} clients.')
+
+load_metrics()
+
+async def publish_metrics():
+    """Stores this worker's counters for the /metrics of the other workers every metrics_seconds"""
+    while True:
+        await asyncio.sleep(metrics_seconds)
+        try:
+            await db.run(server_metrics.publish, worker_id, metrics_ttl)
+        except Exception:
+            logger.exception('Publishing the metrics of this worker failed.')
+
+@app.middleware("http")
+async def request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    endpoint = route.path if route else "unmatched"
+    server_metrics.observe_request(endpoint, time.perf_counter() - start)
+    return response
+
+def not_due(row):
+    """
+    A SELECT_BACKUP row of a client that gets "ok". A client whose last backup failed stays due (and overdue in /status)
+    but waits retry_failed_minutes for the next try.
+    """
+    now = time.time()
+    return row[0] >= now or (row[1] or 0) > now
+
+def backup_not_due(db_connection, client_id):
+    """Read-only first look for /register and /poll, most clients aren't due and need no write transaction"""
+    row = db_connection.execute(SELECT_BACKUP, (client_id,)).fetchone()
+    return row is not None and not_due(row)
+
+def register_client(db_connection, client_id, repository):
+    """Decides if client_id is due and, if so, tries to get it a backup slot. New clients get the default interval"""
+    row = db_connection.execute(SELECT_BACKUP, (client_id,)).fetchone()
+    if row:
+        if not_due(row):
+            return 'ok', None
+        request_logger.info('A backup is needed for %s.', client_id)
     else:
-        logger.info('Found existing database...')
+        # New client → default interval
+        db_connection.execute(INSERT_CLIENT, (client_id, default_backup_interval))
+        clients_changed(db_connection)
+        server_metrics.set_client(client_id, interval=default_backup_interval)
+        request_logger.info('New client %s, taking a backup...', client_id)
+    return scheduler.acquire(db_connection, client_id, repository)
 
-init_db(db_file)
+def register_response(client_id, action, seconds):
+    if action == 'backup':
+        return {"status": "ok", "action": action, "lease_seconds": seconds, "profile": active_profile()}
+    if action == 'wait':
+        request_logger.info('No backup slot for %s, waiting %ss.', client_id, seconds)
+        return {"status": "ok", "action": action, "wait_seconds": seconds}
+    request_logger.info('No backup needed for %s.', client_id)
+    return {"status": "ok", "action": "ok"}
 
 @app.post("/register")
 async def register(request: Request):
     data = await request.json()
     client_id = data["id"]
-    logger.info(f'Client: {client_id}')
-    conn = sqlite3.connect(db_file)
-    db_connection = conn.cursor()
-    db_connection.execute("SELECT last_backup, backup_interval_hours FROM clients WHERE id = ?", (client_id,))
-    row = db_connection.fetchone()
-    now = datetime.now(timezone.utc)
-    action = None
-    if row:
-        last_backup, interval = row
-        interval = interval or default_backup_interval
-        if last_backup is None or (now - datetime.fromisoformat(last_backup)) > timedelta(hours=interval):
-            action = "backup"
-            logger.info(f'A backup is needed...')
+    repository = data.get("repository", "default")
+    bind_log(client=client_id)
+    request_logger.info('Client: %s', client_id)
+    if await db.read(backup_not_due, client_id):
+        action, seconds = 'ok', None
     else:
-        # New client → default interval
-        db_connection.execute("INSERT INTO clients (id, last_backup, backup_interval_hours) VALUES (?, ?, ?)",
-                  (client_id, None, default_backup_interval))
-        action = "backup"
-        logger.info(f'New client, taking a backup...')
+        action, seconds = await db.run(register_client, client_id, repository)
 
-    conn.commit()
-    conn.close()
+    return register_response(client_id, action, seconds)
 
-    if action != 'backup':
-        action = 'ok'
-        logger.info('No backup needed.')
+def batch_items(data, key, required=("id",)):
+    """The list under key in a batch request. A bad item rejects the whole batch before anything is written"""
+    items = data.get(key)
+    if not isinstance(items, list) or not all(isinstance(item, dict) and all(field in item for field in required) for item in items):
+        raise HTTPException(status_code=400, detail=f"{key} must be a list of objects with {', '.join(required)}")
+    return items
 
-    return {"status": "ok", "action": action}
+def register_clients(db_connection, clients):
+    """register_client for every client of a batch, in one transaction"""
+    return [register_client(db_connection, item["id"], item.get("repository", "default")) for item in clients]
 
-@app.post("/report")
-async def report(request: Request):
+@app.post("/register/batch")
+async def register_batch(request: Request):
+    """
+    /register for many clients at once, for hosts running many logical clients and for central agents.
+    Takes {"clients": [{"id": ..., "repository": ...}]}, returns the /register answer of each client in the same order.
+    """
+    clients = batch_items(await request.json(), "clients")
+    decisions = await db.run(register_clients, clients)
+    request_logger.info('Registered %d clients in one batch.', len(clients))
+    return {"status": "ok", "results": [{"id": item["id"], **register_response(item["id"], action, seconds)} for item, (action, seconds) in zip(clients, decisions)]}
+
+@app.post("/heartbeat")
+async def heartbeat(request: Request):
+    """Client renews its backup slot while the backup runs"""
     data = await request.json()
     client_id = data["id"]
-    success = data["success"]
+    bind_log(client=client_id)
+    renewed = await db.run(scheduler.heartbeat, client_id)
+    if not renewed:
+        logger.warning(f'Heartbeat from {client_id} without an active backup slot.')
+    return {"status": "ok", "lease": renewed}
 
-    conn = sqlite3.connect(db_file)
-    db_connection = conn.cursor()
+def finished_at(data):
+    """Reports replayed from a client's outbox carry the time the run finished, fresh ones are stamped now"""
+    if data.get("finished_at"):
+        return min(datetime.fromtimestamp(float(data["finished_at"]), timezone.utc), datetime.now(timezone.utc))
+    return datetime.now(timezone.utc)
 
+def record_run(db_connection, action, data, now):
+    """Adds a report to the runs history, started_at is derived from the reported duration"""
+    duration = data.get("duration")
+    finished = now.timestamp()
+    results = data.get("results")
+    db_connection.execute(INSERT_RUN, (
+        data["id"], action, "ok" if data["success"] else "failed", finished - (duration or 0), finished, duration,
+        data.get("bytes_added"), data.get("error"), json.dumps(results) if results else None
+    ))
+
+def finish_backup(db_connection, data, now):
+    """
+    Records the run, then sets the next due time. With adaptive intervals on, clients not pinned with /config get a new
+    interval and start slot learned from their runs (this one included), the reason is kept for /status.
+    """
+    record_run(db_connection, "backup", data, now)
+    if data["success"]:
+        epoch = int(now.timestamp())
+        row = db_connection.execute(SELECT_INTERVAL, (data["id"],)).fetchone() if adaptive.enabled else None
+        if row and row[1]:
+            interval, next_due, reason = adaptive.schedule(db_connection, data["id"], row[0], epoch)
+            db_connection.execute(UPDATE_SCHEDULE, (epoch, interval, next_due, reason, data["id"]))
+            server_metrics.set_client(data["id"], interval=interval)
+        else:
+            db_connection.execute(UPDATE_BACKUP, (epoch, epoch, data["id"]))
+        clients_changed(db_connection)
+    else:
+        db_connection.execute(UPDATE_BACKUP_FAILED, (int(now.timestamp()) + retry_failed_seconds, data["id"]))
+    scheduler.release(db_connection, data["id"])
+
+def record_report(data, now):
+    client_id = data["id"]
+    success = data["success"]
     if success:
-        now = datetime.now(timezone.utc)
-        db_connection.execute("UPDATE clients SET last_backup = ? WHERE id = ?", (now, client_id))
-        logger.info(f'Updating last backup timestamp for {client_id} to {now}.')
-    conn.commit()
-    conn.close()
+        request_logger.info('Updating last backup timestamp for %s to %s.', client_id, now)
+    for result in data.get("results") or []:
+        request_logger.info('%s %s: %s (exit code %s) in %ss.', client_id, result.get("repo"), result.get("status"), result.get("exit_code"), result.get("duration"))
+    # duration and bytes_added are optional, sent by clients that run backups with json: true
+    server_metrics.record_backup(client_id, success, int(now.timestamp()), data.get("duration"), data.get("bytes_added"))
 
+@app.post("/locks/acquire")
+async def lock_acquire(request: Request):
+    """
+    Repo lock lease for a restic run: {"repo": <restic repository>, "holder": <unique per run>, "shared": true for backups}.
+    Answers "granted" with lease_seconds, or "wait" with wait_seconds and the holders in the way, to ask again after that.
+    """
+    data = await request.json()
+    action, seconds, holders = await db.run(repo_leases.acquire, data["repo"], data["holder"], bool(data.get("shared")))
+    if action == "granted":
+        return {"status": "ok", "action": action, "lease_seconds": seconds}
+    return {"status": "ok", "action": action, "wait_seconds": seconds, "holders": holders}
+
+@app.post("/locks/renew")
+async def lock_renew(request: Request):
+    data = await request.json()
+    renewed = await db.run(repo_leases.renew, data["repo"], data["holder"])
+    if not renewed:
+        logger.warning(f'Renewal of the lock on {data["repo"]} by {data["holder"]} without a lease.')
+    return {"status": "ok", "lease": renewed}
+
+@app.post("/locks/release")
+async def lock_release(request: Request):
+    """Frees the lease, waited (seconds the run queued for it) feeds the lock wait histogram"""
+    data = await request.json()
+    await db.run(repo_leases.release, data["repo"], data["holder"])
+    if data.get("waited") is not None:
+        server_metrics.record_lock_wait(data["repo"], float(data["waited"]))
     return {"status": "ok"}
 
+@app.post("/report")
+async def report(request: Request):
+    data = await request.json()
+    client_id = data["id"]
+    bind_log(client=client_id)
+
+    now = finished_at(data)
+    await db.run(finish_backup, data, now)
+    record_report(data, now)
+
+    return {"status": "ok"}
+
+def finish_backups(db_connection, reports, finished):
+    for data, now in zip(reports, finished):
+        finish_backup(db_connection, data, now)
+
+@app.post("/report/batch")
+async def report_batch(request: Request):
+    """/report for many clients at once: {"reports": [<report>, ...]}, written in one transaction"""
+    reports = batch_items(await request.json(), "reports", ("id", "success"))
+    finished = [finished_at(data) for data in reports]
+    await db.run(finish_backups, reports, finished)
+    for data, now in zip(reports, finished):
+        record_report(data, now)
+    return {"status": "ok", "count": len(reports)}
+
+def set_interval(db_connection, client_id, interval, adaptive_interval):
+    reason = "set with /config, adaptive from here on" if adaptive_interval else "set with /config"
+    params = (interval, interval, int(adaptive_interval), reason, client_id)
+    db_connection.execute(UPDATE_INTERVAL, params)
+    if db_connection.rowcount == 0:
+        db_connection.execute(INSERT_CLIENT, (client_id, interval))
+        db_connection.execute(UPDATE_INTERVAL, params)
+    clients_changed(db_connection)
+
 @app.post("/config")
 async def config(request: Request):
+    """
+    Sets a client's interval. An interval given here is pinned, adaptive intervals leave it alone unless "adaptive": true
+    is sent with it (the interval is then only the starting point). {"id": ..., "adaptive": true} hands a client back.
+    """
     data = await request.json()
     client_id = data["id"]
     interval = int(data.get("backup_interval_hours", default_backup_interval))
+    adaptive_interval = bool(data.get("adaptive", "backup_interval_hours" not in data))
 
-    conn = sqlite3.connect(db_file)
-    db_connection = conn.cursor()
-    db_connection.execute("UPDATE clients SET backup_interval_hours = ? WHERE id = ?", (interval, client_id))
-    logger.info(f'Updating configuration for {client_id}.')
-    if db_connection.rowcount == 0:
-        db_connection.execute("INSERT INTO clients (id, last_backup, backup_interval_hours) VALUES (?, ?, ?)",
-                  (client_id, None, interval))
-    conn.commit()
-    conn.close()
+    await db.run(set_interval, client_id, interval, adaptive_interval)
+    request_logger.info('Updating configuration for %s.', client_id)
+    server_metrics.set_client(client_id, interval=interval)
 
-    return {"status": "ok", "id": client_id, "backup_interval_hours": interval}
+    return {"status": "ok", "id": client_id, "backup_interval_hours": interval, "adaptive": adaptive_interval}
+
+def status_page(db_connection, overdue, limit, cursor, if_none_match=None):
+    """
+    The /status ETag and, unless it equals if_none_match, one page of clients (None otherwise). overdue=true is a range
+    on the next_due index (forced, as the planner would rather walk the primary key for ORDER BY id), only the overdue
+    rows get sorted. The number of overdue clients is part of the ETag because a client turns overdue with time alone,
+    without any write. The ETag comes first, so a poller whose copy is current only pays for two small lookups.
+    """
+    now = int(time.time())
+    overdue_count = db_connection.execute(COUNT_OVERDUE, (now,)).fetchone()[0]
+    clients_version = db_connection.execute(SELECT_CLIENTS_VERSION).fetchone()[0]
+    etag = f'"{clients_version}-{overdue_count}"'
+    if etag == if_none_match:
+        return etag, None, now
+    query = SELECT_OVERDUE if overdue else SELECT_STATUS
+    params = [cursor or ""]
+    if overdue is False:
+        query += " AND next_due > ?"
+    if overdue is not None:
+        params.append(now)
+    query += " ORDER BY id"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    return etag, db_connection.execute(query, params).fetchall(), now
 
 @app.get("/status")
-async def status():
-    conn = sqlite3.connect(db_file)
-    db_connection = conn.cursor()
-    db_connection.execute("SELECT id, last_backup, backup_interval_hours FROM clients")
-    rows = db_connection.fetchall()
-    conn.close()
-    logger.info('Fecthing statuses for all clients:')
-    
-    clients = []
-    now = datetime.now(timezone.utc)
-
-    for cid, last_backup, interval in rows:
-        if last_backup:
-            last_dt = datetime.fromisoformat(last_backup)
-            next_due = last_dt + timedelta(hours=interval)
-            overdue = now > next_due
-        else:
-            last_dt = None
-            next_due = None
-            overdue = True
+async def status(request: Request, overdue: Optional[bool] = None, limit: Optional[int] = None, cursor: Optional[str] = None):
+    """
+    Clients with their last backup, next due time and whether they are overdue, and how their interval was decided.
+    overdue=true/false filters in SQL. With limit the clients come in pages ordered by id, pass next_cursor as cursor to get the next one.
+    Answers 304 when If-None-Match has the current ETag, so pollers only download the list after something changed.
+    """
+    etag, rows, now = await db.read(status_page, overdue, limit, cursor, request.headers.get("if-none-match"))
+    if rows is None:
+        return Response(status_code=304, headers={"ETag": etag})
+    request_logger.info('Fecthing statuses for all clients:')
 
-        clients.append({
+    clients = [
+        {
             "id": cid,
-            "last_backup": last_backup,
+            "last_backup": iso(last_backup),
             "backup_interval_hours": interval,
-            "next_due": next_due.isoformat() if next_due else None,
-            "overdue": overdue
-        })
-    logger.info(f'{len(clients)} clients found.')
-    return {"clients": clients}
+            "next_due": iso(next_due),
+            "overdue": next_due <= now,
+            "adaptive": bool(adaptive_interval),
+            "interval_reason": interval_reason
+        }
+        for cid, last_backup, interval, next_due, adaptive_interval, interval_reason in rows
+    ]
+    request_logger.info('%d clients found.', len(clients))
+    body = {"clients": clients}
+    if limit:
+        body["next_cursor"] = clients[-1]["id"] if len(clients) == limit else None
+    response = JSONResponse(body)
+    response.headers["ETag"] = etag
+    return response
+
+def client_runs(db_connection, client_id, action, status, since, until, limit, cursor):
+    query = SELECT_RUNS
+    params = [client_id]
+    for condition, value in [("action = ?", action), ("status = ?", status), ("started_at >= ?", since), ("started_at < ?", until)]:
+        if value is not None:
+            query += f" AND {condition}"
+            params.append(value)
+    if cursor:
+        started_at, run_id = cursor
+        query += " AND (started_at < ? OR (started_at = ? AND id < ?))"
+        params += [started_at, started_at, run_id]
+    query += " ORDER BY started_at DESC, id DESC LIMIT ?"
+    params.append(limit)
+    return db_connection.execute(query, params).fetchall()
+
+@app.get("/clients/{client_id}/runs")
+async def runs(client_id: str, action: Optional[str] = None, status: Optional[str] = None, since: Optional[float] = None,
+               until: Optional[float] = None, limit: int = 50, cursor: Optional[str] = None):
+    """
+    Run history of a client, newest first, from the (client_id, started_at) index. since/until are epoch seconds.
+    Pages hold up to limit runs (max 500), pass next_cursor as cursor to get the next one.
+    """
+    limit = max(1, min(limit, 500))
+    if cursor:
+        try:
+            started_at, run_id = cursor.split(":")
+            cursor = (float(started_at), int(run_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="cursor must be a next_cursor returned by this endpoint")
+    rows = await db.read(client_runs, client_id, action, status, since, until, limit, cursor)
+    history = [
+        {"id": run_id, "action": run_action, "status": run_status, "started_at": started_at, "finished_at": finished, "duration": duration,
+         "bytes_added": bytes_added, "error": error, "results": json.loads(results) if results else None}
+        for run_id, run_action, run_status, started_at, finished, duration, bytes_added, error, results in rows
+    ]
+    next_cursor = f'{history[-1]["started_at"]}:{history[-1]["id"]}' if len(history) == limit else None
+    return {"id": client_id, "runs": history, "next_cursor": next_cursor}
+
+def active_profile():
+    """
+    Shaping profile pushed to clients with backup/forget: the first server shaping window containing the current time,
+    a profile name from the client's config.yml and/or settings that override it. None lets clients use their own windows.
+    """
+    for entry in shaping:
+        if in_window(entry.get('window')):
+            return {key: value for key, value in entry.items() if key != 'window'}
+    return None
+
+def forget_client(db_connection, client_id, repository="default"):
+    """
+    Returns "forget" when client_id is due for maintenance (forget/prune/check), inserting the client when it's new.
+    Only inside the maintenance window and never while a backup of the client or of its repository holds a lease,
+    and not within retry_failed_minutes of a failed run.
+    """
+    row = db_connection.execute(SELECT_FORGET, (client_id,)).fetchone()
+    if row is None:
+        db_connection.execute(INSERT_CLIENT, (client_id, default_backup_interval))
+        clients_changed(db_connection)
+        server_metrics.set_client(client_id, interval=default_backup_interval)
+    return forget_due(db_connection, client_id, repository, row)
+
+def known_forget_client(db_connection, client_id, repository="default"):
+    """forget_client without the insert, in a read transaction. None for a new client, forget_client has to add it"""
+    row = db_connection.execute(SELECT_FORGET, (client_id,)).fetchone()
+    return forget_due(db_connection, client_id, repository, row) if row else None
+
+def forget_due(db_connection, client_id, repository, row):
+    last_forget = row[0] if row else None
+    if last_forget is not None and time.time() - last_forget <= maintenance_interval * 60 * 60:
+        return "ok"
+    if row and (row[1] or 0) > time.time():
+        return "ok"
+    if not in_window(maintenance_window):
+        return "ok"
+    if scheduler.busy(db_connection, client_id, repository):
+        request_logger.info('%s is due for maintenance but a backup of %s is running.', client_id, repository)
+        return "ok"
+    return "forget"
 
 @app.post("/forget")
 async def forget(request: Request):
     """Client asks if it should run restic forget"""
     data = await request.json()
     client_id = data["id"]
+    bind_log(client=client_id)
+    repository = data.get("repository", "default")
 
-    conn = sqlite3.connect(db_file)
-    db_connection = conn.cursor()
-    db_connection.execute("SELECT last_forget FROM clients WHERE id = ?", (client_id,))
-    row = db_connection.fetchone()
+    action = await db.read(known_forget_client, client_id, repository) or await db.run(forget_client, client_id, repository)
 
-    now = datetime.now(timezone.utc)
-    action = "ok"
+    return {"status": "ok", "action": action, "profile": active_profile()}
 
-    if row:
-        last_forget = row[0]
-        if last_forget is None or (now - datetime.fromisoformat(last_forget)) > timedelta(days=default_backup_interval):
-            action = "forget"
+def forget_clients(db_connection, clients):
+    return [forget_client(db_connection, item["id"], item.get("repository", "default")) for item in clients]
+
+@app.post("/forget/batch")
+async def forget_batch(request: Request):
+    """/forget for many clients at once: {"clients": [{"id": ..., "repository": ...}]}, answers in the same order"""
+    clients = batch_items(await request.json(), "clients")
+    actions = await db.run(forget_clients, clients)
+    profile = active_profile()
+    return {"status": "ok", "results": [{"id": item["id"], "action": action, "profile": profile} for item, action in zip(clients, actions)]}
+
+def finish_forget(db_connection, data, now):
+    if data["success"]:
+        db_connection.execute(UPDATE_FORGET, (int(now.timestamp()), data["id"]))
+        clients_changed(db_connection)
     else:
-        db_connection.execute("INSERT INTO clients (id, last_backup, backup_interval_hours, last_forget) VALUES (?, ?, ?, ?)",
-                  (client_id, None, default_backup_interval, None))
-        action = "forget"
+        db_connection.execute(UPDATE_FORGET_FAILED, (int(now.timestamp()) + retry_failed_seconds, data["id"]))
+    record_run(db_connection, "forget", data, now)
 
-    conn.commit()
-    conn.close()
+def finish_forgets(db_connection, reports, finished):
+    for data, now in zip(reports, finished):
+        finish_forget(db_connection, data, now)
 
-    return {"status": "ok", "action": action}
+@app.post("/forget/report/batch")
+async def forget_report_batch(request: Request):
+    """/forget/report for many clients at once: {"reports": [{"id": ..., "success": ...}]}, written in one transaction"""
+    reports = batch_items(await request.json(), "reports", ("id", "success"))
+    finished = [finished_at(data) for data in reports]
+    await db.run(finish_forgets, reports, finished)
+    for data, now in zip(reports, finished):
+        server_metrics.record_forget(data["id"], data["success"], int(now.timestamp()))
+    return {"status": "ok", "count": len(reports)}
 
 @app.post("/forget/report")
 async def forget_report(request: Request):
@@ -169,14 +526,83 @@ async def forget_report(request: Request):
     data = await request.json()
     client_id = data["id"]
     success = data["success"]
+    bind_log(client=client_id)
 
-    conn = sqlite3.connect(db_file)
-    db_connection = conn.cursor()
+    now = finished_at(data)
+    await db.run(finish_forget, data, now)
+    server_metrics.record_forget(client_id, success, int(now.timestamp()))
 
-    if success:
-        now = datetime.now(timezone.utc).isoformat()
-        db_connection.execute("UPDATE clients SET last_forget = ? WHERE id = ?", (now, client_id))
-    conn.commit()
-    conn.close()
+    return {"status": "ok"}
+
+@app.post("/jobs")
+async def jobs(request: Request):
+    """Queue an ad-hoc job (backup, forget, check or other) for a client, it is handed out on the client's next poll"""
+    data = await request.json()
+    client_id = data["id"]
+    action = data["action"]
+    if action not in job_actions:
+        raise HTTPException(status_code=400, detail=f"action must be one of {job_actions}")
+    job = await db.run(dispatcher.enqueue, client_id, action, data.get("command"))
+    dispatcher.notify(client_id)
+    return {"status": "ok", **job}
+
+@app.post("/jobs/report")
+async def jobs_report(request: Request):
+    """Client reports result of an ad-hoc check/other job"""
+    data = await request.json()
+    bind_log(client=data["id"], run=data.get("job_id"))
+    request_logger.info('Job %s (%s) on %s finished with status: %s.', data.get("job_id"), data.get("action"), data["id"], data["success"])
+    await db.run(record_run, data.get("action") or "other", data, finished_at(data))
+    return {"status": "ok"}
+
+def poll_client(db_connection, client_id, repository):
+    """The client's oldest queued job, or else what register_client decides, in one transaction"""
+    job = dispatcher.claim(db_connection, client_id)
+    if job:
+        return job, None
+    return None, register_client(db_connection, client_id, repository)
+
+def poll_idle(db_connection, client_id):
+    """Read-only first look for /poll: no queued job and no backup due, the common answer, needs no write transaction"""
+    return not dispatcher.queued(db_connection, client_id) and backup_not_due(db_connection, client_id)
+
+@app.post("/poll")
+async def poll(request: Request):
+    """
+    Long-poll for work. Returns right away with a queued job or a due backup/forget,
+    otherwise holds the request until a job is queued for the client or the timeout passes.
+    """
+    data = await request.json()
+    client_id = data["id"]
+    repository = data.get("repository", "default")
+    bind_log(client=client_id)
+    timeout = min(float(data.get("timeout", poll_timeout)), poll_timeout)
+
+    if await db.read(poll_idle, client_id):
+        job, decision = None, ('ok', None)
+    else:
+        job, decision = await db.run(poll_client, client_id, repository)
+    if job:
+        return {"status": "ok", **job}
+    action, seconds = decision
+    if action == 'backup':
+        return {"status": "ok", "action": action, "lease_seconds": seconds, "profile": active_profile()}
+    if action == 'wait':
+        return {"status": "ok", "action": action, "wait_seconds": seconds}
+    # register_client has added a new client by now, this is a read unless it was removed in between
+    if (await db.read(known_forget_client, client_id, repository) or await db.run(forget_client, client_id, repository)) == "forget":
+        return {"status": "ok", "action": "forget", "profile": active_profile()}
+
+    job = await dispatcher.wait(db, client_id, timeout)
+    if job:
+        return {"status": "ok", **job}
+    return {"status": "ok", "action": "ok"}
 
-    return {"status": "ok"}
\ No newline at end of file
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus/OpenMetrics text format, served from memory plus the snapshots of the other workers, which carry the
+    clients they changed as well, so a scrape reads one row per worker and never the clients table.
+    """
+    shared = await db.read(server_metrics.shared, worker_id)
+    return PlainTextResponse(server_metrics.render(default_backup_interval, shared), media_type="text/plain; version=0.0.4")
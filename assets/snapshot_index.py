@@ -0,0 +1,119 @@
+import json
+import re
+import sqlite3
+from contextlib import closing
+import threading
+import time
+from datetime import datetime
+
+# Tag of the snapshots of change-limited backups (change_detection.files_from), they only hold the changed directories
+partial_tag = 'partial'
+
+class SnapshotIndex:
+
+    '''
+    Local copy of `restic snapshots --json` per repo, kept in logs/snapshots.db.
+    A repo's index is used as long as it is younger than ttl seconds and hasn't been invalidated by one of our own
+    backups or forgets. Refreshing only inserts the snapshots we don't know yet and drops the ones that are gone.
+    Tags and paths get their own indexed tables so lookups by tag, host, path and time don't scan every snapshot.
+    '''
+    def __init__(self, db_file, ttl=3600):
+        self.db_file = db_file
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        with self.lock, closing(sqlite3.connect(self.db_file)) as conn, conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    repo TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    short_id TEXT,
+                    time REAL NOT NULL,
+                    hostname TEXT,
+                    paths TEXT,
+                    tags TEXT,
+                    PRIMARY KEY (repo, id)
+                );
+                CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (repo, time);
+                CREATE INDEX IF NOT EXISTS snapshots_host ON snapshots (repo, hostname, time);
+                CREATE TABLE IF NOT EXISTS snapshot_tags (repo TEXT NOT NULL, id TEXT NOT NULL, tag TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS snapshot_tags_tag ON snapshot_tags (repo, tag);
+                CREATE TABLE IF NOT EXISTS snapshot_paths (repo TEXT NOT NULL, id TEXT NOT NULL, path TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS snapshot_paths_path ON snapshot_paths (repo, path);
+                CREATE TABLE IF NOT EXISTS refreshes (repo TEXT PRIMARY KEY, refreshed_at REAL, stale INTEGER DEFAULT 0);
+            """)
+
+    def is_fresh(self, repo):
+        with self.lock, closing(sqlite3.connect(self.db_file)) as conn, conn:
+            row = conn.execute("SELECT refreshed_at, stale FROM refreshes WHERE repo = ?", (repo,)).fetchone()
+        return bool(row) and not row[1] and time.time() - row[0] < self.ttl
+
+    def invalidate(self, repo):
+        with self.lock, closing(sqlite3.connect(self.db_file)) as conn, conn:
+            conn.execute("UPDATE refreshes SET stale = 1 WHERE repo = ?", (repo,))
+
+    def refresh(self, repo, snapshots):
+        '''
+        Merges the output of `restic snapshots --json` into the index. Returns (added, removed).
+        '''
+        by_id = {snapshot['id']: snapshot for snapshot in snapshots}
+        with self.lock, closing(sqlite3.connect(self.db_file)) as conn, conn:
+            known = {row[0] for row in conn.execute("SELECT id FROM snapshots WHERE repo = ?", (repo,))}
+            removed = known - by_id.keys()
+            added = by_id.keys() - known
+            for snapshot_id in removed:
+                for table in ['snapshots', 'snapshot_tags', 'snapshot_paths']:
+                    conn.execute(f"DELETE FROM {table} WHERE repo = ? AND id = ?", (repo, snapshot_id))
+            for snapshot_id in added:
+                snapshot = by_id[snapshot_id]
+                paths = snapshot.get('paths') or []
+                tags = snapshot.get('tags') or []
+                conn.execute(
+                    "INSERT INTO snapshots (repo, id, short_id, time, hostname, paths, tags) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (repo, snapshot_id, snapshot.get('short_id', snapshot_id[:8]), parse_time(snapshot['time']), snapshot.get('hostname'), json.dumps(paths), json.dumps(tags))
+                )
+                conn.executemany("INSERT INTO snapshot_tags (repo, id, tag) VALUES (?, ?, ?)", [(repo, snapshot_id, tag) for tag in tags])
+                conn.executemany("INSERT INTO snapshot_paths (repo, id, path) VALUES (?, ?, ?)", [(repo, snapshot_id, path) for path in paths])
+            conn.execute("INSERT OR REPLACE INTO refreshes (repo, refreshed_at, stale) VALUES (?, ?, 0)", (repo, time.time()))
+        return len(added), len(removed)
+
+    def query(self, repo, tag=None, host=None, path=None, before=None, after=None, limit=None, exclude_tag=None):
+        '''
+        Snapshots of repo matching every filter given and not tagged exclude_tag, newest first. before/after are epoch seconds.
+        '''
+        query = "SELECT id, short_id, time, hostname, paths, tags FROM snapshots WHERE repo = ?"
+        params = [repo]
+        if tag:
+            query += " AND id IN (SELECT id FROM snapshot_tags WHERE repo = ? AND tag = ?)"
+            params += [repo, tag]
+        if exclude_tag and exclude_tag != tag:
+            query += " AND id NOT IN (SELECT id FROM snapshot_tags WHERE repo = ? AND tag = ?)"
+            params += [repo, exclude_tag]
+        if path:
+            query += " AND id IN (SELECT id FROM snapshot_paths WHERE repo = ? AND path = ?)"
+            params += [repo, path]
+        if host:
+            query += " AND hostname = ?"
+            params.append(host)
+        if before is not None:
+            query += " AND time <= ?"
+            params.append(before)
+        if after is not None:
+            query += " AND time >= ?"
+            params.append(after)
+        query += " ORDER BY time DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self.lock, closing(sqlite3.connect(self.db_file)) as conn, conn:
+            rows = conn.execute(query, params).fetchall()
+        return [
+            {'id': row[0], 'short_id': row[1], 'time': row[2], 'hostname': row[3], 'paths': json.loads(row[4]), 'tags': json.loads(row[5])}
+            for row in rows
+        ]
+
+def parse_time(value):
+    '''
+    restic prints nanoseconds and may use Z, fromisoformat before 3.11 only takes microseconds and offsets.
+    '''
+    value = re.sub(r'(\.\d{6})\d+', r'\1', value.replace('Z', '+00:00'))
+    return datetime.fromisoformat(value).timestamp()
@@ -0,0 +1,243 @@
+import json
+import threading
+import time
+
+duration_buckets = [30, 60, 300, 900, 1800, 3600, 7200, 14400, 28800]
+bytes_buckets = [1 << 20, 16 << 20, 128 << 20, 1 << 30, 8 << 30, 64 << 30]
+lock_wait_buckets = [1, 5, 30, 60, 300, 900, 1800, 3600]
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5]
+
+CREATE_WORKER_METRICS = """
+    CREATE TABLE IF NOT EXISTS worker_metrics (
+        worker TEXT PRIMARY KEY,
+        updated REAL NOT NULL,
+        counters TEXT NOT NULL
+    )
+"""
+UPSERT_WORKER_METRICS = """
+    INSERT INTO worker_metrics (worker, updated, counters) VALUES (?, ?, ?)
+    ON CONFLICT (worker) DO UPDATE SET updated = excluded.updated, counters = excluded.counters
+"""
+DELETE_STALE_METRICS = "DELETE FROM worker_metrics WHERE updated < ?"
+SELECT_WORKER_METRICS = "SELECT counters FROM worker_metrics WHERE worker != ?"
+
+class Histogram:
+
+    '''
+    Cumulative histogram in the Prometheus sense, one set of bucket counts per label value.
+    '''
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, label, value):
+        counts, total = self.series.get(label, ([0] * (len(self.buckets) + 1), [0.0, 0]))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        total[0] += value
+        total[1] += 1
+        self.series[label] = (counts, total)
+
+    def merged(self, others):
+        '''
+        A copy with the series of other workers' snapshots ({label: [counts, [sum, count]]}) added.
+        '''
+        merged = Histogram(self.buckets)
+        for series in [self.series, *others]:
+            for label, (counts, total) in series.items():
+                merged_counts, merged_total = merged.series.get(label, ([0] * (len(self.buckets) + 1), [0.0, 0]))
+                merged.series[label] = ([a + b for a, b in zip(merged_counts, counts)], [merged_total[0] + total[0], merged_total[1] + total[1]])
+        return merged
+
+    def render(self, name, label_name):
+        lines = []
+        for label, (counts, total) in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{name}_bucket{{{label_name}="{escape(label)}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{label_name}="{escape(label)}",le="+Inf"}} {counts[-1]}')
+            lines.append(f'{name}_sum{{{label_name}="{escape(label)}"}} {total[0]}')
+            lines.append(f'{name}_count{{{label_name}="{escape(label)}"}} {total[1]}')
+        return lines
+
+class ServerMetrics:
+
+    '''
+    In-memory aggregate behind /metrics. It is seeded once from the clients table at startup and then updated by the
+    handlers as they write, so a scrape never touches the database.
+    With several server workers each one only counts its own requests. Every worker publishes its counters, histograms
+    and the per-client state its handlers changed to the worker_metrics table and adds the others' to what it renders,
+    see publish() and shared().
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        # When this worker last changed a client's state, seeded clients aren't in it
+        self.changed = {}
+        self.backups = {}
+        self.forgets = {}
+        self.backup_duration = Histogram(duration_buckets)
+        self.backup_bytes = Histogram(bytes_buckets)
+        self.request_latency = Histogram(latency_buckets)
+        self.lock_wait = Histogram(lock_wait_buckets)
+
+    def client(self, client_id):
+        return self.clients.setdefault(client_id, {'last_backup': None, 'last_forget': None, 'interval': None})
+
+    def set_client(self, client_id, last_backup=None, last_forget=None, interval=None, seeded=False):
+        '''
+        Timestamps are epoch seconds. seeded is for state loaded from the clients table, which the others have too.
+        '''
+        with self.lock:
+            state = self.client(client_id)
+            if not seeded:
+                self.changed[client_id] = time.time()
+            if last_backup is not None:
+                state['last_backup'] = last_backup
+            if last_forget is not None:
+                state['last_forget'] = last_forget
+            if interval is not None:
+                state['interval'] = interval
+
+    def record_backup(self, client_id, success, finished, duration=None, bytes_added=None):
+        '''
+        finished is when the run finished (epoch seconds), a report replayed from a client's outbox arrives later.
+        '''
+        with self.lock:
+            key = (client_id, 'success' if success else 'failure')
+            self.backups[key] = self.backups.get(key, 0) + 1
+            if success:
+                state = self.client(client_id)
+                state['last_backup'] = max(state['last_backup'] or 0, finished)
+                self.changed[client_id] = time.time()
+            if duration is not None:
+                self.backup_duration.observe(client_id, duration)
+            if bytes_added is not None:
+                self.backup_bytes.observe(client_id, bytes_added)
+
+    def record_forget(self, client_id, success, finished):
+        with self.lock:
+            key = (client_id, 'success' if success else 'failure')
+            self.forgets[key] = self.forgets.get(key, 0) + 1
+            if success:
+                state = self.client(client_id)
+                state['last_forget'] = max(state['last_forget'] or 0, finished)
+                self.changed[client_id] = time.time()
+
+    def record_lock_wait(self, repo, seconds):
+        with self.lock:
+            self.lock_wait.observe(repo, seconds)
+
+    def observe_request(self, endpoint, seconds):
+        with self.lock:
+            self.request_latency.observe(endpoint, seconds)
+
+    def histograms(self):
+        return {'backup_duration': self.backup_duration, 'backup_bytes': self.backup_bytes, 'request_latency': self.request_latency, 'lock_wait': self.lock_wait}
+
+    def snapshot(self):
+        '''
+        The counters, histograms and the state of the clients this worker changed as JSON. The seeded state stays out,
+        every worker loaded it from the clients table at startup.
+        '''
+        with self.lock:
+            return json.dumps({
+                'clients': {client_id: [updated, self.clients[client_id]] for client_id, updated in self.changed.items()},
+                'backups': [[client_id, result, count] for (client_id, result), count in self.backups.items()],
+                'forgets': [[client_id, result, count] for (client_id, result), count in self.forgets.items()],
+                'histograms': {name: histogram.series for name, histogram in self.histograms().items()},
+            })
+
+    def publish(self, cursor, worker, ttl):
+        '''
+        Stores this worker's snapshot and drops the ones of workers that stopped publishing ttl seconds ago.
+        '''
+        now = time.time()
+        cursor.execute(DELETE_STALE_METRICS, (now - ttl,))
+        cursor.execute(UPSERT_WORKER_METRICS, (worker, now, self.snapshot()))
+
+    def shared(self, cursor, worker):
+        '''
+        The last snapshots of the other workers.
+        '''
+        return [json.loads(row[0]) for row in cursor.execute(SELECT_WORKER_METRICS, (worker,)).fetchall()]
+
+    def render(self, default_interval, shared=()):
+        '''
+        Prometheus text, with the counters and histograms of shared (other workers' snapshots) added to this worker's.
+        '''
+        now = time.time()
+        lines = []
+        with self.lock:
+            clients = merge_clients(self.clients, self.changed, [snapshot.get('clients', {}) for snapshot in shared])
+            backups = add_counts(self.backups, [snapshot['backups'] for snapshot in shared])
+            forgets = add_counts(self.forgets, [snapshot['forgets'] for snapshot in shared])
+            histograms = {name: histogram.merged([snapshot['histograms'][name] for snapshot in shared]) for name, histogram in self.histograms().items()}
+            lines.append('# HELP restic_backups_total Backups reported by clients.')
+            lines.append('# TYPE restic_backups_total counter')
+            for (client_id, result), count in sorted(backups.items()):
+                lines.append(f'restic_backups_total{{client="{escape(client_id)}",result="{result}"}} {count}')
+            lines.append('# HELP restic_forgets_total Forget runs reported by clients.')
+            lines.append('# TYPE restic_forgets_total counter')
+            for (client_id, result), count in sorted(forgets.items()):
+                lines.append(f'restic_forgets_total{{client="{escape(client_id)}",result="{result}"}} {count}')
+            lines.append('# HELP restic_last_backup_success_timestamp_seconds Last successful backup per client.')
+            lines.append('# TYPE restic_last_backup_success_timestamp_seconds gauge')
+            for client_id, state in sorted(clients.items()):
+                if state['last_backup'] is not None:
+                    lines.append(f'restic_last_backup_success_timestamp_seconds{{client="{escape(client_id)}"}} {state["last_backup"]}')
+            lines.append('# HELP restic_last_forget_success_timestamp_seconds Last successful forget per client.')
+            lines.append('# TYPE restic_last_forget_success_timestamp_seconds gauge')
+            for client_id, state in sorted(clients.items()):
+                if state['last_forget'] is not None:
+                    lines.append(f'restic_last_forget_success_timestamp_seconds{{client="{escape(client_id)}"}} {state["last_forget"]}')
+            lines.append('# HELP restic_backup_overdue 1 when the client has no backup within its interval.')
+            lines.append('# TYPE restic_backup_overdue gauge')
+            for client_id, state in sorted(clients.items()):
+                interval = (state['interval'] or default_interval) * 60 * 60
+                overdue = state['last_backup'] is None or now - state['last_backup'] > interval
+                lines.append(f'restic_backup_overdue{{client="{escape(client_id)}"}} {int(overdue)}')
+            lines.append('# HELP restic_backup_duration_seconds Backup duration reported by clients.')
+            lines.append('# TYPE restic_backup_duration_seconds histogram')
+            lines.extend(histograms['backup_duration'].render('restic_backup_duration_seconds', 'client'))
+            lines.append('# HELP restic_backup_added_bytes Data added to the repo per backup.')
+            lines.append('# TYPE restic_backup_added_bytes histogram')
+            lines.extend(histograms['backup_bytes'].render('restic_backup_added_bytes', 'client'))
+            lines.append('# HELP restic_server_request_duration_seconds Request latency per endpoint.')
+            lines.append('# TYPE restic_server_request_duration_seconds histogram')
+            lines.extend(histograms['request_latency'].render('restic_server_request_duration_seconds', 'endpoint'))
+            lines.append('# HELP restic_repo_lock_wait_seconds Time runs waited for a repo lock lease, reported on release.')
+            lines.append('# TYPE restic_repo_lock_wait_seconds histogram')
+            lines.extend(histograms['lock_wait'].render('restic_repo_lock_wait_seconds', 'repo'))
+        return '\n'.join(lines) + '\n'
+
+def merge_clients(clients, changed, others):
+    '''
+    The per-client state with the other workers' changes ({client_id: [updated, state]}) applied: the latest timestamps
+    and the interval of whoever changed the client last.
+    '''
+    merged = dict(clients)
+    updated = dict(changed)
+    for rows in others:
+        for client_id, (when, state) in rows.items():
+            current = merged.get(client_id) or {'last_backup': None, 'last_forget': None, 'interval': None}
+            newer = when > updated.get(client_id, 0)
+            merged[client_id] = {
+                'last_backup': max(filter(None, [current['last_backup'], state['last_backup']]), default=None),
+                'last_forget': max(filter(None, [current['last_forget'], state['last_forget']]), default=None),
+                'interval': state['interval'] if newer and state['interval'] is not None else current['interval'],
+            }
+            if newer:
+                updated[client_id] = when
+    return merged
+
+def add_counts(counts, others):
+    total = dict(counts)
+    for rows in others:
+        for client_id, result, count in rows:
+            total[(client_id, result)] = total.get((client_id, result), 0) + count
+    return total
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
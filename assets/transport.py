@@ -0,0 +1,107 @@
+import json
+import os
+import random
+import time
+import uuid
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+class Transport:
+
+    '''
+    Client side of the server API.
+    Uses one requests.Session so connections are kept alive between calls, retries failed calls with exponential backoff
+    and full jitter, and keeps reports that could not be delivered in an on-disk outbox. The outbox is replayed, oldest
+    first, before the client asks the server for work again, so an outage doesn't make the server schedule the same
+    backup twice. A report the server keeps failing with a 5xx is moved to outbox/dead after max_attempts replays.
+    '''
+    retry_status = [429, 502, 503, 504]
+
+    def __init__(self, server_url, outbox_dir, timeout=10, retries=3, backoff=1, max_backoff=30, max_attempts=10):
+        self.server_url = server_url.rstrip('/')
+        self.outbox_dir = outbox_dir
+        self.dead_letter_dir = f'{outbox_dir}/dead'
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        os.makedirs(self.outbox_dir, exist_ok=True)
+
+    def post(self, path, payload, timeout=None, retries=None):
+        '''
+        POSTs payload as JSON and returns the decoded response. Raises the last error once the retries are used up.
+        '''
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                response = self.session.post(f'{self.server_url}{path}', json=payload, timeout=timeout or self.timeout)
+                if response.status_code in self.retry_status and attempt < retries:
+                    raise requests.HTTPError(f'{response.status_code} from {path}', response=response)
+                response.raise_for_status()
+                return response.json()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                retryable = not isinstance(e, requests.HTTPError) or e.response is None or e.response.status_code in self.retry_status
+                if attempt >= retries or not retryable:
+                    raise
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                logger.info(f'{path} failed ({e}), retrying in {delay:.1f}s.')
+                time.sleep(delay)
+
+    def report(self, path, payload):
+        '''
+        Delivers a report or, if the server can't be reached, stores it in the outbox. Returns True when delivered.
+        '''
+        payload = dict(payload, finished_at=payload.get('finished_at') or time.time())
+        try:
+            self.post(path, payload)
+            return True
+        except requests.RequestException as e:
+            file_name = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}.json'
+            self.write_outbox(file_name, {'path': path, 'payload': payload, 'attempts': 0})
+            logger.info(f'Could not send {path} ({e}), kept in outbox as {file_name}.')
+            return False
+
+    def write_outbox(self, file_name, queued):
+        with open(f'{self.outbox_dir}/{file_name}.tmp', 'w') as outbox_file:
+            json.dump(queued, outbox_file)
+        os.replace(f'{self.outbox_dir}/{file_name}.tmp', f'{self.outbox_dir}/{file_name}')
+
+    def flush_outbox(self):
+        '''
+        Replays queued reports oldest first. Returns False if one still can't be delivered, the rest stay queued.
+        Only server errors count as attempts, a server that can't be reached or is unavailable (retry_status) doesn't
+        make a report dead.
+        '''
+        for file_name in sorted(name for name in os.listdir(self.outbox_dir) if name.endswith('.json')):
+            location = f'{self.outbox_dir}/{file_name}'
+            with open(location) as outbox_file:
+                queued = json.load(outbox_file)
+            try:
+                self.post(queued['path'], queued['payload'], retries=0)
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code < 500:
+                    logger.warning(f'Server rejected queued report {file_name}: {e}, dropping it.')
+                    os.remove(location)
+                    continue
+                if e.response is None or e.response.status_code in self.retry_status:
+                    return False
+                queued['attempts'] = queued.get('attempts', 0) + 1
+                if queued['attempts'] < self.max_attempts:
+                    self.write_outbox(file_name, queued)
+                    return False
+                os.makedirs(self.dead_letter_dir, exist_ok=True)
+                os.replace(location, f'{self.dead_letter_dir}/{file_name}')
+                logger.warning(f'Queued report {file_name} failed {queued["attempts"]} times ({e}), moved to {self.dead_letter_dir}.')
+                continue
+            except requests.RequestException:
+                return False
+            os.remove(location)
+            logger.info(f'Replayed queued report {file_name}.')
+        return True
@@ -0,0 +1,67 @@
+'''
+Compares the per-item cost of the single endpoints (/register, /report, /forget, /forget/report) with their /batch versions.
+Start the server first (uvicorn server:app --port 8888 from assets/) and point --url at it.
+Each phase uses fresh client IDs, so registrations insert new rows in both modes and take a backup slot when one is free.
+'''
+import argparse
+import time
+import uuid
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+def post(session, url, path, payload):
+    response = session.post(f'{url}{path}', json=payload, timeout=60)
+    response.raise_for_status()
+    return response.json()
+
+def run_single(url, path, payloads, concurrency):
+    def worker(chunk):
+        session = requests.Session()
+        for payload in chunk:
+            post(session, url, path, payload)
+    chunks = [payloads[i::concurrency] for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, chunks))
+    return time.perf_counter() - start
+
+def run_batch(url, path, key, payloads, batch_size, concurrency):
+    def worker(batches):
+        session = requests.Session()
+        for batch in batches:
+            post(session, url, path, {key: batch})
+    batches = [payloads[i:i + batch_size] for i in range(0, len(payloads), batch_size)]
+    chunks = [batches[i::concurrency] for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, chunks))
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-item cost of single vs batched server calls.')
+    parser.add_argument('--url', type=str, default='http://localhost:8888', help='Server URL.')
+    parser.add_argument('--clients', type=int, default=2000, help='Client IDs per phase.')
+    parser.add_argument('--batch_size', type=int, default=100, help='Items per batch request.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent connections.')
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    calls = [
+        ('/register', 'clients', lambda client_id: {'id': client_id, 'repository': 'bench'}),
+        ('/report', 'reports', lambda client_id: {'id': client_id, 'success': True, 'duration': 1.0, 'bytes_added': 1024}),
+        ('/forget', 'clients', lambda client_id: {'id': client_id, 'repository': 'bench'}),
+        ('/forget/report', 'reports', lambda client_id: {'id': client_id, 'success': True}),
+    ]
+    single_ids = [f'bench-{run_id}-single-{i}' for i in range(args.clients)]
+    batch_ids = [f'bench-{run_id}-batch-{i}' for i in range(args.clients)]
+    print(f'{args.clients} clients per phase, batches of {args.batch_size}, {args.concurrency} connections')
+    print(f'{"ENDPOINT":<16} {"SINGLE us/item":>15} {"BATCH us/item":>15} {"SPEEDUP":>8}')
+    for path, key, payload in calls:
+        single = run_single(args.url, path, [payload(client_id) for client_id in single_ids], args.concurrency)
+        batch = run_batch(args.url, f'{path}/batch', key, [payload(client_id) for client_id in batch_ids], args.batch_size, args.concurrency)
+        single_cost = single / args.clients * 1e6
+        batch_cost = batch / args.clients * 1e6
+        print(f'{path:<16} {single_cost:>15.0f} {batch_cost:>15.0f} {single_cost / batch_cost:>7.1f}x')
+
+if __name__ == '__main__':
+    main()
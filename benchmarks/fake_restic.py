@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+'''
+Stand-in for the restic binary, for benchmarks and trying the wrapper offline. Point restic_path in config.yml at this file.
+It takes the same command lines the wrapper builds and answers like restic does: --json progress and summary messages on
+backup, a snapshot list on snapshots --json, text output for everything else. Nothing is read from the backup paths
+except stdin for --stdin backups.
+
+Behaviour is set with environment variables. Each one is a default optionally followed by overrides for the repos whose
+-r argument contains a given text, e.g. FAKE_RESTIC_LATENCY="0.1,offsite=0.5".
+  FAKE_RESTIC_LATENCY    seconds a command takes (0.05)
+  FAKE_RESTIC_JITTER     random extra fraction of the latency (0.2)
+  FAKE_RESTIC_FAIL_RATE  share of commands that fail with a restic error on stderr and exit code 1 (0)
+  FAKE_RESTIC_FILES      files processed by a backup (1000)
+  FAKE_RESTIC_BYTES      bytes processed by a backup (100 MiB), a tenth of it is reported as added
+  FAKE_RESTIC_STATE      directory keeping the snapshots of every repo, so snapshots/forget see earlier backups (unset: none kept)
+'''
+import hashlib
+import json
+import os
+import random
+import secrets
+import socket
+import sys
+import time
+from datetime import datetime, timezone
+
+commands = ['backup', 'snapshots', 'forget', 'prune', 'check', 'copy', 'init', 'restore', 'dump', 'mount', 'unlock', 'cat', 'stats', 'version']
+# Options the wrapper passes with their value as the next argument, the command is the first other word
+valued_options = [
+    '-r', '--repo', '--password-file', '--from-repo', '--from-password-file', '--limit-upload', '--limit-download', '--pack-size', '-o',
+    '--read-concurrency', '--tag', '--files-from', '--stdin-filename', '--target', '--include', '--exclude', '--keep-daily',
+    '--keep-weekly', '--keep-monthly', '--max-unused', '--max-repack-size', '--read-data-subset',
+]
+
+def setting(name, repo, default, cast=float):
+    '''
+    FAKE_RESTIC_<name> for repo: the first override whose text is part of repo, else the default.
+    '''
+    value = os.environ.get(f'FAKE_RESTIC_{name}')
+    if not value:
+        return default
+    parts = value.split(',')
+    for part in parts[1:]:
+        match, _, override = part.partition('=')
+        if match and match in repo:
+            return cast(override)
+    return cast(parts[0]) if parts[0] else default
+
+def parse(argv):
+    '''
+    Returns ({option: [values]}, positional arguments), the first positional argument is the command.
+    '''
+    options = {}
+    positional = []
+    index = 0
+    while index < len(argv):
+        arg = argv[index]
+        if arg in valued_options and index + 1 < len(argv):
+            options.setdefault(arg, []).append(argv[index + 1])
+            index += 2
+            continue
+        if arg.startswith('-'):
+            name, _, value = arg.partition('=')
+            options.setdefault(name, []).append(value)
+        else:
+            positional.append(arg)
+        index += 1
+    return options, positional
+
+def state_file(repo):
+    directory = os.environ.get('FAKE_RESTIC_STATE')
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    return f'{directory}/{hashlib.sha1(repo.encode()).hexdigest()[:16]}.jsonl'
+
+def load_snapshots(repo):
+    location = state_file(repo)
+    if not location or not os.path.exists(location):
+        return []
+    with open(location) as snapshots:
+        return [json.loads(line) for line in snapshots if line.strip()]
+
+def add_snapshot(repo, paths, tags):
+    snapshot_id = secrets.token_hex(32)
+    snapshot = {
+        'time': datetime.now(timezone.utc).isoformat(), 'tree': secrets.token_hex(32), 'paths': paths, 'hostname': socket.gethostname(),
+        'username': os.environ.get('USER', 'root'), 'tags': tags or None, 'id': snapshot_id, 'short_id': snapshot_id[:8],
+    }
+    location = state_file(repo)
+    if location:
+        # One short append per snapshot, O_APPEND keeps concurrent backups of the same repo from mixing lines
+        with open(location, 'a') as snapshots:
+            snapshots.write(json.dumps(snapshot) + '\n')
+    return snapshot
+
+def save_snapshots(repo, snapshots):
+    location = state_file(repo)
+    if not location:
+        return
+    with open(f'{location}.tmp', 'w') as state:
+        state.writelines(json.dumps(snapshot) + '\n' for snapshot in snapshots)
+    os.replace(f'{location}.tmp', location)
+
+def fail(repo, command):
+    print(f'Fatal: unable to open repository at {repo}: {command}: connection reset by peer (fake restic)', file=sys.stderr)
+    sys.exit(1)
+
+def backup(repo, paths, options, latency):
+    total_files = int(setting('FILES', repo, 1000))
+    total_bytes = int(setting('BYTES', repo, 100 * 1024 * 1024))
+    if '--stdin' in options:
+        total_bytes = 0
+        for chunk in iter(lambda: sys.stdin.buffer.read(1 << 16), b''):
+            total_bytes += len(chunk)
+        total_files = 1
+    if '--files-from' in options:
+        with open(options['--files-from'][0]) as files_from:
+            paths = [line.strip() for line in files_from if line.strip()]
+        total_files = len(paths)
+    start = time.monotonic()
+    steps = 4
+    for step in range(1, steps + 1):
+        time.sleep(latency / steps)
+        if '--json' in options and step < steps:
+            done = step / steps
+            print(json.dumps({
+                'message_type': 'status', 'seconds_elapsed': int(time.monotonic() - start), 'seconds_remaining': int(latency * (1 - done)),
+                'percent_done': done, 'total_files': total_files, 'files_done': int(total_files * done),
+                'total_bytes': total_bytes, 'bytes_done': int(total_bytes * done),
+            }), flush=True)
+    snapshot = add_snapshot(repo, paths or [f"/{options.get('--stdin-filename', ['stdin'])[0]}"], options.get('--tag'))
+    duration = time.monotonic() - start
+    files_new = total_files // 10
+    if '--json' in options:
+        print(json.dumps({
+            'message_type': 'summary', 'files_new': files_new, 'files_changed': files_new, 'files_unmodified': total_files - 2 * files_new,
+            'dirs_new': 1, 'dirs_changed': 2, 'dirs_unmodified': total_files // 50, 'data_blobs': files_new * 2, 'tree_blobs': 3,
+            'data_added': total_bytes // 10, 'data_added_packed': total_bytes // 14, 'total_files_processed': total_files,
+            'total_bytes_processed': total_bytes, 'total_duration': duration, 'snapshot_id': snapshot['id'],
+        }), flush=True)
+        return
+    print(f'Files:        {files_new} new, {files_new} changed, {total_files - 2 * files_new} unmodified')
+    print(f'Added to the repository: {total_bytes / 10 / 1024 / 1024:.3f} MiB')
+    print(f'processed {total_files} files, {total_bytes / 1024 / 1024:.3f} MiB in 0:{duration:02.0f}')
+    print(f'snapshot {snapshot["short_id"]} saved')
+
+def forget(repo, snapshot_ids, options):
+    snapshots = load_snapshots(repo)
+    if snapshot_ids:
+        remaining = [snapshot for snapshot in snapshots if snapshot['id'] not in snapshot_ids and snapshot['short_id'] not in snapshot_ids]
+        save_snapshots(repo, remaining)
+        print(f'removed {len(snapshots) - len(remaining)} snapshots')
+        return
+    keep = sum(int(values[0]) for option, values in options.items() if option.startswith('--keep-'))
+    if keep and len(snapshots) > keep:
+        save_snapshots(repo, snapshots[-keep:])
+        print(f'remove {len(snapshots) - keep} snapshots')
+    print(f'keep {min(len(snapshots), keep) if keep else len(snapshots)} snapshots')
+    if '--prune' in options:
+        print('collecting packs for deletion and repacking\nremoving 0 old packs\ndone')
+
+def main():
+    options, positional = parse(sys.argv[1:])
+    repo = (options.get('-r') or options.get('--repo') or [''])[0]
+    command = positional[0] if positional else None
+    if command not in commands:
+        print(f'unknown command "{command}" for "restic"', file=sys.stderr)
+        sys.exit(1)
+    latency = setting('LATENCY', repo, 0.05)
+    latency *= 1 + random.uniform(0, setting('JITTER', repo, 0.2))
+    if random.random() < setting('FAIL_RATE', repo, 0):
+        time.sleep(latency / 2)
+        fail(repo, command)
+    if command == 'backup':
+        return backup(repo, positional[1:], options, latency)
+    time.sleep(latency)
+    if command == 'snapshots' and '--json' in options:
+        print(json.dumps(load_snapshots(repo)))
+    elif command == 'snapshots':
+        for snapshot in load_snapshots(repo):
+            print(f'{snapshot["short_id"]}  {snapshot["time"][:19]}  {snapshot["hostname"]}  {" ".join(snapshot["paths"])}')
+    elif command == 'forget':
+        forget(repo, positional[1:], options)
+    elif command == 'copy':
+        print(f'snapshots for repository {repo} copied')
+    elif command == 'init':
+        print(f'created restic repository {secrets.token_hex(5)} at {repo}')
+    elif command == 'check':
+        print('using temporary cache\nload indexes\ncheck all packs\ncheck snapshots, trees and blobs\nno errors were found')
+    elif command == 'version':
+        print('restic 0.16.4 (fake) compiled with go1.21 on linux/amd64')
+    else:
+        print(f'{command} done')
+
+if __name__ == '__main__':
+    main()
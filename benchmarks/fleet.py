@@ -0,0 +1,228 @@
+'''
+End-to-end benchmark of the orchestrator with a simulated fleet, offline: no restic, no repos, no separate server.
+Builds a throwaway tree (a copy of assets/ with its own config/ and logs/), starts the server in-process with uvicorn and
+runs --clients clients on threads. Each one goes through the client.py code path (run_once and run_forget: register,
+backup through Runner with fake_restic.py as restic_path, report) with its own config.yml, logs and outbox.
+Every client's interval is set to 0 hours and the server's maintenance interval to 0, so each round is a backup and a
+maintenance run. Slots come from the real scheduler, configured with the --max_concurrent/--max_per_repository options.
+
+Reports the latency of every endpoint as seen by the clients (register and report first), scheduler fairness (time from
+the first /register of a round to getting a slot, Jain's index over those waits, 1.0 meaning every client waited the
+same) and the wall time of each repo's restic run. --output writes the same numbers as JSON, to compare runs in CI.
+'''
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import yaml
+from register_load import percentile
+
+repo_root = os.path.abspath(f'{os.path.dirname(__file__)}/..')
+fake_restic = os.path.abspath(f'{os.path.dirname(__file__)}/fake_restic.py')
+
+def build_tree(tree, args):
+    '''
+    The server reads ../config/server.yaml next to its own file, so it runs from a copy of assets/ in tree.
+    '''
+    shutil.copytree(f'{repo_root}/assets', f'{tree}/assets', ignore=shutil.ignore_patterns('__pycache__'))
+    os.makedirs(f'{tree}/config')
+    server_config = {
+        'server': {
+            'db': f'{tree}/backups.db',
+            'default_backup_interval': 24,
+            'poll_timeout': 5,
+            'scheduler': {
+                'max_concurrent': args.max_concurrent, 'max_per_repository': args.max_per_repository, 'starts_per_minute': args.starts_per_minute,
+                'burst': args.max_concurrent, 'lease_seconds': 900, 'retry_seconds': args.retry_seconds, 'jitter_seconds': args.retry_seconds,
+            },
+            'maintenance': {'interval_hours': 0},
+            # Every round is a run, failed ones (--fail_rate) included
+            'retry_failed_minutes': 0,
+        },
+        'logging': {'log_file': 'server.log', 'log_level': 'WARNING', 'max_log_size': 5242880, 'backup_count': 1},
+    }
+    with open(f'{tree}/config/server.yaml', 'w') as config_file:
+        yaml.safe_dump(server_config, config_file)
+    with open(f'{tree}/password', 'w') as password_file:
+        password_file.write('bench\n')
+
+def client_config(tree, client_id, repos):
+    '''
+    repo0 is a local repo, the others sftp repos on hosts offsite1, offsite2..., so FAKE_RESTIC_LATENCY="0.05,offsite=0.2"
+    makes the remote ones slower.
+    '''
+    servers = {}
+    for index in range(repos):
+        repo = {
+            'enabled': True, 'type': 'local' if index == 0 else 'sftp', 'host': f'bench@offsite{index}' if index else '',
+            'repo_path': f'{tree}/repos/{client_id}/repo{index}', 'backup_path': '/etc', 'password_file': f'{tree}/password',
+            'options': {'no-scan': True, 'json': True}, 'forget_options': {'daily': 7, 'weekly': 4, 'monthly': 6},
+        }
+        servers[f'repo{index}'] = repo
+    return {'restic_path': fake_restic, 'concurrency': {'workers': repos}, 'servers': servers}
+
+class CallLog:
+
+    '''
+    Replaces a client Transport's post with one that keeps the latency of every call, the /register answers and the
+    /report payloads. Transport.report and flush_outbox go through post too.
+    '''
+    def __init__(self, transport):
+        self.post = transport.post
+        self.calls = []
+        self.answers = []
+        self.reports = []
+        transport.post = self.timed_post
+
+    def timed_post(self, path, payload, timeout=None, retries=None):
+        start = time.perf_counter()
+        response = self.post(path, payload, timeout, retries)
+        self.calls.append((path, time.perf_counter() - start))
+        if path == '/register':
+            self.answers.append((time.monotonic(), response.get('action')))
+        elif path == '/report':
+            self.reports.append(payload)
+        return response
+
+def run_client(client, tree, url, client_id, repos, rounds, repository):
+    '''
+    One simulated client.py: rounds of run_once (sleeping through wait answers) followed by run_forget.
+    Returns the CallLog and the slot wait of every round.
+    '''
+    from assets.runner import Runner
+    from assets.config import validate_config
+    script_path = f'{tree}/clients/{client_id}'
+    os.makedirs(f'{script_path}/logs', exist_ok=True)
+    runner = Runner(validate_config(client_config(tree, client_id, repos)), script_path)
+    transport = client.Transport(url, f'{script_path}/logs/outbox', timeout=60)
+    log = CallLog(transport)
+    slot_waits = []
+    for _ in range(rounds):
+        start = time.monotonic()
+        wait_seconds = client.run_once(transport, client_id, runner, repository)
+        while wait_seconds:
+            time.sleep(wait_seconds)
+            wait_seconds = client.run_once(transport, client_id, runner, repository)
+        granted = [at for at, action in log.answers if action == 'backup' and at >= start]
+        slot_waits.append(granted[0] - start if granted else None)
+        client.run_forget(transport, client_id, runner, repository)
+    return log, slot_waits
+
+def start_server(tree):
+    '''
+    Imports the copied server and serves it with uvicorn on a free port, on a daemon thread. Returns (url, uvicorn server).
+    '''
+    import uvicorn
+    sys.path.insert(0, f'{tree}/assets')
+    import server
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host='127.0.0.1', port=port, log_level='warning', lifespan='off'))
+    threading.Thread(target=uvicorn_server.run, daemon=True).start()
+    while not uvicorn_server.started:
+        time.sleep(0.05)
+    return f'http://127.0.0.1:{port}', uvicorn_server
+
+def jain_index(values):
+    total = sum(values)
+    squares = sum(value * value for value in values)
+    return total * total / (len(values) * squares) if squares else 1.0
+
+def summarize(values):
+    return {'count': len(values), 'p50': percentile(values, 50), 'p99': percentile(values, 99), 'max': max(values)} if values else None
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end fleet benchmark with an in-process server and a fake restic.')
+    parser.add_argument('--clients', type=int, default=50, help='Simulated clients.')
+    parser.add_argument('--repos', type=int, default=2, help='Repos per client, repo0 local and the others sftp.')
+    parser.add_argument('--rounds', type=int, default=2, help='Backup and maintenance rounds per client.')
+    parser.add_argument('--repositories', type=int, default=4, help='Distinct repository names sent to the scheduler, clients are spread over them.')
+    parser.add_argument('--max_concurrent', type=int, default=10, help='scheduler.max_concurrent of the server.')
+    parser.add_argument('--max_per_repository', type=int, default=4, help='scheduler.max_per_repository of the server.')
+    parser.add_argument('--starts_per_minute', type=int, default=6000, help='scheduler.starts_per_minute of the server.')
+    parser.add_argument('--retry_seconds', type=int, default=1, help='scheduler.retry_seconds (and jitter_seconds) of the server.')
+    parser.add_argument('--latency', type=str, default='0.05,offsite=0.2', help='FAKE_RESTIC_LATENCY, seconds per restic command.')
+    parser.add_argument('--fail_rate', type=str, default='0', help='FAKE_RESTIC_FAIL_RATE, share of restic commands that fail.')
+    parser.add_argument('--output', type=str, help='Write the results as JSON to this file.')
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary tree (server log, clients' logs) and print its path.")
+    args = parser.parse_args()
+
+    tree = tempfile.mkdtemp(prefix='restic-fleet-')
+    build_tree(tree, args)
+    os.environ.setdefault('FAKE_RESTIC_LATENCY', args.latency)
+    os.environ.setdefault('FAKE_RESTIC_FAIL_RATE', args.fail_rate)
+    os.environ.setdefault('FAKE_RESTIC_STATE', f'{tree}/fake-restic')
+    url, uvicorn_server = start_server(tree)
+    import client
+
+    run_id = uuid.uuid4().hex[:8]
+    client_ids = [f'fleet-{run_id}-{i}' for i in range(args.clients)]
+    setup = client.Transport(url, f'{tree}/logs/outbox')
+    for client_id in client_ids:
+        setup.post('/config', {'id': client_id, 'backup_interval_hours': 0})
+
+    start = time.perf_counter()
+    # restic output and the per-run summary tables would bury the results
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), ThreadPoolExecutor(max_workers=args.clients) as executor:
+        futures = [
+            executor.submit(run_client, client, tree, url, client_id, args.repos, args.rounds, f'repository-{index % args.repositories}')
+            for index, client_id in enumerate(client_ids)
+        ]
+        outcomes = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    uvicorn_server.should_exit = True
+
+    latencies = {}
+    for log, _ in outcomes:
+        for path, seconds in log.calls:
+            latencies.setdefault(path, []).append(seconds)
+    slot_waits = [wait for _, waits in outcomes for wait in waits if wait is not None]
+    wait_answers = [sum(action == 'wait' for _, action in log.answers) for log, _ in outcomes]
+    repo_times = {}
+    statuses = {}
+    for log, _ in outcomes:
+        for report in log.reports:
+            for row in report.get('results') or []:
+                repo_times.setdefault(row['repo'], []).append(row['duration'])
+                statuses[row['status']] = statuses.get(row['status'], 0) + 1
+    backups = sum(len(log.reports) for log, _ in outcomes)
+    results = {
+        'clients': args.clients, 'repos': args.repos, 'rounds': args.rounds, 'elapsed': elapsed, 'backups': backups,
+        'backups_per_second': backups / elapsed, 'statuses': statuses,
+        'latency': {path: summarize(values) for path, values in sorted(latencies.items())},
+        'fairness': {'slot_wait': summarize(slot_waits), 'jain_index': jain_index(slot_waits) if slot_waits else None,
+                     'max_wait_answers': max(wait_answers), 'clients_never_waiting': wait_answers.count(0)},
+        'repo_wall_time': {repo: summarize(values) for repo, values in sorted(repo_times.items())},
+    }
+
+    print(f'{args.clients} clients x {args.repos} repos x {args.rounds} rounds in {elapsed:.1f}s: {backups} backups ({backups / elapsed:.1f}/s), repo runs {statuses}')
+    print(f'\n{"ENDPOINT":<16} {"CALLS":>7} {"P50 ms":>8} {"P99 ms":>8} {"MAX ms":>8}')
+    for path in sorted(latencies, key=lambda path: (path not in ['/register', '/report'], path)):
+        stats = results['latency'][path]
+        print(f'{path:<16} {stats["count"]:>7} {stats["p50"] * 1000:>8.1f} {stats["p99"] * 1000:>8.1f} {stats["max"] * 1000:>8.1f}')
+    fairness = results['fairness']
+    if slot_waits:
+        print(f'\nslot wait p50 {fairness["slot_wait"]["p50"]:.2f}s p99 {fairness["slot_wait"]["p99"]:.2f}s max {fairness["slot_wait"]["max"]:.2f}s, '
+              f'Jain index {fairness["jain_index"]:.3f}, {fairness["clients_never_waiting"]} clients never told to wait, at most {fairness["max_wait_answers"]} waits per client')
+    print(f'\n{"REPO":<10} {"RUNS":>6} {"P50 s":>8} {"P99 s":>8} {"MAX s":>8}')
+    for repo, stats in results['repo_wall_time'].items():
+        print(f'{repo:<10} {stats["count"]:>6} {stats["p50"]:>8.3f} {stats["p99"]:>8.3f} {stats["max"]:>8.3f}')
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.keep:
+        print(f'\nKept {tree}')
+    else:
+        shutil.rmtree(tree, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
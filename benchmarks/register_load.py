@@ -0,0 +1,55 @@
+'''
+Load test for the orchestrator's /register endpoint.
+Start the server first (uvicorn server:app --port 8888 from assets/) and point --url at it.
+Every worker keeps its own session so connection setup is not part of the measurement.
+'''
+import argparse
+import math
+import time
+import uuid
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(p / 100 * len(ordered))) - 1]
+
+def worker(url, client_ids, rounds):
+    session = requests.Session()
+    latencies = []
+    errors = 0
+    for _ in range(rounds):
+        for client_id in client_ids:
+            start = time.perf_counter()
+            try:
+                response = session.post(f'{url}/register', json={'id': client_id}, timeout=30)
+                response.raise_for_status()
+            except requests.RequestException:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+    return latencies, errors
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure /register throughput and latency.')
+    parser.add_argument('--url', type=str, default='http://localhost:8888', help='Server URL.')
+    parser.add_argument('--clients', type=int, default=500, help='Number of distinct client IDs.')
+    parser.add_argument('--concurrency', type=int, default=50, help='Concurrent connections.')
+    parser.add_argument('--rounds', type=int, default=4, help='Times each client registers, the first round inserts new rows.')
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    client_ids = [f'bench-{run_id}-{i}' for i in range(args.clients)]
+    chunks = [client_ids[i::args.concurrency] for i in range(args.concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda chunk: worker(args.url, chunk, args.rounds), chunks))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for result in results for latency in result[0]]
+    errors = sum(result[1] for result in results)
+    print(f'{len(latencies)} requests from {args.clients} clients over {args.concurrency} connections in {elapsed:.2f}s')
+    print(f'throughput: {len(latencies) / elapsed:.0f} req/s, errors: {errors}')
+    print(f'latency p50: {percentile(latencies, 50) * 1000:.1f}ms p99: {percentile(latencies, 99) * 1000:.1f}ms max: {max(latencies) * 1000:.1f}ms')
+
+if __name__ == '__main__':
+    main()
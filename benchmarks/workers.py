@@ -0,0 +1,120 @@
+'''
+/register throughput of the server with 1, 2, 4... uvicorn workers sharing one database.
+For every worker count it starts `uvicorn server:app --workers N` on a throwaway copy of assets/ with a fresh SQLite file
+(or --db, e.g. a postgresql:// URL, emptied by hand between runs), runs the register_load.py load against it and checks
+that the workers together never handed out more backup slots than scheduler.max_concurrent.
+The load generator runs on the same host: give it spare cores, on a machine with fewer cores than workers plus client
+threads the numbers show contention rather than scaling.
+'''
+import argparse
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import yaml
+from register_load import percentile, worker
+
+repo_root = os.path.abspath(f'{os.path.dirname(__file__)}/..')
+
+def build_tree(tree, db, max_concurrent):
+    shutil.copytree(f'{repo_root}/assets', f'{tree}/assets', ignore=shutil.ignore_patterns('__pycache__'))
+    os.makedirs(f'{tree}/config')
+    server_config = {
+        'server': {
+            'db': db,
+            'default_backup_interval': 24,
+            'scheduler': {'max_concurrent': max_concurrent, 'max_per_repository': max_concurrent, 'starts_per_minute': 6000, 'burst': max_concurrent},
+        },
+        'logging': {'log_file': 'server-{pid}.log', 'log_level': 'WARNING', 'max_log_size': 5242880, 'backup_count': 1},
+    }
+    with open(f'{tree}/config/server.yaml', 'w') as config_file:
+        yaml.safe_dump(server_config, config_file)
+
+def start_server(tree, workers):
+    '''
+    Returns (url, process) once the server answers /status, plus a moment for the workers that are still starting.
+    '''
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'server:app', '--port', str(port), '--workers', str(workers), '--log-level', 'warning', '--no-access-log'],
+        cwd=f'{tree}/assets', stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'{url}/status?limit=1', timeout=1).raise_for_status()
+            break
+        except requests.RequestException:
+            time.sleep(0.2)
+    time.sleep(1 + workers * 0.5)
+    return url, process
+
+def granted_slots(db):
+    if db.startswith(('postgresql://', 'postgres://')):
+        return None
+    with sqlite3.connect(db) as conn:
+        return conn.execute("SELECT COUNT(*) FROM leases").fetchone()[0]
+
+def run_load(url, clients, concurrency, rounds):
+    run_id = uuid.uuid4().hex[:8]
+    client_ids = [f'workers-{run_id}-{i}' for i in range(clients)]
+    chunks = [client_ids[i::concurrency] for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda chunk: worker(url, chunk, rounds), chunks))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for result in results for latency in result[0]]
+    return {
+        'requests': len(latencies), 'elapsed': elapsed, 'throughput': len(latencies) / elapsed, 'errors': sum(result[1] for result in results),
+        'p50': percentile(latencies, 50), 'p99': percentile(latencies, 99),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure /register throughput for several uvicorn worker counts.')
+    parser.add_argument('--workers', type=str, default='1,2,4', help='Comma separated worker counts.')
+    parser.add_argument('--clients', type=int, default=500, help='Number of distinct client IDs.')
+    parser.add_argument('--concurrency', type=int, default=32, help='Concurrent connections.')
+    parser.add_argument('--rounds', type=int, default=4, help='Times each client registers, the first round inserts new rows.')
+    parser.add_argument('--max_concurrent', type=int, default=10, help='scheduler.max_concurrent of the server.')
+    parser.add_argument('--db', type=str, help='server.db for every run, default a new SQLite file per run.')
+    parser.add_argument('--output', type=str, help='Write the results as JSON to this file.')
+    args = parser.parse_args()
+
+    results = []
+    for workers in [int(count) for count in args.workers.split(',')]:
+        tree = tempfile.mkdtemp(prefix='restic-workers-')
+        db = args.db or f'{tree}/backups.db'
+        build_tree(tree, db, args.max_concurrent)
+        url, process = start_server(tree, workers)
+        try:
+            result = run_load(url, args.clients, args.concurrency, args.rounds)
+        finally:
+            process.terminate()
+            process.wait()
+        result.update(workers=workers, slots=granted_slots(db))
+        results.append(result)
+        shutil.rmtree(tree, ignore_errors=True)
+
+    print(f'{args.clients} clients x {args.rounds} rounds over {args.concurrency} connections, {os.cpu_count()} CPUs')
+    print(f'{"WORKERS":>7} {"REQ/S":>8} {"SPEEDUP":>8} {"P50 ms":>8} {"P99 ms":>8} {"ERRORS":>7} {"SLOTS":>6}')
+    for result in results:
+        slots = '-' if result['slots'] is None else f'{result["slots"]}/{args.max_concurrent}'
+        print(f'{result["workers"]:>7} {result["throughput"]:>8.0f} {result["throughput"] / results[0]["throughput"]:>7.2f}x '
+              f'{result["p50"] * 1000:>8.1f} {result["p99"] * 1000:>8.1f} {result["errors"]:>7} {slots:>6}')
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
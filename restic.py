@@ -2,72 +2,61 @@ import argparse
 import os
 import sys
 import logging
-import yaml
-from assets.backup import ResticBackup
+import uuid
+from datetime import datetime
+from assets.runner import Runner
+from assets.config import load_config, ConfigError
+from assets.misc import setup_logging, bind_log
+from assets.snapshot_index import partial_tag
 
 script_path = os.path.abspath(os.path.dirname(__file__))
-logging.basicConfig(filename=f'{script_path}/logs/restic.log', encoding='utf-8', level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%d/%m/%Y %I:%M:%S %p')
+# Only to logs/restic.log, restic.py prints its own output
+setup_logging({'logging': {'log_file': 'restic.log'}}, f'{script_path}/assets', console=False)
+bind_log(run=uuid.uuid4().hex[:12])
 config_location = f'{script_path}/config/config.yml'
 logging.info(f'Opening {config_location} as the configuration file.')
 
-try:
-    with open(config_location) as config_file:
-        config = yaml.safe_load(config_file)
-except FileNotFoundError:
-    print('Configuration file cannot be opened.')
-    logging.debug(f'No configuration file at: {config_location}.')
-    exit()
-
-def load_environment(restic_task):
-
+def print_report(metrics, single, action, days):
     '''
-    Checking if the basic keys exist on the config file, if it doesn't it will exit.
-    Tasks can be set to enabled = true or enabled = false to skip.
-    Once keys are checked and task is enabled the task keys are returned to be used.
+    Percentiles and trend per repo from the metrics store, throughput is restic's total_bytes_processed / total_duration.
+    LOCK is the time runs queued for the repo lock.
     '''
-    if not config['servers'][restic_task]:
-        return None
-    elif config['servers'][restic_task]['enabled'] is not True:
-        print(f'Skipping {restic_task} as it is disabled in the configuration file.')
-        return None
-    return config['servers'][restic_task]
+    rows = metrics.report(single, action, days)
+    if not rows:
+        print(f'No {action} runs recorded in the last {days} days.')
+        return
+    mib = lambda value: f'{value / 1024 / 1024:.1f}' if value is not None else '-'
+    secs = lambda value: f'{value:.1f}' if value is not None else '-'
+    print(f'{action} runs over the last {days} days (wall time in s, throughput in MiB/s):')
+    print(f'{"REPO":<20} {"TYPE":<8} {"RUNS":>5} {"FAIL":>5} {"WALL p50":>9} {"p90":>7} {"p99":>7} {"RATE p50":>9} {"p90":>7} {"p99":>7} {"LOCK p50":>9} {"p99":>7} {"DEDUP":>7} {"TREND":>8}')
+    for row in rows:
+        wall, rate, lock_wait = row['wall_time'], row['throughput'], row['lock_wait']
+        dedup = f'{row["dedup_ratio"]:.1f}x' if row['dedup_ratio'] else '-'
+        trend = f'{row["trend"]:+.0f}%' if row['trend'] is not None else '-'
+        print(f'{row["repo"]:<20} {row["backend"]:<8} {row["runs"]:>5} {row["failed"]:>5} {secs(wall[50]):>9} {secs(wall[90]):>7} {secs(wall[99]):>7} {mib(rate[50]):>9} {mib(rate[90]):>7} {mib(rate[99]):>7} {secs(lock_wait[50]):>9} {secs(lock_wait[99]):>7} {dedup:>7} {trend:>8}')
 
-def choice(action, task, snapshot_id, restore_path, single, command):
-    '''
-    To trigger the actions.
-    Restore, create and mount cannot run for all repos, a single repo must be chosen with --single <repo>
-    '''
-    logging.info(f'Task is set to {action}')
-    if action == 'other':
-        if not command:
-            print(f'Command is empty.')
-            sys.exit()
-        task.other(command)
-    if action == 'backup':
-        options = task.option_parser()
-        task.backup(options)
-    elif action == 'forget':
-        task.forget()
-    elif action == 'snapshots':
-        task.list_snapshots()
-    elif action == 'restore':
-        if not single:
-            print(f'Cannot {action} all repos, use --single.')
-            logging.warning(f'Action was set to {action} but all repos were selected. Exiting.')
-            sys.exit()
-        task.restore(snapshot_id, restore_path)
-    elif action == 'mount':
-        if not single:
-            print(f'Cannot {action} all repos, use --single.')
-            logging.warning(f'Action was set to {action} but all repos were selected. Exiting.')
-            sys.exit()
-        task.mount(restore_path)
-    elif action == 'init':
-        if not single:
-            print(f'Cannot {action} all repos, use --single.')
-            logging.warning(f'Action was set to {action} but all repos were selected. Exiting.')
-            sys.exit()
-        task.create()
+def print_snapshots(restic_task, snapshots):
+    print(f'Snapshots of {restic_task} from the local index:')
+    print(f'{"ID":<10} {"TIME":<20} {"HOST":<20} {"TAGS":<20} PATHS')
+    for snapshot in snapshots:
+        time = datetime.fromtimestamp(snapshot['time']).strftime('%Y-%m-%d %H:%M:%S')
+        print(f'{snapshot["short_id"]:<10} {time:<20} {snapshot["hostname"] or "":<20} {",".join(snapshot["tags"]):<20} {",".join(snapshot["paths"])}')
+    print(f'{len(snapshots)} snapshots')
+
+def snapshot_filters(args):
+    filters = {'tag': args.tag, 'host': args.host, 'path': args.path}
+    if args.before:
+        filters['before'] = datetime.fromisoformat(args.before).timestamp()
+    if args.after:
+        filters['after'] = datetime.fromisoformat(args.after).timestamp()
+    return {key: value for key, value in filters.items() if value is not None}
+
+def restore_options(args):
+    includes = list(args.include or [])
+    if args.files:
+        with open(args.files) as files:
+            includes += [line.strip() for line in files if line.strip()]
+    return {'includes': includes, 'excludes': args.exclude or [], 'workers': args.restore_workers}
 
 def main():
     parser = argparse.ArgumentParser(description='Create and manage backups using restic.')
@@ -75,28 +64,80 @@ def main():
     parser.add_argument('--snapshot_id', type=str, help='Use snapshot ID as argument.')
     parser.add_argument('--restore_path', type=str, help='Set restore path.')
     parser.add_argument('--command', type=str, help='Pass other command.')
-    parser.add_argument('action', type=str, help='init, backup, restore, snapshots, mount or forget.', choices=['init', 'backup', 'forget', 'snapshots', 'restore', 'mount', 'other'])
+    parser.add_argument('--workers', type=int, help='Number of repos to run at the same time when --single is not used.')
+    parser.add_argument('--tag', type=str, help='Filter snapshots by tag (snapshots, restore).')
+    parser.add_argument('--host', type=str, help='Filter snapshots by hostname (snapshots, restore).')
+    parser.add_argument('--path', type=str, help='Filter snapshots by backed up path (snapshots, restore).')
+    parser.add_argument('--before', type=str, help='Only snapshots taken up to this ISO date/time (snapshots, restore).')
+    parser.add_argument('--after', type=str, help='Only snapshots taken from this ISO date/time (snapshots).')
+    parser.add_argument('--include', type=str, action='append', help='Only restore paths matching this pattern, can be repeated.')
+    parser.add_argument('--exclude', type=str, action='append', help='Skip paths matching this pattern on restore, can be repeated.')
+    parser.add_argument('--files', type=str, help='File with one path per line to restore, added to --include.')
+    parser.add_argument('--restore_workers', type=int, default=4, help='restic restore processes to run at once for a partial restore.')
+    parser.add_argument('--cached', action='store_true', help='List snapshots from the local index instead of the repo.')
+    parser.add_argument('--refresh', action='store_true', help='Refresh the local snapshot index before using it.')
+    parser.add_argument('--profile', type=str, help='Shaping profile from config.yml to use instead of the repo\'s shaping windows.')
+    parser.add_argument('--report_action', type=str, default='backup', help='Action to show in report, backup by default.')
+    parser.add_argument('--days', type=int, default=30, help='Days of runs to include in report.')
+    parser.add_argument('action', type=str, help='init, backup, restore, dump, snapshots, mount, forget, maintenance or report.', choices=['init', 'backup', 'forget', 'maintenance', 'snapshots', 'restore', 'dump', 'mount', 'other', 'report'])
     args = parser.parse_args()
+    try:
+        config = load_config(config_location)
+    except FileNotFoundError:
+        print('Configuration file cannot be opened.')
+        logging.debug(f'No configuration file at: {config_location}.')
+        exit()
+    except ConfigError as e:
+        print(e)
+        logging.warning(str(e))
+        exit()
+    runner = Runner(config, script_path)
+    if args.profile and args.profile not in (config.get('profiles') or {}):
+        print(f'Profile {args.profile} is not in the configuration file.')
+        sys.exit()
     single = args.single
     action = args.action
     snapshot_id = args.snapshot_id
     restore_path = args.restore_path
     command = args.command
+    workers = args.workers
     servers = config['servers']
-    restic_path = config['restic_path']
+    if action == 'report':
+        print_report(runner.metrics, single, args.report_action, args.days)
+        return
+    filters = snapshot_filters(args)
+    if action == 'snapshots' and (filters or args.cached or args.refresh):
+        for restic_task in ([single] if single else servers):
+            task = runner.task(restic_task)
+            if task is None:
+                continue
+            snapshots = runner.snapshots(restic_task, task, args.refresh, **filters)
+            if snapshots is not None:
+                print_snapshots(restic_task, snapshots)
+        return
     if single in servers:
-        loaded_config = load_environment(single)
-        if loaded_config is None:
+        task = runner.task(single)
+        if task is None:
             sys.exit() 
-        task = ResticBackup(loaded_config, restic_path, script_path)
-        choice(action, task, snapshot_id, restore_path, single, command)
+        options = restore_options(args)
+        # restic's own latest would pick the newest snapshot even when it is a partial one of a change-limited backup
+        if action in ['restore', 'dump'] and snapshot_id in [None, 'latest']:
+            if action == 'restore' and filters.get('tag') != partial_tag:
+                snapshot_id, options['overlays'] = runner.resolve_latest(single, task, **filters)
+            else:
+                snapshot_id = runner.resolve_snapshot(single, task, **filters)
+            if snapshot_id is None:
+                print(f'No complete snapshot of {single}' + (f' matches {filters}.' if filters else '.'))
+                sys.exit()
+            overlays = options.get('overlays')
+            print(f'Using snapshot {snapshot_id}' + (f' with the changes of {len(overlays)} newer partial snapshots.' if overlays else '.'), file=sys.stderr)
+        runner.run_task(single, task, [], action, snapshot_id, restore_path, single, command, options, args.profile)
     elif single == '' or single == None:
-        for restic_task in servers:
-            loaded_config = load_environment(restic_task)
-            if loaded_config is None:
-                continue
-            task = ResticBackup(loaded_config, restic_path, script_path)
-            choice(action, task, snapshot_id, restore_path, single, command)
+        if action in ['restore', 'dump', 'mount', 'init']:
+            print(f'Cannot {action} all repos, use --single.')
+            logging.warning(f'Action was set to {action} but all repos were selected. Exiting.')
+            sys.exit()
+        runner.run_all(action, snapshot_id, restore_path, single, command, workers, args.profile)
     else:
         print(f'Selection cannot be found in config file.')
         logging.warning(f'Selection cannot be found in config file.')
@@ -0,0 +1,127 @@
+'''
+Change-limited backups (change_detection.files_from) and restoring "latest" afterwards, against a small restic stand-in
+that really stores the files it is given, so the restored tree can be checked.
+'''
+import os
+import sys
+import textwrap
+import pytest
+
+sys.path.insert(0, os.path.abspath(f'{os.path.dirname(__file__)}/..'))
+from assets.config import ConfigError, validate_config
+from assets.runner import Runner
+from assets.snapshot_index import partial_tag
+
+# Stores every backup as a copy of its files under <repo>/<snapshot id>/, answers snapshots --json and restores a
+# snapshot (or the files matching --include) into --target with the absolute paths below it, as restic does
+fake_restic = '''
+    import json, os, shutil, sys, time, uuid
+    args = sys.argv[1:]
+    with_value = {'-r', '--tag', '--password-file', '--files-from', '--target', '--include', '--exclude', '--group-by',
+                  '--keep-daily', '--keep-weekly', '--keep-monthly'}
+    options, positional = {}, []
+    i = 0
+    while i < len(args):
+        if args[i] in with_value:
+            options.setdefault(args[i], []).append(args[i + 1])
+            i += 2
+            continue
+        if not args[i].startswith('-'):
+            positional.append(args[i])
+        i += 1
+    repo = options['-r'][0]
+    os.makedirs(repo, exist_ok=True)
+    command, rest = positional[0], positional[1:]
+
+    def snapshots():
+        found = []
+        for name in os.listdir(repo):
+            with open(f'{repo}/{name}/snapshot.json') as meta:
+                found.append(json.load(meta))
+        return sorted(found, key=lambda snapshot: snapshot['time'])
+
+    if command == 'backup':
+        if '--files-from' in options:
+            with open(options['--files-from'][0]) as listing:
+                files = [line.strip() for line in listing if line.strip()]
+        else:
+            files = [os.path.join(root, name) for path in rest for root, _, names in os.walk(path) for name in names]
+        snapshot_id = uuid.uuid4().hex * 2
+        for path in files:
+            stored = f'{repo}/{snapshot_id}/files/{path.lstrip("/")}'
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            shutil.copy(path, stored)
+        created = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + f'.{time.time_ns() % 10**9:09d}Z'
+        meta = {'id': snapshot_id, 'short_id': snapshot_id[:8], 'time': created, 'hostname': 'test',
+                'paths': rest or files, 'tags': options.get('--tag', [])}
+        os.makedirs(f'{repo}/{snapshot_id}', exist_ok=True)
+        with open(f'{repo}/{snapshot_id}/snapshot.json', 'w') as out:
+            json.dump(meta, out)
+        print(f'snapshot {snapshot_id[:8]} saved')
+    elif command == 'snapshots':
+        print(json.dumps(snapshots()))
+    elif command == 'restore':
+        stored = f'{repo}/{rest[0]}/files'
+        includes = options.get('--include', [])
+        for root, _, names in os.walk(stored):
+            for name in names:
+                path = '/' + os.path.relpath(os.path.join(root, name), stored)
+                if includes and not any(path.startswith(include) for include in includes):
+                    continue
+                target = options['--target'][0] + path
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copy(os.path.join(root, name), target)
+'''
+
+@pytest.fixture
+def repo_config(tmp_path):
+    restic = tmp_path / 'restic'
+    restic.write_text(f'#!{sys.executable}\n' + textwrap.dedent(fake_restic))
+    restic.chmod(0o755)
+    (tmp_path / 'password').write_text('test\n')
+    (tmp_path / 'logs').mkdir()
+    source = tmp_path / 'data'
+    (source / 'docs').mkdir(parents=True)
+    (source / 'photos').mkdir()
+    (source / 'docs' / 'report.txt').write_text('report')
+    (source / 'photos' / 'beach.jpg').write_text('beach')
+    repo = {
+        'enabled': True, 'type': 'local', 'repo_path': str(tmp_path / 'repo'), 'password_file': str(tmp_path / 'password'),
+        'backup_path': str(source), 'forget_options': {'daily': 7, 'weekly': 4, 'monthly': 6},
+        'change_detection': {'enabled': True, 'files_from': True, 'max_skip_hours': 24},
+    }
+    return {'restic_path': str(restic), 'servers': {'data': repo}}, source
+
+def restored(target, path):
+    return target / str(path).lstrip('/')
+
+def test_restore_latest_includes_files_of_partial_backups(tmp_path, repo_config):
+    config, source = repo_config
+    runner = Runner(validate_config(config), str(tmp_path))
+    assert [row['status'] for row in runner.run_all('backup')] == ['ok']
+    (source / 'docs' / 'new.txt').write_text('new')
+    assert [row['status'] for row in runner.run_all('backup')] == ['ok']
+
+    task = runner.task('data')
+    newest = runner.snapshots('data', task, refresh=True)[0]
+    assert partial_tag in newest['tags']
+    snapshot_id, overlays = runner.resolve_latest('data', task)
+    assert snapshot_id != newest['id'] and overlays == [newest['id']]
+
+    target = tmp_path / 'restore'
+    row = runner.run_task('data', task, [], 'restore', snapshot_id, str(target), 'data', None, {'includes': [], 'excludes': [], 'workers': 1, 'overlays': overlays})
+    assert row['status'] == 'ok'
+    assert restored(target, source / 'docs' / 'new.txt').read_text() == 'new'
+    assert restored(target, source / 'docs' / 'report.txt').read_text() == 'report'
+    assert restored(target, source / 'photos' / 'beach.jpg').read_text() == 'beach'
+
+def test_files_from_needs_max_skip_hours(repo_config):
+    config, _ = repo_config
+    del config['servers']['data']['change_detection']['max_skip_hours']
+    with pytest.raises(ConfigError, match='max_skip_hours'):
+        validate_config(config)
+
+def test_forget_groups_partial_snapshots_by_tags(tmp_path, repo_config):
+    config, _ = repo_config
+    task = Runner(validate_config(config), str(tmp_path)).task('data')
+    assert task.type_selector('forget')[-4:-2] == ['--group-by', 'host,tags']